@@ -26,405 +26,680 @@
 #            --heads 50,100 \
 #            --plot annual_revenue,capacity \
 #            --interest 0.05 | less
+#
+# Or use it as a library, without the command line:
+#   import EPIC
+#   params = EPIC.make_params(catch_type=1, slope=45, cl=13, fdc_index=5, aar=1000, aae=400,
+#                             ca=1000000, reliability=0.7, market_price=0.03, interest=0.05)
+#   results = EPIC.run_epic(params, EPIC.read_pipe_table('pipes_0.csv'))
+#   results['schemes']['cost_per_kw']
+
 
-from math import sin, cos, tan, ceil, pi
+# prettytable and matplotlib are slow to import, so they are only imported by
+#   print_results() and plotting.py when they are needed.
+from math import sin, cos, tan, ceil, pi, isinf, isnan
 from math import radians as rad
 from optparse import OptionParser
-from prettytable import PrettyTable
 import sys
-import matplotlib.pyplot as p
-import datetime
 
 # other EPIC files
 from hydro_utils import *
+from hydro_vector import evaluate_heads, get_scheme
+from flow_series import get_annual_energy
 from constants import *
 
-### Take options {{{
-usage = """
-    EPIC ... some big helpful string for the user.
-    Maybe Name and Copyright notice
-"""
-# Take the options from the command line. All are required.
-parser = OptionParser(version='0.1', usage=usage)
-parser.add_option('--verbose', dest='v', action='store_true', default=False,
-                  help='Verbose output. Prints optimums for every head.')
-parser.add_option('--catchment_area', dest='ca',
-                  help='Total area of catchment upstream of powerhouse.')
-parser.add_option('--catchment_type', dest='catch_type',
-                  help='See writeup for different area types.', metavar='INT')
-parser.add_option('--catchment_length', dest='cl',
-                  help='The length from the powerhouse to the furthest point of the catchment area')
-parser.add_option('--flow_duration_curve', dest='fdc_index',
-                  help='Flow duration curve selected by user based on knowledge of catchment geology.')
-parser.add_option('--slope', dest='slope',
-                  help='General slopiness of the pipe.')
-parser.add_option('--precipitation', dest='aar',
-                  help='Anticipated annual rainfall')
-parser.add_option('--potential_evaporation', dest='aae',
-                  help='Anticipated annual evaporation')
-parser.add_option('--pipe_file', dest='pipe_file',
-                  help='PATH to file containing pipe costs.')
-parser.add_option('--reliability', dest='reliability',
-                  help='Relability Factor')
-parser.add_option('--efficiency', dest='efficiency',
-                  help='Efficiency. Normally 0.82', default=0.82)
-parser.add_option('--market_price', dest='market_price',
-                  help='Fluctuant value per kW in GBP')
-parser.add_option('--interest', dest='interest',
-                  help='Rate of interest charged on project loan.')
-parser.add_option('--plots', dest='plots',
-                  help='Plots to make.')
-parser.add_option('--heads', dest='heads',
-                  help='Head values to test.')
-(opts, args) = parser.parse_args()
-
-# Ensure passed parameters are the correct type
-opts.ca = float(opts.ca)
-opts.cl = float(opts.cl)
-opts.fdc_index = int(opts.fdc_index) - 1 # Minus one for array access.
-opts.slope = float(opts.slope)
-opts.catch_type = int(opts.catch_type)
-opts.aar = float(opts.aar)
-opts.aae = float(opts.aae)
-opts.pipe_file = str(opts.pipe_file)
-opts.reliability = float(opts.reliability)
-opts.efficiency = float(opts.efficiency)
-opts.market_price = float(opts.market_price)
-opts.interest = float(opts.interest)
-if opts.plots: opts.plots = str(opts.plots)
-if opts.heads: opts.heads = str(opts.heads)
-
-### }}} End of Take options
-
-# Maximum height
-max_H = tan(rad(opts.slope)) * opts.cl
-
-# Get Pipe Table {{{
-# Read in pipe diameter/cost table from a comma separated values file
-try:
-    pipe_file = open(opts.pipe_file, 'r')
-    pipe_string = pipe_file.read()
-    pipe_file.close()
-except:
-    print 'Something went wrong with pipe file.'
-    sys.exit(1)
-pipe_table = []
-i = 0
-for line in pipe_string.splitlines():
-    if i > 0:
-        (diameter, pvc, di, grp) = line.split(',')
-        table_line = [diameter, pvc, di, grp]
-        pipe_table.append(table_line)
-    i += 1
-# }}} Get Pipe Table
-
-# Potential evaporation calculated from Layman's Guidebook - On How
-# To Develop A Small Hydro Site, Chapter 3, page 69.
-if opts.aar < 850:
-    opts.aae = (0.00061 * aar + 0.475) * aae
-
-# There are optimum schemes to be chosen, each for a different economic factor.
-# Cost/kW, Payback Period, Annual ROI, Annual Revenue, Capacity
-# Initialise optimum schemes {{{
-scheme_cost_per_kw      = {'diameter'              : 0.0,
-                           'material'              : '',
-                           'head'                  : 0.0,
-                           'capacity'              : 0.0,
-                           'project_cost'          : 0.0,
-                           'cost_per_kw'           : 999999999.9,
-                           'payback_period'        : 999999999.9,
-                           'annual_roi'            : 0.0,
-                           'annual_revenue'        : 0.0}
-
-scheme_payback_period   = {'diameter'              : 0.0,
-                           'material'              : '',
-                           'head'                  : 0.0,
-                           'capacity'              : 0.0,
-                           'project_cost'          : 0.0,
-                           'cost_per_kw'           : 999999999.9,
-                           'payback_period'        : 999999999.9,
-                           'annual_roi'            : 0.0,
-                           'annual_revenue'        : 0.0}
-
-scheme_annual_roi       = {'diameter'              : 0.0,
-                           'material'              : '',
-                           'head'                  : 0.0,
-                           'capacity'              : 0.0,
-                           'project_cost'          : 0.0,
-                           'cost_per_kw'           : 999999999.9,
-                           'payback_period'        : 999999999.9,
-                           'annual_roi'            : 0.0,
-                           'annual_revenue'        : 0.0}
-
-scheme_annual_revenue   = {'diameter'              : 0.0,
-                           'material'              : '',
-                           'head'                  : 0.0,
-                           'capacity'              : 0.0,
-                           'project_cost'          : 0.0,
-                           'cost_per_kw'           : 999999999.9,
-                           'payback_period'        : 999999999.9,
-                           'annual_roi'            : 0.0,
-                           'annual_revenue'        : 0.0}
-
-scheme_capacity         = {'diameter'              : 0.0,
-                           'material'              : '',
-                           'head'                  : 0.0,
-                           'capacity'              : 0.0,
-                           'project_cost'          : 0.0,
-                           'cost_per_kw'           : 999999999.9,
-                           'payback_period'        : 999999999.9,
-                           'annual_roi'            : 0.0,
-                           'annual_revenue'        : 0.0}
-# }}} Initialise optimum schemes
-
-# If no heads are specified then just compare all possible heads up to the maximum
-if opts.plots:
-    plots = opts.plots.split(',')
-
-# If no heads are specified then just compare all possible heads up to the maximum
-if opts.heads:
-    heads = str(opts.heads).split(',')
+def get_option_parser(): # {{{
+    '''
+    Returns the OptionParser for the EPIC.py command line.
+    '''
+    usage = """
+        EPIC ... some big helpful string for the user.
+        Maybe Name and Copyright notice
+    """
+    # Take the options from the command line. All are required.
+    parser = OptionParser(version='0.1', usage=usage)
+    parser.add_option('--verbose', dest='v', action='store_true', default=False,
+                      help='Verbose output. Prints optimums for every head.')
+    parser.add_option('--catchment_area', dest='ca',
+                      help='Total area of catchment upstream of powerhouse.')
+    parser.add_option('--catchment_type', dest='catch_type',
+                      help='See writeup for different area types, and CATCHMENT_SHAPES in hydro_utils.py.',
+                      metavar='INT')
+    parser.add_option('--catchment_length', dest='cl',
+                      help='The length from the powerhouse to the furthest point of the catchment area')
+    parser.add_option('--flow_duration_curve', dest='fdc_index',
+                      help='Flow duration curve selected by user based on knowledge of catchment geology.')
+    parser.add_option('--slope', dest='slope',
+                      help='General slopiness of the pipe.')
+    parser.add_option('--precipitation', dest='aar',
+                      help='Anticipated annual rainfall')
+    parser.add_option('--potential_evaporation', dest='aae',
+                      help='Anticipated annual evaporation')
+    parser.add_option('--pipe_file', dest='pipe_file',
+                      help='PATH to file containing pipe costs. See pipes.py for the format.')
+    parser.add_option('--reliability', dest='reliability',
+                      help='Relability Factor. Not used with --flow_series.')
+    parser.add_option('--efficiency', dest='efficiency',
+                      help='Efficiency. Normally 0.82', default=0.82)
+    parser.add_option('--market_price', dest='market_price',
+                      help='Fluctuant value per kW in GBP')
+    parser.add_option('--interest', dest='interest',
+                      help='Rate of interest charged on project loan.')
+    parser.add_option('--flow_series', dest='flow_series', metavar='FILE',
+                      help='Measured flows at the powerhouse (m^3/s), e.g. years of gauge data. '
+                           'The energy generated is worked out from them rather than from '
+                           '--reliability. See flow_series.py for the formats.')
+    parser.add_option('--flow_step', dest='flow_step', type='float', default=24.0, metavar='HOURS',
+                      help='Hours between the flows of --flow_series. Default 24, daily.')
+    parser.add_option('--min_flow', dest='min_flow', type='float', default=TurbineMinFlow,
+                      help='Fraction of the design flow below which the turbine stops, with '
+                           '--flow_series. Default %s.' % TurbineMinFlow)
+    parser.add_option('--plots', dest='plots',
+                      help='Plots to make, a comma separated list of penstock_length, '
+                           'avg_flow_rate, design_flow, fit, capacity, total_penstock_cost, '
+                           'total_project_cost, annual_revenue, payback_period, cost_per_kw '
+                           'and annual_roi.')
+    parser.add_option('--plot_layout', dest='plot_layout', default='separate',
+                      type='choice', choices=['separate', 'grid'],
+                      help='separate (default) saves each plot to its own file, rendered across '
+                           '--processes processes, grid saves them all as one figure.')
+    parser.add_option('--plot_points', dest='plot_points', type='int', default=2000,
+                      help='Continuous plots with more heads than this are downsampled to this '
+                           'many points. 0 never downsamples. Default 2000.')
+    parser.add_option('--heads', dest='heads',
+                      help='Head values to test.')
+    parser.add_option('--engine', dest='engine', default='vector',
+                      type='choice', choices=['vector', 'scalar'],
+                      help='vector evaluates every head at once (default), scalar one head at a time. '
+                           '--verbose always uses scalar.')
+    parser.add_option('--friction_method', dest='friction_method', default='fixed_point',
+                      type='choice', choices=['fixed_point', 'newton', 'swamee_jain', 'haaland', 'moody'],
+                      help='How the Colebrook-White equation is solved. Default fixed_point, '
+                           'moody uses a precomputed lookup table (see moody.py).')
+    parser.add_option('--friction_tolerance', dest='friction_tolerance', type='float',
+                      default=FrictionTolerance,
+                      help='Relative tolerance at which the friction solver stops iterating.')
+    parser.add_option('--pipe_search', dest='pipe_search', default='exhaustive',
+                      type='choice', choices=['exhaustive', 'bound'],
+                      help='How the diameters are searched for each head: exhaustive (default) '
+                           'tries every row of the pipe file, bound stops once no other pipe '
+                           'can be cheaper and reports the diameters skipped. bound uses the '
+                           'scalar engine.')
+    parser.add_option('--top', dest='top', type='int', default=1, metavar='K',
+                      help='Report the best K schemes of each economic factor rather than only '
+                           'the optimum. Default 1.')
+    parser.add_option('--format', dest='format', default='table',
+                      type='choice', choices=['table', 'json', 'csv'],
+                      help='Output format: table (default) for people, json or csv for programs.')
+    parser.add_option('--output', dest='output', metavar='FILE',
+                      help='Write every head evaluated (pipe, head loss, capacity, costs, payback, '
+                           'ROI) to FILE as it is worked out. See export.py.')
+    parser.add_option('--output_format', dest='output_format',
+                      type='choice', choices=['csv', 'jsonl', 'columnar'],
+                      help='Format of --output: csv, jsonl or columnar (a directory of .npy '
+                           'files). Defaults to the extension of FILE.')
+    parser.add_option('--no_cache', dest='no_cache', action='store_true', default=False,
+                      help='Always work out the results rather than reading them from the result '
+                           'cache in ~/.epic/results. See result_cache.py.')
+    parser.add_option('--clear_cache', dest='clear_cache', action='store_true', default=False,
+                      help='Empty the result cache first.')
+    parser.add_option('--cache_size', dest='cache_size', type='float', default=256,
+                      help='Most MB the result cache may hold, least recently used results '
+                           'are removed first. Default 256.')
+    parser.add_option('--batch', dest='batch', metavar='FILE',
+                      help='CSV file of catchments, one per line, with a header of option names. '
+                           'Options not in the file are taken from the command line. See batch.py.')
+    parser.add_option('--processes', dest='processes', type='int',
+                      help='Processes used by --batch, --serve and to render --plots. Defaults to '
+                           'the number of CPUs.')
+    parser.add_option('--monte_carlo', dest='monte_carlo', type='int', metavar='N',
+                      help='Draw N samples of the --uncertain inputs and report percentile bands.')
+    parser.add_option('--uncertain', dest='uncertain',
+                      help='Distributions for --monte_carlo, e.g. '
+                           'precipitation=normal:1600:150,market_price=uniform:0.02:0.05. '
+                           'See monte_carlo.py.')
+    parser.add_option('--seed', dest='seed', type='int',
+                      help='Seed for the --monte_carlo random numbers.')
+    parser.add_option('--sweep', dest='sweep',
+                      help='Grid of interest, market_price, efficiency and reliability values '
+                           'to find the optimum schemes at, e.g. '
+                           'interest=0.03:0.08:50,market_price=0.02:0.05:50. See sweep.py.')
+    parser.add_option('--fdc_sweep', dest='fdc_sweep', action='store_true', default=False,
+                      help='Evaluate every flow duration curve against every head and report '
+                           'the optimum (head, design flow) of each economic factor, rather than '
+                           'using --flow_duration_curve. --plots are heatmaps. See fdc_sweep.py.')
+    parser.add_option('--head_search', dest='head_search', action='store_true', default=False,
+                      help='Search continuous heads for the optimum schemes instead of every '
+                           'whole meter. Cannot be used with --heads. See head_search.py.')
+    parser.add_option('--interactive', dest='interactive', action='store_true', default=False,
+                      help='After the results, read lines of option=value (e.g. '
+                           'market_price=0.04 interest=0.06) and print the results again. Only '
+                           'the stages which the changed options affect are worked out again. '
+                           'See stages.py.')
+    parser.add_option('--dem', dest='dem', metavar='FILE',
+                      help='Digital elevation model of the catchment, an ESRI ASCII (.asc) or '
+                           'float (.flt) grid in meters. Every cell of the channel above the '
+                           'powerhouse is evaluated as an intake, with its measured head and '
+                           'upstream area, instead of --catchment_type, --catchment_length and '
+                           '--slope. See dem.py.')
+    parser.add_option('--dem_outlet', dest='dem_outlet', metavar='X,Y',
+                      help='Where the powerhouse is on the --dem. Defaults to the cell which '
+                           'the most of the DEM drains through.')
+    parser.add_option('--dem_snap', dest='dem_snap', type='int', default=3, metavar='CELLS',
+                      help='--dem_outlet is moved onto the channel within this many cells. '
+                           'Default 3.')
+    parser.add_option('--dem_min_area', dest='dem_min_area', type='float', default=0.0,
+                      help='The channel is traced up the --dem while at least this many m^2 '
+                           'drain to it. Default 0, up to its source.')
+    parser.add_option('--long_profile', dest='long_profile', metavar='FILE',
+                      help='CSV of the surveyed river, chainage,elevation per line. An intake at '
+                           'every point above the powerhouse is evaluated, with the head and '
+                           'penstock length measured along the river instead of from --slope. '
+                           'See long_profile.py.')
+    parser.add_option('--powerhouse_chainage', dest='powerhouse_chainage', type='float',
+                      help='Chainage of the powerhouse on the --long_profile. Defaults to its '
+                           'lower end.')
+    parser.add_option('--pareto', dest='pareto', metavar='OBJECTIVES',
+                      help='Comma separated economic factors to trade off, some of capacity, '
+                           'annual_revenue, annual_roi, payback_period, cost_per_kw and '
+                           'project_cost. Prints the Pareto front: every scheme which no other '
+                           'beats on all of them. See pareto.py.')
+    parser.add_option('--pareto_plot', dest='pareto_plot', action='store_true', default=False,
+                      help='With --pareto, save a plot of the front for each pair of objectives '
+                           'into the plots directory.')
+    parser.add_option('--serve', dest='serve', action='store_true', default=False,
+                      help='Answer JSON requests over HTTP on --host and --port, keeping the '
+                           'pipe files and results warm between them. The other options are '
+                           'the defaults of each request. See serve.py.')
+    parser.add_option('--host', dest='host', default='127.0.0.1',
+                      help='Address --serve listens on. Default 127.0.0.1, this machine only.')
+    parser.add_option('--port', dest='port', type='int', default=8340,
+                      help='Port --serve listens on. Default 8340.')
+    parser.add_option('--queue', dest='queue', type='int', default=64,
+                      help='Requests which may wait for one of the --processes workers of '
+                           '--serve, more are answered 503. Default 64.')
+    parser.add_option('--profile', dest='profile', metavar='FILE',
+                      help='Write a JSON report of the run to FILE: the time of each stage, '
+                           'calls of get_friction_coeff, get_head_loss and get_area, friction '
+                           'solver iterations and peak memory. See profiling.py.')
+    parser.add_option('--profile_dump', dest='profile_dump', metavar='FILE',
+                      help='Also write a cProfile dump of the run to FILE, its most expensive '
+                           'functions are put in the --profile report.')
+    parser.add_option('--head_tolerance', dest='head_tolerance', type='float', default=0.01,
+                      help='Meters to which --head_search finds the optimum heads. Default 0.01.')
+    return parser
+    # }}} End of get_option_parser
+
+def normalise_params(opts): # {{{
+    '''
+    Ensures passed parameters are the correct type.
+    opts holds the values as given on the command line.
+    '''
+    # Ensure passed parameters are the correct type
+    if opts.dem: # The catchment is measured, see dem.py
+        if opts.ca is None: opts.ca = 'nan'
+        if opts.cl is None: opts.cl = 0
+        if opts.slope is None: opts.slope = 0
+        if opts.catch_type is None: opts.catch_type = 0
+    if opts.long_profile and opts.slope is None: opts.slope = 0 # Measured, see long_profile.py
+    opts.ca = float(opts.ca)
+    opts.cl = float(opts.cl)
+    if opts.fdc_index is None and opts.fdc_sweep: opts.fdc_index = 1 # Every curve is used
+    opts.fdc_index = int(opts.fdc_index) - 1 # Minus one for array access.
+    opts.slope = float(opts.slope)
+    opts.catch_type = int(opts.catch_type)
+    opts.aar = float(opts.aar)
+    opts.aae = float(opts.aae)
+    if opts.pipe_file: opts.pipe_file = str(opts.pipe_file)
+    if opts.reliability is None and opts.flow_series: opts.reliability = 1.0 # Not used
+    opts.reliability = float(opts.reliability)
+    opts.efficiency = float(opts.efficiency)
+    opts.market_price = float(opts.market_price)
+    opts.interest = float(opts.interest)
+    if opts.plots: opts.plots = str(opts.plots)
+    if opts.heads: opts.heads = str(opts.heads)
+    opts.top = int(opts.top)
+    if opts.v: opts.engine = 'scalar' # Only the scalar engine prints every head
+    if opts.pipe_search == 'bound': opts.engine = 'scalar' # The vector engine tries every pipe at once
+
+    return opts
+    # }}} End of normalise_params
+
+# Options which each run EPIC.py in a mode of its own, so only one may be given
+MODE_OPTIONS = ['--batch', '--serve', '--monte_carlo', '--sweep', '--head_search', '--fdc_sweep',
+                '--interactive', '--dem', '--long_profile', '--pareto']
+
+def check_mode_options(parser, opts): # {{{
+    '''
+    Stops with a usage error, through parser.error(), if opts has more than one of
+      MODE_OPTIONS.
+    '''
+    given = [name for name in MODE_OPTIONS
+             if getattr(opts, parser.get_option(name).dest) not in (None, False)]
+    if len(given) > 1: parser.error('%s cannot be used together' % ', '.join(given))
+    # }}} End of check_mode_options
+
+def parse_args(argv=None): # {{{
+    '''
+    Parses the command line, argv defaults to sys.argv[1:].
+    Returns (params, args) with params ready for run_epic().
+    '''
+    parser = get_option_parser()
+    (opts, args) = parser.parse_args(argv)
+    check_mode_options(parser, opts)
+    return (normalise_params(opts), args)
+    # }}} End of parse_args
+
+def make_params(**kwargs): # {{{
+    '''
+    Returns params for run_epic() from keyword arguments named after the dest of each
+      command line option (ca, cl, catch_type, fdc_index, slope, aar, aae, ...).
+    Values are as they would be given on the command line, so fdc_index counts from 1,
+      and options which are not given take their command line defaults.
+    '''
+    params = get_option_parser().get_default_values()
+    for (key, value) in kwargs.items():
+        if not hasattr(params, key):
+            raise TypeError('Unknown EPIC parameter: %s' % key)
+        setattr(params, key, value)
+    return normalise_params(params)
+    # }}} End of make_params
+
+def read_pipe_table(filename): # {{{
+    '''
+    Read in pipe diameter/cost table from a comma separated values file.
+    The first line is a header naming the materials, then each line is a diameter and
+      the cost/m in each material (see pipes.py).
+    Returns a pipes.PipeCatalogue, cached in ~/.epic so a file is only parsed once.
+    '''
+    import pipes
+    return pipes.read_pipe_catalogue(filename)
+    # }}} End of read_pipe_table
+
+def get_heads(params): # {{{
+    '''
+    Returns (heads, max_H): the heads to evaluate and the maximum head of the catchment.
+    Raises ValueError if a head in params.heads is above the maximum head.
+    '''
+    # Maximum height
+    max_H = tan(rad(params.slope)) * params.cl
+
+    # If no heads are specified then just compare all possible heads up to the maximum
+    if params.heads:
+        heads = str(params.heads).split(',')
+        for i, h in enumerate(heads):
+            heads[i] = int(h)
+            if heads[i] > max_H:
+                raise ValueError('Head is too large for catchment area: %d' % heads[i])
+
+    else:
+        heads = range(1, int(ceil(max_H)))
+
+    return (heads, max_H)
+    # }}} End of get_heads
+
+# The per head values of run_epic(), keyed as the plots
+AXES = ['head', 'penstock_length', 'avg_flow_rate', 'design_flow', 'fit', 'capacity',
+        'total_penstock_cost', 'total_project_cost', 'annual_revenue', 'payback_period',
+        'cost_per_kw', 'annual_roi']
+
+# The vector engine evaluates the heads in chunks of about this many (head, diameter,
+#   material) elements, so its memory does not grow with the number of heads.
+RUN_CHUNK_ELEMENTS = 1500000
+
+def run_epic(params, pipe_table, keep_axes=None, output=None): # {{{
+    '''
+    Evaluates a scheme for every head and chooses the optimum schemes.
+    params is from parse_args() or make_params(), pipe_table from read_pipe_table().
+    The optimum schemes are chosen as the heads go by (see reducer.py), the per head
+      values are only kept if keep_axes is True, by default when params.plots asks
+      for plots. output is an export.HeadWriter which every head is written to as it
+      is evaluated, or None.
+    Returns a dict with:
+      max_H        - the maximum head of the catchment
+      schemes      - the optimum scheme for each of capacity, annual_revenue,
+                     annual_roi, payback_period and cost_per_kw
+      top          - the best params.top schemes of each of those, best first
+      head_schemes - the scheme for every head given in params.heads
+      axes         - lists of every per head value, keyed as AXES, or empty lists
+                     if they were not kept
+      diameters_skipped - the diameters which params.pipe_search did not need to
+                     try, over every head
+      evaluations  - the number of heads evaluated
+    Raises ValueError if a head in params.heads is above the maximum head.
+    '''
+    from pipes import get_pipe_catalogue
+    from reducer import SchemeReducer
+
+    (heads, max_H) = get_heads(params)
+    pipe_table = get_pipe_catalogue(pipe_table)
+    if keep_axes is None: keep_axes = bool(params.plots)
+
+    # There are optimum schemes to be chosen, each for a different economic factor.
+    # Cost/kW, Payback Period, Annual ROI, Annual Revenue, Capacity
+    reducer = SchemeReducer(getattr(params, 'top', 1) or 1)
     head_schemes = []
-    for i, h in enumerate(heads):
-        heads[i] = int(h)
-        if heads[i] > max_H:
-            print 'Error: Head is too large for catchment area. Exiting'
-            sys.exit(1)
+    diameters_skipped = 0
+    axes = dict((name, []) for name in AXES)
+
+    if params.engine == 'vector': ### all heads at once, a chunk at a time {{{
+        chunk = max(1, RUN_CHUNK_ELEMENTS // max(1, len(pipe_table) * len(pipe_table.materials)))
+        for start in range(0, len(heads), chunk):
+            chunk_heads = heads[start:start + chunk]
+            results = evaluate_heads(chunk_heads, pipe_table, params)
+            reducer.add_results(results, chunk_heads)
+            if output: output.write(results)
+
+            if keep_axes:
+                axes['head'].extend(chunk_heads)
+                for name in AXES[1:]: axes[name].extend(results[name].tolist())
+
+            if params.heads:
+                head_schemes += [get_scheme(results, i, h) for (i, h) in enumerate(chunk_heads)]
+        ### }}} End of all heads at once
+
+    else:
+        # Potential evaporation is corrected for low rainfall
+        aae = get_evaporation(params.aar, params.aae)
+
+        for h in heads: ### for each head {{{
+            if params.v: print 'Head = %d' % h
+
+            # penstock_length {{{
+            penstock_length = float(h) / sin(rad(params.slope))
+            Hz = float(h) / tan(rad(params.slope))
+            # }}} penstock_length
+
+            # Flow rate {{{
+            area_frac = get_area(params.catch_type, params.cl, Hz, params.v)
+            avail_ca = params.ca * area_frac
+
+            # Now that the area of the catchment area has been calculated
+            # catchment_vol is the annual total volume of precipitation which enters the catchment.
+            catchment_vol = avail_ca * ((params.aar - aae) / 1000) # Divide by 1000 to put mm into meters
+            avg_flow_rate = catchment_vol / (365 * 24 * 60 * 60) # In cumecs
+            if params.v: print '\tAverage flow rate = %(flow)s' % {'flow': avg_flow_rate}
+            # }}} Flow rate
+
+            # Design flow {{{
+            design_flow = avg_flow_rate * flow_duration_curve[params.fdc_index]
+            if params.v: print '\tDesign flow = %(flow)s' % {'flow': design_flow}
+            # }}} End of Design flow
+
+            # FIT {{{
+            # The Hydro Estimation Parameter (HEP) is just a number used to quickly estimate the
+            #   installed power capacity in kW.
+            # It comes from a combination of G(9.81) and an efficiency of around 82%.
+            capacity_estimate = design_flow * h * HEP
+            if capacity_estimate <= 100: FIT = GTHigh
+            else: FIT = GTLow
+            # }}} FIT
+
+            # Get optimum pipe {{{
+            pipe = get_optimum_pipe_for_head(head            = h,
+                                             pipe_table      = pipe_table,
+                                             design_flow     = design_flow,
+                                             penstock_length = penstock_length,
+                                             FIT             = FIT,
+                                             efficiency      = params.efficiency,
+                                             market_price    = params.market_price, 
+                                             interest        = params.interest,
+                                             verbose         = False,
+                                             friction_method = params.friction_method,
+                                             friction_tolerance = params.friction_tolerance,
+                                             search          = params.pipe_search)
+            if params.v: print '\tOptimum pipe for this head = ', pipe
+            diameters_skipped += pipe['skipped']
+            # }}} End of Get optimum pipe
+
+            # capacity {{{
+            capacity = get_scheme_capacity(head = h,
+                                           head_loss = pipe['head_loss'],
+                                           Q = design_flow,
+                                           efficiency = params.efficiency)
+            if params.v: print '\tCapacity = %f' % capacity
+            #if capacity < 15: continue # 15kW is the minimum threshold for a small hydroscheme (rather than a pico,
+                                       #   which has different equations relating to cost, and methodologies associated).
+            # }}} End of capacity
+
+            # Total project cost {{{
+            # Capital expenditure of penstock
+            total_penstock_cost = pipe['annual_capital_cost'] / params.interest
+            if params.v: print '\tTotal Penstock cost = %f' % total_penstock_cost
+
+            # The total project cost has quite a predicable breakdown for hydro schemes.
+            # Therefore the rough fraction is stored as a constant.
+            total_project_cost = total_penstock_cost / PenFrac
+            if params.v: print '\tTotal Project Cost = %f' % total_project_cost
+            # }}} End of Total project cost
+
+            # Annual Revenue {{{
+            # From the flow series if there is one, see flow_series.py
+            annual_energy = get_annual_energy(params, area_frac, design_flow, h,
+                                              pipe['head_loss'], params.efficiency)
+            if annual_energy is not None:
+                annual_energy = float(annual_energy)
+                if params.v: print '\tAnnual energy = %f' % annual_energy
+
+            annual_revenue = get_scheme_annual_revenue(C = capacity,
+                                                       FIT = FIT,
+                                                       P = params.market_price,
+                                                       R = params.reliability,
+                                                       interest = params.interest,
+                                                       total = total_project_cost,
+                                                       E = annual_energy)
+
+            if params.v: print '\tScheme Annual Revenue = %f' % annual_revenue
+            # }}} Annual Revenue
+
+            # Payback period {{{
+            # The payback period, cost/kW and return are the main economic factors of a scheme.
+            payback_period = total_project_cost / annual_revenue
+            if params.v: print '\tScheme Payback Period = %f' % payback_period
+            # }}} Payback period
+
+            # Cost/kW {{{
+            cost_per_kw = total_project_cost / capacity
+            if params.v: print '\tScheme Cost/kW = %f' % cost_per_kw
+            # }}} Cost/kW
+
+            # Annual RIO {{{
+            annual_return_on_investment = annual_revenue / total_project_cost * 100
+            if params.v: print '\tScheme annual ROI = %f' % annual_return_on_investment 
+            # }}} Annual RIO
+
+            # Now we have all the desired economic factors we can choose the optimum scheme
+            #   for each.
+            scheme = {'diameter'       :   pipe['diameter'],
+                      'material'       :   pipe['material'],
+                      'head'           :   h,
+                      'capacity'       :   capacity,
+                      'project_cost'   :   total_project_cost,
+                      'cost_per_kw'    :   cost_per_kw,
+                      'payback_period' :   payback_period,
+                      'annual_roi'     :   annual_return_on_investment,
+                      'annual_revenue' :   annual_revenue}
+            reducer.add(scheme)
+            if params.heads: head_schemes.append(scheme)
+
+            if output:
+                output.add({'head'                : h,
+                            'penstock_length'     : penstock_length,
+                            'avg_flow_rate'       : avg_flow_rate,
+                            'design_flow'         : design_flow,
+                            'fit'                 : FIT,
+                            'diameter'            : pipe['diameter'],
+                            'material'            : pipe['material'],
+                            'head_loss'           : pipe['head_loss'],
+                            'capacity'            : capacity,
+                            'total_penstock_cost' : total_penstock_cost,
+                            'total_project_cost'  : total_project_cost,
+                            'annual_revenue'      : annual_revenue,
+                            'payback_period'      : payback_period,
+                            'cost_per_kw'         : cost_per_kw,
+                            'annual_roi'          : annual_return_on_investment})
+
+            if keep_axes:
+                for (name, value) in zip(AXES, [h, penstock_length, avg_flow_rate, design_flow,
+                                                FIT, capacity, total_penstock_cost,
+                                                total_project_cost, annual_revenue,
+                                                payback_period, cost_per_kw,
+                                                annual_return_on_investment]):
+                    axes[name].append(value)
+
+        ### }}} End of for each head loop
+
+    return {'max_H'         : max_H,
+            'schemes'       : reducer.schemes(),
+            'top'           : dict((f[0], reducer.top(f[0])) for f in reducer.factors),
+            'head_schemes'  : head_schemes,
+            'axes'          : axes,
+            'diameters_skipped' : diameters_skipped,
+            'evaluations'   : reducer.count}
+    # }}} End of run_epic
+
+def run_intakes(params, pipe_table, geometry, keep_axes=False): # {{{
+    '''
+    Evaluates a scheme for every intake of geometry and chooses the optimum schemes, as
+      run_epic() does for every head. The intakes are positions measured on a real
+      river (see dem.py) rather than heads on an idealised catchment, so geometry is as
+      hydro_vector.evaluate_geometry(): arrays of head, penstock_length and area_frac
+      with one value per intake.
+    Returns a dict as run_epic(). Each scheme has intake, the index of its intake in
+      geometry, and max_H is the largest head.
+    '''
+    import numpy as np
+    from pipes import get_pipe_catalogue
+    from reducer import SchemeReducer
+    from hydro_vector import evaluate_geometry
+
+    pipe_table = get_pipe_catalogue(pipe_table)
+    n = len(geometry['head'])
+    geometry = dict(geometry)
+    geometry['intake'] = np.arange(n)
+    reducer = SchemeReducer(getattr(params, 'top', 1) or 1)
+    axes = dict((name, []) for name in AXES)
+
+    chunk = max(1, RUN_CHUNK_ELEMENTS // max(1, len(pipe_table) * len(pipe_table.materials)))
+    for start in range(0, n, chunk):
+        part = dict((key, np.asarray(values)[start:start + chunk])
+                    for (key, values) in geometry.items())
+        with np.errstate(divide='ignore', invalid='ignore'):
+            results = evaluate_geometry(part, pipe_table, params)
+        reducer.add_results(results)
+        if keep_axes:
+            for name in AXES: axes[name].extend(results[name].tolist())
+
+    return {'max_H'         : float(np.max(geometry['head'])) if n else 0.0,
+            'schemes'       : reducer.schemes(),
+            'top'           : dict((f[0], reducer.top(f[0])) for f in reducer.factors),
+            'head_schemes'  : [],
+            'axes'          : axes,
+            'diameters_skipped' : 0,
+            'evaluations'   : reducer.count}
+    # }}} End of run_intakes
+
+# The optimum schemes in the order they are written by the json and csv formats
+RESULT_SCHEMES = [('Optimum Capacity',          'capacity'),
+                  ('Optimum Revenue',           'annual_revenue'),
+                  ('Optimum ROI',               'annual_roi'),
+                  ('Optimum Payback Period',    'payback_period'),
+                  ('Optimum Cost/kW',           'cost_per_kw')]
+
+RESULT_FIELDS = ['head', 'material', 'diameter', 'capacity', 'annual_revenue',
+                 'project_cost', 'payback_period', 'cost_per_kw', 'annual_roi']
+
+def get_result_rows(results): # {{{
+    '''
+    Returns (scheme name, scheme) for each optimum scheme and user specified head.
+    Where more than the optimum was kept (--top) the runners up follow each optimum,
+      named with their rank.
+    '''
+    rows = []
+    for (name, key) in RESULT_SCHEMES:
+        rows.append((name, results['schemes'][key]))
+        for (rank, scheme) in enumerate(results.get('top', {}).get(key, [])[1:]):
+            rows.append(('%s #%d' % (name, rank + 2), scheme))
+    rows += [('User Specified', scheme) for scheme in results['head_schemes']]
+    return rows
+    # }}} End of get_result_rows
+
+def get_json_scheme(scheme): # {{{
+    '''
+    Returns a copy of a scheme which can be written as JSON. JSON has no infinity or
+      NaN, so they become null.
+    '''
+    clean = {}
+    for (key, value) in scheme.items():
+        if isinstance(value, float) and (isinf(value) or isnan(value)): value = None
+        clean[key] = value
+    return clean
+    # }}} End of get_json_scheme
 
-else:
-    heads = range(1, int(ceil(max_H)))
-
-# Initialise plot axis {{{
-x_axis = []
-penstock_length_y_axis = []
-avg_flow_rate_y_axis = []
-design_flow_y_axis = []
-fit_y_axis = []
-capacity_y_axis = []
-total_penstock_cost_y_axis = []
-total_project_cost_y_axis = []
-annual_revenue_y_axis = []
-payback_period_y_axis = []
-cost_per_kw_y_axis = []
-annual_roi_y_axis = []
-# }}} End of Initialise plot axis
-
-for h in heads: ### for each head {{{
-    if opts.v: print 'Head = %d' % h
-    x_axis.append(h)
-    
-    # penstock_length {{{
-    penstock_length = float(h) / sin(rad(opts.slope))
-    penstock_length_y_axis.append(penstock_length)
-    Hz = float(h) / tan(rad(opts.slope))
-    # }}} penstock_length
-    
-    # Flow rate {{{
-    area_frac = get_area(opts.catch_type, opts.cl, Hz, opts.v)
-    avail_ca = opts.ca * area_frac
-    
-    # Now that the area of the catchment area has been calculated
-    # catchment_vol is the annual total volume of precipitation which enters the catchment.
-    catchment_vol = avail_ca * ((opts.aar - opts.aae) / 1000) # Divide by 1000 to put mm into meters
-    avg_flow_rate = catchment_vol / (365 * 24 * 60 * 60) # In cumecs
-    if opts.v: print '\tAverage flow rate = %(flow)s' % {'flow': avg_flow_rate}
-    avg_flow_rate_y_axis.append(avg_flow_rate)
-    # }}} Flow rate
-    
-    # Design flow {{{
-    design_flow = avg_flow_rate * flow_duration_curve[opts.fdc_index]
-    if opts.v: print '\tDesign flow = %(flow)s' % {'flow': design_flow}
-    design_flow_y_axis.append(design_flow)
-    # }}} End of Design flow
-
-    # FIT {{{
-    # The Hydro Estimation Parameter (HEP) is just a number used to quickly estimate the
-    #   installed power capacity in kW.
-    # It comes from a combination of G(9.81) and an efficiency of around 82%.
-    capacity_estimate = design_flow * h * HEP
-    if capacity_estimate <= 100: FIT = GTHigh
-    else: FIT = GTLow
-    fit_y_axis.append(FIT)
-    # }}} FIT
-    
-    # Get optimum pipe {{{
-    pipe = get_optimum_pipe_for_head(head            = h,
-                                     pipe_table      = pipe_table,
-                                     design_flow     = design_flow,
-                                     penstock_length = penstock_length,
-                                     FIT             = FIT,
-                                     efficiency      = opts.efficiency,
-                                     market_price    = opts.market_price, 
-                                     interest        = opts.interest,
-                                     verbose         = False)
-    if opts.v: print '\tOptimum pipe for this head = ', pipe
-    # }}} End of Get optimum pipe
-    
-    # capacity {{{
-    capacity = get_scheme_capacity(head = h,
-                                   head_loss = pipe['head_loss'],
-                                   Q = design_flow,
-                                   efficiency = opts.efficiency)
-    if opts.v: print '\tCapacity = %f' % capacity
-    capacity_y_axis.append(capacity)
-    #if capacity < 15: continue # 15kW is the minimum threshold for a small hydroscheme (rather than a pico,
-                               #   which has different equations relating to cost, and methodologies associated).
-    # }}} End of capacity
-    
-    # Total project cost {{{
-    # Capital expenditure of penstock
-    total_penstock_cost = pipe['annual_capital_cost'] / opts.interest
-    if opts.v: print '\tTotal Penstock cost = %f' % total_penstock_cost
-    total_penstock_cost_y_axis.append(total_penstock_cost)
-    
-    # The total project cost has quite a predicable breakdown for hydro schemes.
-    # Therefore the rough fraction is stored as a constant.
-    total_project_cost = total_penstock_cost / PenFrac
-    if opts.v: print '\tTotal Project Cost = %f' % total_project_cost
-    total_project_cost_y_axis.append(total_project_cost)
-    # }}} End of Total project cost
-    
-    # Annual Revenue {{{
-    annual_revenue = get_scheme_annual_revenue(C = capacity,
-                                               FIT = FIT,
-                                               P = opts.market_price,
-                                               R = opts.reliability,
-                                               interest = opts.interest,
-                                               total = total_project_cost)
-    
-    if opts.v: print '\tScheme Annual Revenue = %f' % annual_revenue
-    annual_revenue_y_axis.append(annual_revenue)
-    # }}} Annual Revenue
-
-    # Payback period {{{
-    # The payback period, cost/kW and return are the main economic factors of a scheme.
-    payback_period = total_project_cost / annual_revenue
-    if opts.v: print '\tScheme Payback Period = %f' % payback_period
-    payback_period_y_axis.append(payback_period)
-    # }}} Payback period
-    
-    # Cost/kW {{{
-    cost_per_kw = total_project_cost / capacity
-    if opts.v: print '\tScheme Cost/kW = %f' % cost_per_kw
-    cost_per_kw_y_axis.append(cost_per_kw)
-    # }}} Cost/kW
-
-    # Annual RIO {{{
-    annual_return_on_investment = annual_revenue / total_project_cost * 100
-    if opts.v: print '\tScheme annual ROI = %f' % annual_return_on_investment 
-    annual_roi_y_axis.append(annual_return_on_investment)
-    # }}} Annual RIO
-    
-    # Now we have all the desired economic factors we can choose the optimum scheme
-    #   for each.
-    if cost_per_kw < scheme_cost_per_kw['cost_per_kw']: # {{{
-        scheme_cost_per_kw['diameter']          = pipe['diameter']
-        scheme_cost_per_kw['material']          = pipe['material']
-        scheme_cost_per_kw['head']              = h
-        scheme_cost_per_kw['capacity']          = capacity
-        scheme_cost_per_kw['project_cost']      = total_project_cost
-        scheme_cost_per_kw['cost_per_kw']       = cost_per_kw
-        scheme_cost_per_kw['payback_period']    = payback_period
-        scheme_cost_per_kw['annual_roi']        = annual_return_on_investment
-        scheme_cost_per_kw['annual_revenue']    = annual_revenue
-        # }}} End of Cost/kW
-    
-    if payback_period > 0 and payback_period < scheme_payback_period['payback_period']: # {{{
-        scheme_payback_period['diameter']       = pipe['diameter']
-        scheme_payback_period['material']       = pipe['material']
-        scheme_payback_period['head']           = h
-        scheme_payback_period['capacity']       = capacity
-        scheme_payback_period['project_cost']   = total_project_cost
-        scheme_payback_period['cost_per_kw']    = cost_per_kw
-        scheme_payback_period['payback_period'] = payback_period
-        scheme_payback_period['annual_roi']     = annual_return_on_investment
-        scheme_payback_period['annual_revenue'] = annual_revenue
-        # }}} End of Payback Period
-    
-    if annual_return_on_investment > scheme_annual_roi['annual_roi']: # {{{
-        scheme_annual_roi['diameter']           = pipe['diameter']
-        scheme_annual_roi['material']           = pipe['material']
-        scheme_annual_roi['head']               = h
-        scheme_annual_roi['capacity']           = capacity
-        scheme_annual_roi['project_cost']       = total_project_cost
-        scheme_annual_roi['cost_per_kw']        = cost_per_kw
-        scheme_annual_roi['payback_period']     = payback_period
-        scheme_annual_roi['annual_roi']         = annual_return_on_investment
-        scheme_annual_roi['annual_revenue']     = annual_revenue
-        # }}} End of Annual ROI
-    
-    if annual_revenue > scheme_annual_revenue['annual_revenue']: # {{{
-        scheme_annual_revenue['diameter']       = pipe['diameter']
-        scheme_annual_revenue['material']       = pipe['material']
-        scheme_annual_revenue['head']           = h
-        scheme_annual_revenue['capacity']       = capacity
-        scheme_annual_revenue['project_cost']   = total_project_cost
-        scheme_annual_revenue['cost_per_kw']    = cost_per_kw
-        scheme_annual_revenue['payback_period'] = payback_period
-        scheme_annual_revenue['annual_roi']     = annual_return_on_investment
-        scheme_annual_revenue['annual_revenue'] = annual_revenue
-        # }}} End of Annual Revenue
-    
-    if capacity > scheme_capacity['capacity']: # {{{
-        scheme_capacity['diameter']       = pipe['diameter']
-        scheme_capacity['material']       = pipe['material']
-        scheme_capacity['head']           = h
-        scheme_capacity['capacity']       = capacity
-        scheme_capacity['project_cost']   = total_project_cost
-        scheme_capacity['cost_per_kw']    = cost_per_kw
-        scheme_capacity['payback_period'] = payback_period
-        scheme_capacity['annual_roi']     = annual_return_on_investment
-        scheme_capacity['annual_revenue'] = annual_revenue
-        # }}} End of Capacity
-    
-    if opts.heads:
-        head_scheme = {'diameter'       :   pipe['diameter'],
-                       'material'       :   pipe['material'],
-                       'head'           :   h,
-                       'capacity'       :   capacity,
-                       'project_cost'   :   total_project_cost,
-                       'cost_per_kw'    :   cost_per_kw,
-                       'payback_period' :   payback_period,
-                       'annual_roi'     :   annual_return_on_investment,
-                       'annual_revenue' :   annual_revenue}
-        head_schemes.append(head_scheme)
-
-### }}} End of for each head loop
-
-# Print results {{{
-# Now we have finished the calculations we can print the results in a table
-results = PrettyTable(['Scheme',
-                       'Head (m)',
-                       'Mat',
-                       'Diam (m)',
-                       'Cap (kW)',
-                       'Rev/Yr (GBP)',
-                       'Proj Cost (GBP)',
-                       'Payback Period (Yr)',
-                       'Cost/kW (GBP/kW)'])
-
-results.add_row(['Optimum Capacity',
-                 scheme_capacity['head'],
-                 scheme_capacity['material'],
-                 '%.02f' % scheme_capacity['diameter'],
-                 '%.02f' % scheme_capacity['capacity'],
-                 '%.02f' % scheme_capacity['annual_revenue'],
-                 '%.02f' % scheme_capacity['project_cost'],
-                 '%.02f' % scheme_capacity['payback_period'],
-                 '%.02f' % scheme_capacity['cost_per_kw']])
-
-results.add_row(['Optimum Revenue',
-                 scheme_annual_revenue['head'],
-                 scheme_annual_revenue['material'],
-                 '%.02f' % scheme_annual_revenue['diameter'],
-                 '%.02f' % scheme_annual_revenue['capacity'],
-                 '%.02f' % scheme_annual_revenue['annual_revenue'],
-                 '%.02f' % scheme_annual_revenue['project_cost'],
-                 '%.02f' % scheme_annual_revenue['payback_period'],
-                 '%.02f' % scheme_annual_revenue['cost_per_kw']])
-if opts.heads:
-    for scheme in head_schemes:
-        results.add_row(['User Specified',
+def get_results_document(results, params): # {{{
+    '''
+    Returns the optimum schemes from run_epic() as a dict which can be written as JSON.
+    '''
+    document = {'pipe_file'     : params.pipe_file,
+                'max_H'         : results['max_H'],
+                'schemes'       : dict((key, get_json_scheme(results['schemes'][key]))
+                                       for (name, key) in RESULT_SCHEMES),
+                'head_schemes'  : [get_json_scheme(scheme) for scheme in results['head_schemes']]}
+    if getattr(params, 'top', 1) > 1:
+        document['top'] = dict((key, [get_json_scheme(scheme) for scheme in results['top'][key]])
+                               for (name, key) in RESULT_SCHEMES)
+    return document
+    # }}} End of get_results_document
+
+def write_results_json(results, params, out=sys.stdout): # {{{
+    '''
+    Writes the optimum schemes from run_epic() as a JSON object.
+    '''
+    import json
+    json.dump(get_results_document(results, params), out, sort_keys=True)
+    out.write('\n')
+    # }}} End of write_results_json
+
+def write_results_csv(results, params, out=sys.stdout): # {{{
+    '''
+    Writes the optimum schemes from run_epic() as CSV, one row per scheme.
+    '''
+    import csv
+    writer = csv.writer(out)
+    writer.writerow(['scheme'] + RESULT_FIELDS)
+    for (name, scheme) in get_result_rows(results):
+        writer.writerow([name] + [repr(scheme[k]) if isinstance(scheme[k], float) else scheme[k]
+                                  for k in RESULT_FIELDS])
+    # }}} End of write_results_csv
+
+def print_results(results, params): # {{{
+    '''
+    Prints the optimum schemes from run_epic() in a table, or as json or csv when
+      params.format says so.
+    '''
+    if params.format == 'json': return write_results_json(results, params)
+    if params.format == 'csv':  return write_results_csv(results, params)
+
+    from prettytable import PrettyTable
+
+    # The table only has the capacity and revenue optimums and the user specified heads
+    rows = [(name, scheme) for (name, scheme) in get_result_rows(results)
+            if name.startswith('Optimum Capacity') or name.startswith('Optimum Revenue') or
+               (name == 'User Specified' and params.heads)]
+
+    # Now we have finished the calculations we can print the results in a table
+    results = PrettyTable(['Scheme',
+                           'Head (m)',
+                           'Mat',
+                           'Diam (m)',
+                           'Cap (kW)',
+                           'Rev/Yr (GBP)',
+                           'Proj Cost (GBP)',
+                           'Payback Period (Yr)',
+                           'Cost/kW (GBP/kW)'])
+
+    for (name, scheme) in rows:
+        results.add_row([name,
                          scheme['head'],
                          scheme['material'],
                          '%.02f' % scheme['diameter'],
@@ -434,238 +709,443 @@ if opts.heads:
                          '%.02f' % scheme['payback_period'],
                          '%.02f' % scheme['cost_per_kw']])
 
-print 'Input file: ', opts.pipe_file
-print results
-# }}} End of Print results
-
-# Plot results {{{
-# Name the files correctly so I can find them easily
-datestring = '_' + datetime.datetime.now().strftime('%Y%m%d-%H%M')
-if opts.heads:
-    typestring = '_discrete'
-else:
-    typestring = '_continuous'
-
-# Now make the plots
-if plots.count('penstock_length'): # {{{
-# TODO Make penstock_length look pretty
-    f_penstock_length = p.figure()
-    p_penstock_length = f_penstock_length.add_subplot(111)
-    
-    if opts.heads: p_penstock_length.plot(x_axis, penstock_length_y_axis, 'bo')
-    else:          p_penstock_length.plot(x_axis, penstock_length_y_axis, '-')
-    
-    p_capacity.set_title('Capacity')
-    p_capacity.set_ylabel('Capacity (kW)')
-    p_capacity.set_xlabel('Head (m)')
-    
-    p_penstock_length.axis([min(x_axis) - 5, max(x_axis) + 5,
-                     min(penstock_length_y_axis) - 5, max(penstock_length_y_axis) * 1.05])
-    
-    # finally save the plot
-    penstock_length_filename = 'plots/penstock_length' + typestring + datestring
-    f_penstock_length.savefig(penstock_length_filename)
-# }}} End of penstock_length
-
-if plots.count('avg_flow_rate'): # {{{
-# TODO Make avg_flow_rate look pretty
-    f_avg_flow_rate = p.figure()
-    p_avg_flow_rate = f_avg_flow_rate.add_subplot(111)
-    
-    if opts.heads: p_avg_flow_rate.plot(x_axis, avg_flow_rate_y_axis, 'bo')
-    else:          p_avg_flow_rate.plot(x_axis, avg_flow_rate_y_axis, '-')
-    
-    p_capacity.set_title('Capacity')
-    p_capacity.set_ylabel('Capacity (kW)')
-    p_capacity.set_xlabel('Head (m)')
-    
-    p_avg_flow_rate.axis([min(x_axis) - 5, max(x_axis) + 5,
-                     min(avg_flow_rate_y_axis) - 5, max(avg_flow_rate_y_axis) * 1.05])
-    
-    # finally save the plot
-    avg_flow_rate_filename = 'plots/avg_flow_rate' + typestring + datestring
-    f_avg_flow_rate.savefig(avg_flow_rate_filename)
-# }}} End of avg_flow_rate
-
-if plots.count('design_flow'): # {{{
-# TODO Make design_flow look pretty
-    f_design_flow = p.figure()
-    p_design_flow = f_design_flow.add_subplot(111)
-    
-    if opts.heads: p_design_flow.plot(x_axis, design_flow_y_axis, 'bo')
-    else:          p_design_flow.plot(x_axis, design_flow_y_axis, '-')
-    
-    p_capacity.set_title('Capacity')
-    p_capacity.set_ylabel('Capacity (kW)')
-    p_capacity.set_xlabel('Head (m)')
-    
-    p_design_flow.axis([min(x_axis) - 5, max(x_axis) + 5,
-                     min(design_flow_y_axis) - 5, max(design_flow_y_axis) * 1.05])
-    
-    # finally save the plot
-    design_flow_filename = 'plots/design_flow' + typestring + datestring
-    f_design_flow.savefig(design_flow_filename)
-# }}} End of design_flow
-
-if plots.count('fit'): # {{{
-# TODO Make fit look pretty
-    f_fit = p.figure()
-    p_fit = f_fit.add_subplot(111)
-    
-    if opts.heads: p_fit.plot(x_axis, fit_y_axis, 'bo')
-    else:          p_fit.plot(x_axis, fit_y_axis, '-')
-    
-    p_capacity.set_title('Capacity')
-    p_capacity.set_ylabel('Capacity (kW)')
-    p_capacity.set_xlabel('Head (m)')
-    
-    p_fit.axis([min(x_axis) - 5, max(x_axis) + 5,
-                     min(fit_y_axis) - 5, max(fit_y_axis) * 1.05])
-    
-    # finally save the plot
-    fit_filename = 'plots/fit' + typestring + datestring
-    f_fit.savefig(fit_filename)
-# }}} End of fit
-
-if plots.count('capacity'): # {{{
-# TODO Make capacity look pretty
-    f_capacity = p.figure()
-    p_capacity = f_capacity.add_subplot(111)
-    
-    if opts.heads: p_capacity.plot(x_axis, capacity_y_axis, 'bo')
-    else:          p_capacity.plot(x_axis, capacity_y_axis, '-')
-    
-    p_capacity.set_title('Capacity')
-    p_capacity.set_ylabel('Capacity (kW)')
-    p_capacity.set_xlabel('Head (m)')
-    
-    p_capacity.axis([min(x_axis) - 5, max(x_axis) + 5,
-                     min(capacity_y_axis) - 5, max(capacity_y_axis) * 1.05])
-    
-    # finally save the plot
-    capacity_filename = 'plots/capacity' + typestring + datestring
-    f_capacity.savefig(capacity_filename)
-# }}} End of capacity
-
-if plots.count('total_penstock_cost'): # {{{
-# TODO Make total_penstock_cost look pretty
-    f_total_penstock_cost = p.figure()
-    p_total_penstock_cost = f_total_penstock_cost.add_subplot(111)
-    
-    if opts.heads: p_total_penstock_cost.plot(x_axis, total_penstock_cost_y_axis, 'bo')
-    else:          p_total_penstock_cost.plot(x_axis, total_penstock_cost_y_axis, '-')
-    
-    p_total_penstock_cost.set_title('Total_penstock_cost')
-    p_total_penstock_cost.set_ylabel('Total_penstock_cost (GBP)')
-    p_total_penstock_cost.set_xlabel('Head (m)')
-    
-    p_total_penstock_cost.axis([min(x_axis) - 5, max(x_axis) + 5,
-                     min(total_penstock_cost_y_axis) - 5, max(total_penstock_cost_y_axis) * 1.05])
-    
-    # finally save the plot
-    total_penstock_cost_filename = 'plots/total_penstock_cost' + typestring + datestring
-    f_total_penstock_cost.savefig(total_penstock_cost_filename)
-# }}} End of total_penstock_cost
-
-if plots.count('total_project_cost'): # {{{
-# TODO Make total_project_cost look pretty
-    f_total_project_cost = p.figure()
-    p_total_project_cost = f_total_project_cost.add_subplot(111)
-    
-    if opts.heads: p_total_project_cost.plot(x_axis, total_project_cost_y_axis, 'bo')
-    else:          p_total_project_cost.plot(x_axis, total_project_cost_y_axis, '-')
-    
-    p_total_project_cost.set_title('Total_project_cost')
-    p_total_project_cost.set_ylabel('Total_project_cost (GBP)')
-    p_total_project_cost.set_xlabel('Head (m)')
-    
-    p_total_project_cost.axis([min(x_axis) - 5, max(x_axis) + 5,
-                     min(total_project_cost_y_axis) - 5, max(total_project_cost_y_axis) * 1.05])
-    
-    # finally save the plot
-    total_project_cost_filename = 'plots/total_project_cost' + typestring + datestring
-    f_total_project_cost.savefig(total_project_cost_filename)
-# }}} End of total_project_cost
-
-if plots.count('annual_revenue'): # {{{
-# TODO Make annual_revenue look pretty
-    f_annual_revenue = p.figure()
-    p_annual_revenue = f_annual_revenue.add_subplot(111)
-    
-    if opts.heads: p_annual_revenue.plot(x_axis, annual_revenue_y_axis, 'bo')
-    else:          p_annual_revenue.plot(x_axis, annual_revenue_y_axis, '-')
-    
-    p_annual_revenue.set_title('Annual_revenue')
-    p_annual_revenue.set_ylabel('Annual_revenue (GBP)')
-    p_annual_revenue.set_xlabel('Head (m)')
-    
-    p_annual_revenue.axis([min(x_axis) - 5, max(x_axis) + 5,
-                     min(annual_revenue_y_axis) - 5, max(annual_revenue_y_axis) * 1.05])
-    
-    # finally save the plot
-    annual_revenue_filename = 'plots/annual_revenue' + typestring + datestring
-    f_annual_revenue.savefig(annual_revenue_filename)
-# }}} End of annual_revenue
-
-if plots.count('payback_period'): # {{{
-# TODO Make payback_period look pretty
-    f_payback_period = p.figure()
-    p_payback_period = f_payback_period.add_subplot(111)
-    
-    if opts.heads: p_payback_period.plot(x_axis, payback_period_y_axis, 'bo')
-    else:          p_payback_period.plot(x_axis, payback_period_y_axis, '-')
-    
-    p_payback_period.set_title('payback_period')
-    p_payback_period.set_ylabel('payback_period (years)')
-    p_payback_period.set_xlabel('Head (m)')
-    
-    p_payback_period.axis([min(x_axis) - 5, max(x_axis) + 5,
-                     min(payback_period_y_axis) - 5, max(payback_period_y_axis) * 1.05])
-    
-    # finally save the plot
-    payback_period_filename = 'plots/payback_period' + typestring + datestring
-    f_payback_period.savefig(payback_period_filename)
-# }}} End of payback_period
-
-if plots.count('cost_per_kw'): # {{{
-# TODO Make cost_per_kw look pretty
-    f_cost_per_kw = p.figure()
-    p_cost_per_kw = f_cost_per_kw.add_subplot(111)
-    
-    if opts.heads: p_cost_per_kw.plot(x_axis, cost_per_kw_y_axis, 'bo')
-    else:          p_cost_per_kw.plot(x_axis, cost_per_kw_y_axis, '-')
-    
-    p_cost_per_kw.set_title('Cost_per_kw')
-    p_cost_per_kw.set_ylabel('Cost_per_kw (GBP/kW)')
-    p_cost_per_kw.set_xlabel('Head (m)')
-    
-    p_cost_per_kw.axis([min(x_axis) - 5, max(x_axis) + 5,
-                     min(cost_per_kw_y_axis) - 5, max(cost_per_kw_y_axis) * 1.05])
-    
-    # finally save the plot
-    cost_per_kw_filename = 'plots/cost_per_kw' + typestring + datestring
-    f_cost_per_kw.savefig(cost_per_kw_filename)
-# }}} End of cost_per_kw
-
-if plots.count('annual_roi'): # {{{
-# TODO Make annual_roi look pretty
-    f_annual_roi = p.figure()
-    p_annual_roi = f_annual_roi.add_subplot(111)
-    
-    if opts.heads: p_annual_roi.plot(x_axis, annual_roi_y_axis, 'bo')
-    else:          p_annual_roi.plot(x_axis, annual_roi_y_axis, '-')
-    
-    p_annual_roi.set_title('Annual_roi')
-    p_annual_roi.set_ylabel('Annual_roi (%)')
-    p_annual_roi.set_xlabel('Head (m)')
-    
-    p_annual_roi.axis([min(x_axis) - 5, max(x_axis) + 5,
-                     min(annual_roi_y_axis) - 5, max(annual_roi_y_axis) * 1.05])
-    
-    # finally save the plot
-    annual_roi_filename = 'plots/annual_roi' + typestring + datestring
-    f_annual_roi.savefig(annual_roi_filename)
-# }}} End of annual_roi
-
-# }}} End of Plot results
+    print 'Input file: ', params.pipe_file
+    print results
+    # }}} End of print_results
+
+def add_intake_fields(results, values): # {{{
+    '''
+    Adds where the intake is to each scheme of results from run_intakes(). values is a
+      dict of arrays with a value for each intake, the scheme of intake i gets
+      values[key][i] as key.
+    '''
+    for schemes in [results['schemes'].values()] + results['top'].values():
+        for scheme in schemes:
+            if 'intake' not in scheme: continue # No intake beat the initial values
+            for (key, array) in values.items(): scheme[key] = float(array[scheme['intake']])
+    # }}} End of add_intake_fields
+
+def print_intake_results(results, params, fields, document, title, out=None): # {{{
+    '''
+    Writes the optimum schemes from run_intakes() in the format of params.format, all of
+      them with where their intakes are. fields are (key, column title, format function)
+      of the values add_intake_fields() added. document is added to the json, title
+      printed above the table.
+    '''
+    if out is None: out = sys.stdout
+    rows = [(name, results['schemes'][key]) for (name, key) in RESULT_SCHEMES]
+    keys = RESULT_FIELDS + [key for (key, name, show) in fields]
+
+    if params.format == 'json':
+        import json
+        full = get_results_document(results, params)
+        full.update(document)
+        json.dump(full, out, sort_keys=True)
+        out.write('\n')
+
+    elif params.format == 'csv':
+        import csv
+        writer = csv.writer(out)
+        writer.writerow(['scheme'] + keys)
+        for (name, scheme) in rows:
+            writer.writerow([name] + [repr(scheme[k]) if isinstance(scheme.get(k), float)
+                                      else scheme.get(k, '') for k in keys])
+
+    else:
+        from prettytable import PrettyTable
+        table = PrettyTable(['Scheme', 'Head (m)'] + [name for (key, name, show) in fields] +
+                            ['Mat', 'Diam (m)', 'Cap (kW)', 'Rev/Yr (GBP)', 'Proj Cost (GBP)',
+                             'Payback Period (Yr)', 'Cost/kW (GBP/kW)'])
+        for (name, scheme) in rows:
+            where = [show(scheme[key]) if key in scheme else '' for (key, column, show) in fields]
+            table.add_row([name, '%.01f' % scheme['head']] + where + [scheme['material']] +
+                          ['%.02f' % scheme[k] for k in ['diameter', 'capacity', 'annual_revenue',
+                                                         'project_cost', 'payback_period',
+                                                         'cost_per_kw']])
+        print >>out, 'Input file: ', params.pipe_file
+        print >>out, title
+        print >>out, table
+    # }}} End of print_intake_results
+
+def make_plots(results, params): # {{{
+    '''
+    Saves the plots named in params.plots into the plots directory, see plotting.py.
+    Returns [(name, filename, seconds)] for every plot.
+    Raises ValueError for a plot which does not exist.
+    '''
+    import plotting
+    jobs = plotting.get_plot_jobs(results['axes'], params.plots, bool(params.heads),
+                                  getattr(params, 'plot_points', plotting.PLOT_POINTS))
+    return plotting.render_plots(jobs, getattr(params, 'plot_layout', 'separate'),
+                                 getattr(params, 'processes', None))
+    # }}} End of make_plots
+
+def run_epic_cached(opts, pipe_table, output=None): # {{{
+    '''
+    run_epic() through the result cache, see result_cache.py. The cache is skipped for
+      --no_cache, for --verbose and --output, which need every head to be worked out,
+      and for --profile and --profile_dump, which would otherwise time a cache read.
+    '''
+    if opts.no_cache or opts.v or output or \
+       opts.profile or opts.profile_dump:
+        return run_epic(opts, pipe_table, output=output)
+
+    import result_cache
+    keep_axes = bool(opts.plots)
+    cache = result_cache.ResultCache(max_bytes=int(opts.cache_size * 1024 * 1024))
+    key = result_cache.get_result_key(opts, pipe_table, keep_axes)
+    results = cache.get(key)
+    if results is None:
+        results = run_epic(opts, pipe_table, keep_axes)
+        cache.put(key, results)
+    return results
+    # }}} End of run_epic_cached
+
+def main(argv=None): # {{{
+    '''
+    The EPIC.py command line: parse the options, run EPIC, print and plot the results.
+    '''
+    if argv is None: argv = sys.argv[1:]
+    parser = get_option_parser()
+    (opts, args) = parser.parse_args(argv)
+    check_mode_options(parser, opts)
+
+    if not (opts.profile or opts.profile_dump):
+        import profiling
+        return main_run(opts, argv, profiling.NoProfiler())
+    main_profile(opts, argv)
+    # }}} End of main
+
+def main_profile(opts, argv): # {{{
+    '''
+    The --profile command line, the run is timed stage by stage and the report written
+      when it ends, even if it fails.
+    '''
+    import profiling
+    profiler = profiling.Profiler(opts.profile_dump)
+    profiler.start()
+    try:
+        main_run(opts, argv, profiler)
+    finally:
+        profiler.stop()
+        if opts.profile:
+            profiler.write_report(opts.profile)
+            if opts.format == 'table': print 'Profile: %s' % opts.profile
+    # }}} End of main_profile
+
+def main_run(opts, argv, profiler): # {{{
+    '''
+    Runs the command line options of main(), timing its stages with profiler.
+    '''
+    if opts.clear_cache:
+        import result_cache
+        removed = result_cache.ResultCache().clear()
+        if opts.format == 'table': print 'Removed %d cached results' % removed
+        if opts.ca is None and not opts.batch: return # Only asked to clear the cache
+
+    if opts.batch:
+        with profiler.stage('batch'): main_batch(opts)
+        return
+
+    if opts.serve:
+        import serve
+        serve.serve(opts, opts.host, opts.port, opts.processes, opts.queue)
+        return
+
+    opts = normalise_params(opts)
+
+    # Get Pipe Table
+    try:
+        with profiler.stage('read_pipe_table'):
+            pipe_table = read_pipe_table(opts.pipe_file)
+    except ValueError, e:
+        print 'Error in pipe file: %s. Exiting' % e
+        sys.exit(1)
+    except:
+        print 'Something went wrong with pipe file.'
+        sys.exit(1)
+
+    if opts.monte_carlo:
+        with profiler.stage('monte_carlo'): main_monte_carlo(opts, pipe_table)
+        return
+
+    if opts.sweep:
+        with profiler.stage('sweep'): main_sweep(opts, pipe_table)
+        return
+
+    if opts.head_search:
+        with profiler.stage('head_search'): main_head_search(opts, pipe_table)
+        return
+
+    if opts.fdc_sweep:
+        with profiler.stage('fdc_sweep'): main_fdc_sweep(opts, pipe_table)
+        return
+
+    if opts.interactive:
+        with profiler.stage('interactive'): main_interactive(opts, pipe_table, argv)
+        return
+
+    if opts.dem:
+        with profiler.stage('dem'): main_dem(opts, pipe_table)
+        return
+
+    if opts.long_profile:
+        with profiler.stage('long_profile'): main_long_profile(opts, pipe_table)
+        return
+
+    if opts.pareto:
+        with profiler.stage('pareto'): main_pareto(opts, pipe_table)
+        return
+
+    output = None
+    try:
+        if opts.plots:
+            import plotting
+            plotting.get_plot_names(opts.plots) # Check them before the run, not after
+        if opts.output:
+            import export
+            output = export.open_head_writer(opts.output, pipe_table.materials, opts.output_format)
+        with profiler.stage('run_epic'):
+            results = run_epic_cached(opts, pipe_table, output)
+    except (ValueError, IOError, OSError), e:
+        print 'Error: %s. Exiting' % e
+        sys.exit(1)
+    finally:
+        if output: output.close()
+
+    with profiler.stage('print_results'):
+        print_results(results, opts)
+    if opts.pipe_search == 'bound' and opts.format == 'table':
+        print 'Diameters skipped: %d of %d' % (results['diameters_skipped'],
+                                               len(pipe_table) * results['evaluations'])
+    if opts.plots:
+        try:
+            with profiler.stage('plots'):
+                timings = make_plots(results, opts)
+        except (ValueError, IOError, OSError), e:
+            print 'Error: %s. Exiting' % e
+            sys.exit(1)
+        if opts.format == 'table':
+            for (name, filename, seconds) in timings:
+                print 'Plot %s: %.2fs (%s)' % (name, seconds, filename)
+    # }}} End of main_run
+
+def main_monte_carlo(opts, pipe_table): # {{{
+    '''
+    The --monte_carlo command line.
+    '''
+    import monte_carlo
+    try:
+        uncertain = monte_carlo.parse_uncertain(opts.uncertain)
+        results = monte_carlo.run_monte_carlo(opts, pipe_table, uncertain,
+                                              opts.monte_carlo, opts.seed)
+    except ValueError, e:
+        print 'Error: %s. Exiting' % e
+        sys.exit(1)
+    monte_carlo.print_monte_carlo(results, opts)
+    # }}} End of main_monte_carlo
+
+def main_sweep(opts, pipe_table): # {{{
+    '''
+    The --sweep command line.
+    '''
+    import sweep
+    try:
+        grid = sweep.parse_sweep(opts.sweep, opts)
+        results = sweep.run_sweep(opts, pipe_table, grid)
+    except ValueError, e:
+        print 'Error: %s. Exiting' % e
+        sys.exit(1)
+    sweep.print_sweep(results, opts)
+    # }}} End of main_sweep
+
+def main_fdc_sweep(opts, pipe_table): # {{{
+    '''
+    The --fdc_sweep command line.
+    '''
+    import fdc_sweep
+    try:
+        if opts.plots:
+            import plotting
+            plotting.get_plot_names(opts.plots) # Check them before the run, not after
+        results = fdc_sweep.run_fdc_sweep(opts, pipe_table)
+    except ValueError, e:
+        print 'Error: %s. Exiting' % e
+        sys.exit(1)
+    fdc_sweep.print_fdc_sweep(results, opts)
+
+    if opts.plots:
+        # Mark the joint optimum on the heatmap of its own factor
+        optimums = dict((key, (scheme['fdc_index'], scheme['head']))
+                        for (key, scheme) in results['schemes'].items() if scheme['fdc_index'])
+        jobs = plotting.get_heatmap_jobs(results['matrices'], results['heads'], opts.plots, optimums)
+        try:
+            timings = plotting.render_plots(jobs, processes=opts.processes,
+                                            render=plotting.render_heatmap)
+        except (IOError, OSError), e:
+            print 'Error: %s. Exiting' % e
+            sys.exit(1)
+        if opts.format == 'table':
+            for (name, filename, seconds) in timings:
+                print 'Plot %s: %.2fs (%s)' % (name, seconds, filename)
+    # }}} End of main_fdc_sweep
+
+def main_dem(opts, pipe_table): # {{{
+    '''
+    The --dem command line.
+    '''
+    import dem
+    try:
+        grid = dem.read_dem(opts.dem)
+        (results, channel) = dem.run_dem(opts, pipe_table, grid)
+    except (ValueError, IOError, OSError), e:
+        print 'Error: %s. Exiting' % e
+        sys.exit(1)
+    dem.print_dem(results, channel, opts)
+    # }}} End of main_dem
+
+def main_long_profile(opts, pipe_table): # {{{
+    '''
+    The --long_profile command line.
+    '''
+    import long_profile
+    try:
+        (chainage, elevation) = long_profile.read_long_profile(opts.long_profile)
+        (results, profile) = long_profile.run_long_profile(opts, pipe_table, chainage, elevation)
+    except (ValueError, IOError), e:
+        print 'Error: %s. Exiting' % e
+        sys.exit(1)
+    long_profile.print_long_profile(results, profile, opts)
+    # }}} End of main_long_profile
+
+def main_pareto(opts, pipe_table): # {{{
+    '''
+    The --pareto command line. Every head can also be written out with --output.
+    '''
+    import pareto
+    output = None
+    try:
+        objectives = pareto.parse_objectives(opts.pareto)
+        if opts.output:
+            import export
+            output = export.open_head_writer(opts.output, pipe_table.materials, opts.output_format)
+        results = pareto.run_pareto(opts, pipe_table, objectives, output)
+    except (ValueError, IOError, OSError), e:
+        print 'Error: %s. Exiting' % e
+        sys.exit(1)
+    finally:
+        if output: output.close()
+    pareto.print_pareto(results, opts)
+
+    if opts.pareto_plot:
+        import plotting
+        labels = dict((key, label) for (key, column, label) in pareto.PARETO_OBJECTIVES)
+        jobs = plotting.get_pareto_jobs(results['front'], [(key, labels[key]) for key in objectives])
+        try:
+            timings = plotting.render_plots(jobs, processes=opts.processes,
+                                            render=plotting.render_pareto)
+        except (IOError, OSError), e:
+            print 'Error: %s. Exiting' % e
+            sys.exit(1)
+        if opts.format == 'table':
+            for (name, filename, seconds) in timings:
+                print 'Plot %s: %.2fs (%s)' % (name, seconds, filename)
+    # }}} End of main_pareto
+
+def main_head_search(opts, pipe_table): # {{{
+    '''
+    The --head_search command line. There are no per head axes, so no plots.
+    '''
+    import head_search
+    try:
+        results = head_search.run_head_search(opts, pipe_table, opts.head_tolerance)
+    except ValueError, e:
+        print 'Error: %s. Exiting' % e
+        sys.exit(1)
+    if opts.format == 'table':
+        # The heads found are not whole meters, so they are shown to two places
+        for scheme in results['schemes'].values(): scheme['head'] = '%.02f' % scheme['head']
+    print_results(results, opts)
+    if opts.format == 'table': print 'Heads evaluated: ', results['evaluations']
+    # }}} End of main_head_search
+
+def get_interactive_args(line, parser): # {{{
+    '''
+    Returns the command line arguments for a line of option=value pairs of the
+      --interactive mode, with the option names as on the command line.
+    Raises ValueError for a pair which cannot be understood.
+    '''
+    args = []
+    for item in line.split():
+        (option, equals, value) = item.partition('=')
+        option = '--' + option.lstrip('-')
+        if not equals or not parser.has_option(option):
+            raise ValueError('Cannot read %s, use option=value' % item)
+        if option in ['--pipe_file', '--interactive', '--engine', '--pipe_search']:
+            raise ValueError('%s cannot be changed' % option)
+        args += [option, value]
+    return args
+    # }}} End of get_interactive_args
+
+def main_interactive(opts, pipe_table, argv): # {{{
+    '''
+    The --interactive command line. Each line read changes the options given so far,
+      and the results are printed again with the stages which were worked out.
+    '''
+    import stages
+    parser = get_option_parser()
+    pipeline = stages.Pipeline(pipe_table)
+    while True:
+        try:
+            results = pipeline.run(opts)
+        except ValueError, e:
+            print 'Error: %s' % e
+        else:
+            print_results(results, opts)
+            if opts.format == 'table':
+                print 'Stages: %s' % ', '.join('%s %.3fs' % (name, seconds) if worked_out
+                                               else '%s (kept)' % name
+                                               for (name, seconds, worked_out) in pipeline.timings)
+
+        while True:
+            if opts.format == 'table':
+                sys.stdout.write('option=value ... > ')
+                sys.stdout.flush()
+            line = sys.stdin.readline()
+            if not line or line.strip() in ['quit', 'exit']: return
+            try:
+                changed = argv + get_interactive_args(line, parser)
+                # optparse exits on a value it cannot parse, which should not end the session
+                try:
+                    (opts, args) = parse_args(changed)
+                except SystemExit:
+                    raise ValueError('Cannot read %s' % line.strip())
+            except ValueError, e:
+                print 'Error: %s' % e
+                continue
+            argv = changed
+            break
+    # }}} End of main_interactive
+
+def main_batch(opts): # {{{
+    '''
+    The --batch command line, opts are the options before normalise_params().
+    '''
+    import batch
+    try:
+        sites = batch.read_sites(opts.batch, opts)
+    except (IOError, ValueError), e:
+        print 'Something went wrong with sites file: %s' % e
+        sys.exit(1)
+
+    try:
+        pipe_tables = batch.read_pipe_tables(sites)
+    except:
+        print 'Something went wrong with pipe file.'
+        sys.exit(1)
+
+    batch.write_batch(batch.run_batch(sites, pipe_tables, opts.processes), sites, opts)
+    # }}} End of main_batch
 
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,167 @@
+# batch.py
+# This file contains the batch mode of EPIC.py (--batch sites.csv), which evaluates a whole
+# inventory of catchments across a pool of processes.
+#
+# The sites file has a header line naming the command line options without their
+# leading dashes, then one catchment per line, e.g.
+#   site,catchment_area,catchment_type,catchment_length,slope,precipitation
+#   Glen A,15000000,4,3000,10,1600
+# Options which are not columns of the file are taken from the command line, so
+# values shared by every site (--pipe_file, --market_price, ...) are only given once.
+# An optional 'site' column names each catchment, otherwise they are numbered from 1.
+#
+# Each pipe file is read once, in the parent process, and handed to the workers when
+# the pool starts rather than with every site. Results are written in the order of the
+# sites file, as soon as each one and all those before it are finished.
+import sys
+import copy
+import itertools
+import multiprocessing
+
+import EPIC
+
+_pipe_tables = {} # Pipe tables in each worker, keyed by file name
+
+def read_sites(filename, opts, parser=None): # {{{
+    '''
+    Reads the sites file and returns a list of (site name, params) in file order.
+    opts are the command line options before normalise_params(), they supply every
+      value which the sites file does not.
+    '''
+    import csv
+    if parser is None: parser = EPIC.get_option_parser()
+
+    sites_file = open(filename, 'rb')
+    reader = csv.reader(sites_file)
+    header = [column.strip() for column in reader.next()]
+
+    # Match each column to the dest of its command line option
+    dests = []
+    for column in header:
+        if column == 'site':
+            dests.append(None)
+            continue
+        option = parser.get_option('--' + column)
+        if option is None:
+            raise ValueError('Unknown column in sites file: %s' % column)
+        dests.append(option.dest)
+
+    sites = []
+    for (n, row) in enumerate(reader):
+        if not row or not ''.join(row).strip(): continue
+        params = copy.copy(opts)
+        name = str(n + 1)
+        for (column, dest, value) in zip(header, dests, row):
+            value = value.strip()
+            if dest is None: name = value
+            elif value != '': setattr(params, dest, value)
+        sites.append((name, params))
+    sites_file.close()
+
+    return sites
+    # }}} End of read_sites
+
+def _init_worker(pipe_tables): # {{{
+    '''
+    Runs once in each worker of the pool.
+    '''
+    global _pipe_tables
+    _pipe_tables = pipe_tables
+    # }}} End of _init_worker
+
+def evaluate_site(site): # {{{
+    '''
+    Runs EPIC for one (site name, params) from read_sites().
+    Returns (site name, results, error) where results is run_epic() without the
+      per head axes, which are not kept as they would only be thrown away, and error
+      is a message or None.
+    '''
+    (name, params) = site
+    try:
+        params = EPIC.normalise_params(params)
+        results = EPIC.run_epic(params, _pipe_tables[params.pipe_file], keep_axes=False)
+    except (ValueError, TypeError, KeyError), e:
+        return (name, None, str(e) or e.__class__.__name__)
+    except Exception, e:
+        # One catchment the model cannot handle must not end the whole batch
+        return (name, None, '%s: %s' % (e.__class__.__name__, e))
+    del results['axes']
+    return (name, results, None)
+    # }}} End of evaluate_site
+
+def read_pipe_tables(sites): # {{{
+    '''
+    Reads every pipe file used by the sites, once each.
+    Returns a dict of pipe tables keyed by file name.
+    '''
+    pipe_tables = {}
+    for (name, params) in sites:
+        if params.pipe_file and params.pipe_file not in pipe_tables:
+            pipe_tables[params.pipe_file] = EPIC.read_pipe_table(params.pipe_file)
+    return pipe_tables
+    # }}} End of read_pipe_tables
+
+def run_batch(sites, pipe_tables, processes=None): # {{{
+    '''
+    Evaluates every site from read_sites() across a pool of processes.
+    pipe_tables is from read_pipe_tables(), processes defaults to the number of CPUs.
+    Yields (site name, results, error) in the order of sites.
+    '''
+    if processes is None: processes = multiprocessing.cpu_count()
+    if processes <= 1 or len(sites) <= 1:
+        _init_worker(pipe_tables)
+        for site in sites:
+            yield evaluate_site(site)
+        return
+
+    pool = multiprocessing.Pool(processes, _init_worker, (pipe_tables,))
+    try:
+        # Big enough chunks to keep the overhead down, small enough to balance the load
+        chunksize = max(1, len(sites) // (processes * 4))
+        for result in pool.imap(evaluate_site, sites, chunksize):
+            yield result
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+    # }}} End of run_batch
+
+def write_batch(batch, sites, params, out=sys.stdout): # {{{
+    '''
+    Writes the results of run_batch(sites) as they arrive in the format of
+      params.format.
+    '''
+    if params.format == 'json':
+        import json
+        for (name, results, error) in batch:
+            document = {'site': name, 'error': error}
+            if results:
+                document['max_H'] = results['max_H']
+                document['schemes'] = dict((key, EPIC.get_json_scheme(scheme))
+                                           for (key, scheme) in results['schemes'].items())
+                document['head_schemes'] = [EPIC.get_json_scheme(scheme)
+                                            for scheme in results['head_schemes']]
+            json.dump(document, out, sort_keys=True)
+            out.write('\n')
+            out.flush()
+
+    elif params.format == 'csv':
+        import csv
+        writer = csv.writer(out)
+        writer.writerow(['site', 'scheme'] + EPIC.RESULT_FIELDS + ['error'])
+        for (name, results, error) in batch:
+            if error:
+                writer.writerow([name, ''] + [''] * len(EPIC.RESULT_FIELDS) + [error])
+                continue
+            for (scheme_name, scheme) in EPIC.get_result_rows(results):
+                writer.writerow([name, scheme_name] +
+                                [repr(scheme[k]) if isinstance(scheme[k], float) else scheme[k]
+                                 for k in EPIC.RESULT_FIELDS] + [''])
+            out.flush()
+
+    else:
+        for ((name, results, error), (name, site_params)) in itertools.izip(batch, sites):
+            print 'Site: ', name
+            if error: print 'Error: %s' % error
+            else:     EPIC.print_results(results, site_params)
+    # }}} End of write_batch
@@ -0,0 +1,391 @@
+#!/usr/bin/env python
+# bench_hot_paths.py
+# This file is the benchmark suite of EPIC's hot paths. Each case is timed in this
+# interpreter, after one untimed warm up call, as the best of --repeat runs of enough
+# calls to take about MIN_RUN_SECONDS; the time reported is per call. See
+# bench_startup.py for the time EPIC takes to start.
+#
+# Save a baseline before a change, then compare against it after:
+# ./bench_hot_paths.py run --save before.json
+# ./bench_hot_paths.py compare before.json         # runs the suite now
+# ./bench_hot_paths.py compare before.json after.json --threshold 5
+# compare exits with status 1 if any case is more than --threshold percent slower than
+# its baseline, so it can gate a build. Baselines are only comparable on the same machine,
+# compare warns when they were not.
+#
+# ./bench_hot_paths.py check
+# runs each of ENGINE_CHECKS with the vector and the scalar engine and exits with status 1
+# if they do not agree to the tolerance of hydro_vector.py, so a faster vector engine can
+# not quietly give other answers. It also runs --head_search on each of
+# HEAD_SEARCH_CHECKS and fails if any optimum is worse than the integer scan's.
+import os
+import sys
+import json
+import time
+import platform
+from optparse import OptionParser
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+BENCH_VERSION = 1       # Bump this when the cases change what they measure
+MIN_RUN_SECONDS = 0.2   # Calls are repeated until a run takes at least this long
+
+# The example from the epic script, a continuous sweep of every head
+EPIC_ARGS = ['--catchment_type', '4', '--slope', '10', '--catchment_length', '3000',
+             '--flow_duration_curve', '4', '--precipitation', '1600',
+             '--potential_evaporation', '400', '--catchment_area', '15000000',
+             '--pipe_file', os.path.join(HERE, 'pipes_1.csv'), '--reliability', '0.7',
+             '--efficiency', '0.82', '--market_price', '0.03', '--interest', '0.05']
+
+SYNTHETIC_DIAMETERS = 5000
+
+# Changes to EPIC_ARGS which check compares the engines on: the example, the other
+# catchment types, a steep slope where the head loss takes up nearly the whole head of
+# the small catchment, a large catchment and the other pipe file
+ENGINE_CHECKS = [[],
+                 ['--catchment_type', '1'],
+                 ['--catchment_type', '2'],
+                 ['--catchment_type', '3'],
+                 ['--catchment_type', '3', '--slope', '45', '--flow_duration_curve', '1'],
+                 ['--catchment_type', '1', '--catchment_area', '1500000000'],
+                 ['--flow_duration_curve', '20', '--pipe_file', os.path.join(HERE, 'pipes_0.csv')]]
+
+# Changes to EPIC_ARGS which check compares --head_search with the integer scan on: those
+# of ENGINE_CHECKS and sites where a pipe change lies just below a whole metre
+HEAD_SEARCH_CHECKS = ENGINE_CHECKS + \
+                     [['--catchment_type', '1', '--slope', '2', '--catchment_area', '40000000'],
+                      ['--catchment_type', '2', '--slope', '5', '--flow_duration_curve', '16',
+                       '--market_price', '0.1'],
+                      ['--catchment_type', '3', '--slope', '5', '--flow_duration_curve', '20',
+                       '--market_price', '0.1']]
+
+def get_example(): # {{{
+    '''
+    Returns (params, flows) of the epic example, flows for every head as from
+      hydro_vector.get_head_flows().
+    '''
+    import EPIC
+    from hydro_vector import get_head_flows
+    (params, args) = EPIC.parse_args(EPIC_ARGS)
+    (heads, max_H) = EPIC.get_heads(params)
+    return (params, get_head_flows(heads, params))
+    # }}} End of get_example
+
+def get_synthetic_catalogue(diameters=SYNTHETIC_DIAMETERS): # {{{
+    '''
+    Returns a PipeCatalogue of diameters diameters from 0.05 m to 2.5 m in PVC, DI and
+      GRP, costing about the same per m as pipes_1.csv. DI is not made above 2 m.
+    '''
+    import numpy as np
+    from pipes import PipeCatalogue
+    diameter = np.linspace(0.05, 2.5, diameters)
+    cost = np.array([230 * diameter**1.3, 330 * diameter**1.3, 380 * diameter**1.3])
+    cost[1, diameter > 2.0] = np.nan
+    return PipeCatalogue(diameter, cost, ['PVC', 'DI', 'GRP'])
+    # }}} End of get_synthetic_catalogue
+
+def case_friction_coeff(): # {{{
+    from hydro_utils import get_friction_coeff
+    (params, flows) = get_example()
+    triples = [(Q, D, E) for Q in flows['design_flow'][::50].tolist()
+                         for D in [0.1, 0.5, 1.5] for E in [0.003, 0.15]]
+    return lambda: [get_friction_coeff(Q = Q, D = D, E = E) for (Q, D, E) in triples]
+    # }}} End of case_friction_coeff
+
+def case_friction_coeff_array(): # {{{
+    import numpy as np
+    from hydro_vector import get_friction_coeff_array
+    from pipes import read_pipe_catalogue
+    (params, flows) = get_example()
+    catalogue = read_pipe_catalogue(os.path.join(HERE, 'pipes_1.csv'))
+    Q = flows['design_flow'][:, np.newaxis]
+    return lambda: [get_friction_coeff_array(Q = Q, D = catalogue.diameter, E = E)
+                    for E in catalogue.roughness]
+    # }}} End of case_friction_coeff_array
+
+def case_head_loss(): # {{{
+    from hydro_utils import get_head_loss
+    (params, flows) = get_example()
+    values = zip(flows['design_flow'].tolist(), flows['penstock_length'].tolist())
+    return lambda: [get_head_loss(F = 0.02, L = L, D = D, Q = Q)
+                    for (Q, L) in values for D in [0.1, 0.5, 1.5]]
+    # }}} End of case_head_loss
+
+def optimum_pipe_case(pipe_file, search='exhaustive'): # {{{
+    '''
+    Returns a case which chooses the pipe of every 10th head of the example from
+      pipe_file, a file name in this directory or a PipeCatalogue.
+    '''
+    def case():
+        from hydro_utils import get_optimum_pipe_for_head
+        from pipes import read_pipe_catalogue
+        (params, flows) = get_example()
+        catalogue = pipe_file
+        if isinstance(pipe_file, str): catalogue = read_pipe_catalogue(os.path.join(HERE, pipe_file))
+        heads = [dict((key, float(values[i])) for (key, values) in flows.items())
+                 for i in range(0, len(flows['head']), 10)]
+        return lambda: [get_optimum_pipe_for_head(head            = h['head'],
+                                                  pipe_table      = catalogue,
+                                                  design_flow     = h['design_flow'],
+                                                  penstock_length = h['penstock_length'],
+                                                  FIT             = h['fit'],
+                                                  efficiency      = params.efficiency,
+                                                  market_price    = params.market_price,
+                                                  interest        = params.interest,
+                                                  verbose         = False,
+                                                  search          = search)
+                        for h in heads]
+    return case
+    # }}} End of optimum_pipe_case
+
+def sweep_case(engine, catalogue=None): # {{{
+    '''
+    Returns a case which runs the example over every head with engine, on the
+      PipeCatalogue returned by catalogue() or else pipes_1.csv.
+    '''
+    def case():
+        import EPIC
+        (params, args) = EPIC.parse_args(EPIC_ARGS + ['--engine', engine])
+        pipe_table = catalogue() if catalogue else EPIC.read_pipe_table(params.pipe_file)
+        return lambda: EPIC.run_epic(params, pipe_table)
+    return case
+    # }}} End of sweep_case
+
+# (name, what it measures, function returning the callable to time)
+CASES = [('friction_coeff',        'get_friction_coeff(), 66 (Q, D, E)',
+                                   case_friction_coeff),
+         ('friction_coeff_array',  'get_friction_coeff_array(), every head x pipes_1.csv',
+                                   case_friction_coeff_array),
+         ('head_loss',             'get_head_loss(), every head x 3 diameters',
+                                   case_head_loss),
+         ('optimum_pipe_pipes_0',  'get_optimum_pipe_for_head(), 53 heads, pipes_0.csv',
+                                   optimum_pipe_case('pipes_0.csv')),
+         ('optimum_pipe_pipes_1',  'get_optimum_pipe_for_head(), 53 heads, pipes_1.csv',
+                                   optimum_pipe_case('pipes_1.csv')),
+         ('sweep_vector',          'run_epic() of the epic example, vector engine',
+                                   sweep_case('vector')),
+         ('sweep_scalar',          'run_epic() of the epic example, scalar engine',
+                                   sweep_case('scalar')),
+         ('synthetic_vector',      'run_epic(), %d diameters, vector engine' % SYNTHETIC_DIAMETERS,
+                                   sweep_case('vector', get_synthetic_catalogue)),
+         ('synthetic_bound',       'get_optimum_pipe_for_head(), 53 heads, %d diameters, '
+                                   'bound search' % SYNTHETIC_DIAMETERS,
+                                   lambda: optimum_pipe_case(get_synthetic_catalogue(), 'bound')())]
+
+def time_case(function, repeat): # {{{
+    '''
+    Returns (best seconds per call, calls per run) of function.
+    '''
+    function() # Warm up caches and imports
+    number = 1
+    while True:
+        start = time.time()
+        for i in range(number): function()
+        elapsed = time.time() - start
+        if elapsed >= MIN_RUN_SECONDS: break
+        number *= 2 if elapsed <= 0 else max(2, int(MIN_RUN_SECONDS / elapsed * 1.2))
+    best = elapsed
+    for i in range(repeat - 1):
+        start = time.time()
+        for j in range(number): function()
+        best = min(best, time.time() - start)
+    return (best / number, number)
+    # }}} End of time_case
+
+def get_machine(): # {{{
+    import numpy
+    return {'platform'  : platform.platform(),
+            'processor' : platform.processor() or platform.machine(),
+            'python'    : platform.python_version(),
+            'numpy'     : numpy.__version__}
+    # }}} End of get_machine
+
+def run_suite(names=None, repeat=5, out=sys.stdout): # {{{
+    '''
+    Times the CASES in names (all if None), printing each as it goes to out.
+    Returns the results as saved by --save.
+    Raises ValueError for a case which does not exist.
+    '''
+    known = [name for (name, description, case) in CASES]
+    for name in names or []:
+        if name not in known:
+            raise ValueError('Unknown case %s, use some of %s' % (name, ','.join(known)))
+
+    results = {'version': BENCH_VERSION, 'machine': get_machine(), 'cases': {}}
+    for (name, description, case) in CASES:
+        if names and name not in names: continue
+        (seconds, number) = time_case(case(), repeat)
+        results['cases'][name] = {'seconds': seconds, 'number': number, 'repeat': repeat}
+        print >>out, '  %-22s %10.3f ms  %s' % (name, seconds * 1000, description)
+        out.flush()
+    return results
+    # }}} End of run_suite
+
+def read_results(filename): # {{{
+    '''
+    Reads results saved by --save.
+    Raises ValueError if the file is not a baseline of this version of the suite.
+    '''
+    with open(filename) as f:
+        try:
+            results = json.load(f)
+        except ValueError:
+            raise ValueError('%s is not a benchmark baseline' % filename)
+    if not isinstance(results, dict) or 'cases' not in results:
+        raise ValueError('%s is not a benchmark baseline' % filename)
+    if results.get('version') != BENCH_VERSION:
+        raise ValueError('%s is from another version of the benchmarks, save it again' % filename)
+    return results
+    # }}} End of read_results
+
+def write_results(results, filename): # {{{
+    with open(filename, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+        f.write('\n')
+    # }}} End of write_results
+
+def compare_results(baseline, current, threshold, out=sys.stdout): # {{{
+    '''
+    Prints the change of every case in both baseline and current.
+    Returns the names of the cases more than threshold percent slower.
+    '''
+    if baseline['machine'] != current['machine']:
+        print >>out, 'Warning: the baseline is from another machine or version:'
+        for key in sorted(baseline['machine']):
+            if baseline['machine'][key] != current['machine'].get(key):
+                print >>out, '  %s: %s now %s' % (key, baseline['machine'][key],
+                                                  current['machine'].get(key))
+
+    regressed = []
+    print >>out, '  %-22s %12s %12s %9s' % ('Case', 'Baseline ms', 'Now ms', 'Change')
+    for (name, description, case) in CASES:
+        if name not in baseline['cases'] or name not in current['cases']: continue
+        before = baseline['cases'][name]['seconds']
+        after = current['cases'][name]['seconds']
+        change = (after / before - 1) * 100 if before > 0 else 0.0
+        status = ''
+        if change > threshold:
+            status = 'REGRESSED'
+            regressed.append(name)
+        print >>out, '  %-22s %12.3f %12.3f %+8.1f%% %s' % (name, before * 1000, after * 1000,
+                                                           change, status)
+    return regressed
+    # }}} End of compare_results
+
+def check_engines(out=sys.stdout): # {{{
+    '''
+    Runs each of ENGINE_CHECKS with both engines, printing the worst error of each as a
+      multiple of the tolerance of hydro_vector.get_engine_errors().
+    Returns the descriptions of the checks where the engines disagree, on an axis or
+      on an optimum scheme.
+    '''
+    import EPIC
+    from hydro_vector import get_engine_errors
+    failed = []
+    print >>out, '  %-60s %8s  %s' % ('Check', 'Error', 'Worst axis')
+    for changes in ENGINE_CHECKS:
+        (params, args) = EPIC.parse_args(EPIC_ARGS + changes + ['--no_cache'])
+        pipe_table = EPIC.read_pipe_table(params.pipe_file)
+        results = {}
+        for engine in ['vector', 'scalar']:
+            params.engine = engine
+            results[engine] = EPIC.run_epic(params, pipe_table, keep_axes=True)
+        errors = get_engine_errors(results['vector']['axes'], results['scalar']['axes'])
+        worst = max(errors, key=errors.get)
+        schemes = [key for key in sorted(results['scalar']['schemes'])
+                   if [results['vector']['schemes'][key].get(k) for k in ['head', 'material']] !=
+                      [results['scalar']['schemes'][key].get(k) for k in ['head', 'material']]]
+        description = ' '.join(os.path.basename(c) for c in changes) or 'the example'
+        status = ''
+        if errors[worst] > 1 or schemes:
+            status = 'DISAGREE' + (' on %s' % ', '.join(schemes) if schemes else '')
+            failed.append(description)
+        print >>out, '  %-60s %8.3g  %s %s' % (description, errors[worst], worst, status)
+        out.flush()
+    return failed
+    # }}} End of check_engines
+
+def check_head_search(out=sys.stdout): # {{{
+    '''
+    Runs each of HEAD_SEARCH_CHECKS with --head_search and the integer scan, printing
+      the heads each evaluated.
+    Returns the descriptions of the checks where an optimum of the search is worse than
+      the integer scan's.
+    '''
+    import EPIC
+    import head_search
+    from hydro_vector import OPTIMUM_FACTORS
+    failed = []
+    print >>out, '  %-60s %8s %8s  %s' % ('Check', 'Search', 'Scan', 'Worse on')
+    for changes in HEAD_SEARCH_CHECKS:
+        (params, args) = EPIC.parse_args(EPIC_ARGS + changes + ['--no_cache'])
+        pipe_table = EPIC.read_pipe_table(params.pipe_file)
+        scan = EPIC.run_epic(params, pipe_table)
+        search = head_search.run_head_search(params, pipe_table)
+        worse = [key for (key, better, initial, condition) in OPTIMUM_FACTORS
+                 if better(scan['schemes'][key][key], search['schemes'][key][key])]
+        description = ' '.join(os.path.basename(c) for c in changes) or 'the example'
+        if worse: failed.append(description)
+        print >>out, '  %-60s %8d %8d  %s' % (description, search['evaluations'],
+                                              scan['evaluations'], ', '.join(worse))
+        out.flush()
+    return failed
+    # }}} End of check_head_search
+
+def main(argv=None): # {{{
+    parser = OptionParser(usage='%prog run [--save FILE] | compare BASELINE [CURRENT] | check')
+    parser.add_option('--repeat', dest='repeat', type='int', default=5,
+                      help='Runs of each case, the best is reported. Default 5.')
+    parser.add_option('--cases', dest='cases',
+                      help='Comma separated cases to run, default all of: %s.' %
+                           ', '.join(name for (name, description, case) in CASES))
+    parser.add_option('--save', dest='save', metavar='FILE',
+                      help='Save the results of run (or of compare without CURRENT) to FILE.')
+    parser.add_option('--threshold', dest='threshold', type='float', default=10.0,
+                      help='Percent slower than the baseline at which compare fails. Default 10.')
+    (opts, args) = parser.parse_args(argv)
+    sys.path.insert(0, HERE)
+
+    if not args or args[0] not in ['run', 'compare', 'check'] or \
+       (args[0] in ['run', 'check'] and len(args) != 1) or \
+       (args[0] == 'compare' and len(args) not in [2, 3]):
+        parser.error('Give run, check, or compare and one or two baseline files')
+    names = opts.cases.split(',') if opts.cases else None
+
+    if args[0] == 'check':
+        print 'Vector engine against the scalar engine (error as a multiple of the tolerance):'
+        failed = check_engines()
+        print '--head_search against the integer scan (heads evaluated):'
+        failed += check_head_search()
+        if failed:
+            print '%d check(s) disagree: %s' % (len(failed), ', '.join(failed))
+            sys.exit(1)
+        return
+
+    try:
+        if args[0] == 'compare':
+            baseline = read_results(args[1])
+            if len(args) == 3:
+                current = read_results(args[2])
+            else:
+                # Only the cases of the baseline, so they can be compared
+                print 'Running:'
+                current = run_suite(names or sorted(baseline['cases']), opts.repeat)
+        else:
+            print 'Running:'
+            current = run_suite(names, opts.repeat)
+        if opts.save: write_results(current, opts.save)
+    except (ValueError, IOError), e:
+        print 'Error: %s. Exiting' % e
+        sys.exit(1)
+
+    if args[0] == 'compare':
+        print 'Compared with %s (threshold %g%%):' % (args[1], opts.threshold)
+        regressed = compare_results(baseline, current, opts.threshold)
+        if regressed:
+            print '%d case(s) regressed: %s' % (len(regressed), ', '.join(regressed))
+            sys.exit(1)
+    # }}} End of main
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+# bench_startup.py
+# This file measures how long EPIC takes to start. Every measurement is made in a fresh
+# interpreter, as that is what a user of the command line pays for.
+#
+# Run with something like:
+# ./bench_startup.py --repeat 10
+import os
+import sys
+import time
+import shutil
+import tempfile
+import subprocess
+from optparse import OptionParser
+
+# Modules whose import cost is reported, relative to an empty interpreter
+MODULES = ['numpy', 'prettytable', 'matplotlib.pyplot', 'hydro_utils', 'hydro_vector', 'EPIC']
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# The example from the epic script, always worked out rather than read from the result
+#   cache, which would time a cache read from the second repeat on
+EPIC_ARGS = ['--catchment_type', '4', '--slope', '10', '--catchment_length', '3000',
+             '--flow_duration_curve', '4', '--precipitation', '1600',
+             '--potential_evaporation', '400', '--catchment_area', '15000000',
+             '--pipe_file', os.path.join(HERE, 'pipes_1.csv'), '--reliability', '0.7',
+             '--efficiency', '0.82', '--market_price', '0.03', '--interest', '0.05',
+             '--heads', '50,100', '--no_cache']
+
+def time_command(command, repeat, cwd, env): # {{{
+    '''
+    Returns the best wall time in seconds of repeat runs of command.
+    The best rather than the mean, as anything slower is noise from the machine.
+    '''
+    devnull = open(os.devnull, 'w')
+    best = None
+    for i in range(repeat):
+        start = time.time()
+        subprocess.check_call(command, cwd=cwd, env=env, stdout=devnull)
+        elapsed = time.time() - start
+        if best is None or elapsed < best: best = elapsed
+    devnull.close()
+    return best
+    # }}} End of time_command
+
+def main(argv=None): # {{{
+    parser = OptionParser(usage='%prog [--repeat N]')
+    parser.add_option('--repeat', dest='repeat', type='int', default=5,
+                      help='Runs of each measurement, the best is reported.')
+    (opts, args) = parser.parse_args(argv)
+
+    # Let EPIC choose its own matplotlib backend, and run where the plots can be saved
+    env = dict(os.environ)
+    env.pop('MPLBACKEND', None)
+    env['PYTHONPATH'] = HERE
+    cwd = tempfile.mkdtemp(prefix='epic_bench_')
+    os.mkdir(os.path.join(cwd, 'plots'))
+
+    try:
+        python = [sys.executable]
+        empty = time_command(python + ['-c', 'pass'], opts.repeat, cwd, env)
+        print 'Empty interpreter:            %8.1f ms' % (empty * 1000)
+
+        print 'Import cost:'
+        for module in MODULES:
+            t = time_command(python + ['-c', 'import %s' % module], opts.repeat, cwd, env)
+            print '  %-28s %8.1f ms' % (module, (t - empty) * 1000)
+
+        print 'EPIC.py runs (including interpreter):'
+        epic = python + [os.path.join(HERE, 'EPIC.py')] + EPIC_ARGS
+        for (name, extra) in [('--format json',     ['--format', 'json']),
+                              ('--format csv',      ['--format', 'csv']),
+                              ('table',             []),
+                              ('table and a plot',  ['--plots', 'capacity'])]:
+            t = time_command(epic + extra, opts.repeat, cwd, env)
+            print '  %-28s %8.1f ms' % (name, t * 1000)
+        # The first run fills the result cache, the best of the rest reads it
+        t = time_command(epic[:-1], max(2, opts.repeat), cwd, env)
+        print '  %-28s %8.1f ms' % ('table, cached result', t * 1000)
+    finally:
+        shutil.rmtree(cwd)
+    # }}} End of main
+
+if __name__ == '__main__':
+    main()
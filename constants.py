@@ -20,7 +20,24 @@ TurbFrac = 0.2  #
 GridFrac = 0.1  # 
 # assert int(PenFrac + CivFrac + TurbFrac + GridFrac) == 1, 'Fractions of cost do not add up to 1.0: %s' % int(PenFrac + CivFrac + TurbFrac + GridFrac)
 
+# Colebrook-White solver, see hydro_utils.get_friction_coeff()
+FrictionTolerance     = 1e-12   # Relative change in friction factor at which iteration stops
+FrictionMaxIterations = 100     # Includes the seed, as in the original fixed 100 iterations
+
+# Turbines stop below this fraction of their design flow, see flow_series.py
+TurbineMinFlow = 0.1
+
 # PVC can only be used under certain conditions
 PVC_Constraint_MaxHead     = 120    # Meters
 PVC_Constraint_MaxDiameter = 0.5    # Meters
 
+# Pipe materials which are recognised in the header of a pipe file, see pipes.py
+#   (name, surface roughness, lower case names it may have in the header)
+PipeMaterials = [('PVC', E_PVC, ['pvc', 'poly vinyl chloride']),
+                 ('DI',  E_DI,  ['di', 'ductile iron', 'iron']),
+                 ('GRP', E_GRP, ['grp', 'glass reinforced plastic'])]
+
+# Materials which are always used where they are allowed, whatever the other materials
+#   cost: name: (max head, max diameter)
+PreferredMaterials = {'PVC': (PVC_Constraint_MaxHead, PVC_Constraint_MaxDiameter)}
+
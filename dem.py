@@ -0,0 +1,439 @@
+# dem.py
+# This file contains the DEM mode of EPIC.py (--dem FILE), which measures the catchment
+# from a digital elevation model instead of approximating it by one of the shapes of
+# hydro_utils.CATCHMENT_SHAPES from --catchment_length and --slope.
+#
+#   - The DEM is an ESRI ASCII grid (.asc) or an ESRI binary float grid (.flt with its
+#     .hdr), in a projection whose units are meters. Binary grids are memory mapped; an
+#     ASCII grid is parsed once, a block at a time, into a memory mapped .npy file in
+#     ~/.epic/dem, so neither is ever held as Python objects.
+#   - The D8 flow direction of every cell (towards its steepest downhill neighbour) is
+#     worked out a block of rows at a time, and the flow accumulation (the cells upstream
+#     of every cell, itself included) in one pass over the cells in topological order,
+#     each cell being visited once. Flats and pits have no direction, so the DEM should
+#     have its depressions filled first.
+#   - The channel is traced upstream from the powerhouse (--dem_outlet, snapped to the
+#     cell of largest accumulation within --dem_snap cells), always into the neighbour
+#     with the largest accumulation, up to where less than --dem_min_area drains to it.
+#
+# Every channel cell above the powerhouse is a candidate intake. Its head is its height
+# above the powerhouse, its penstock length the length of the channel to it, and the
+# fraction of the catchment above it the measured upstream area over that of the
+# powerhouse. They are evaluated in one go by EPIC.run_intakes(). --catchment_area
+# defaults to the measured area at the powerhouse.
+import os
+import hashlib
+import numpy as np
+
+DEM_CACHE_VERSION = 1 # Bump this when the layout of the cached grids changes
+DEM_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.epic', 'dem')
+DEM_BLOCK_ROWS = 512        # Rows of flow directions worked out at a time
+DEM_READ_BYTES = 1 << 24    # Bytes of an ASCII grid parsed at a time
+DEM_SNAP_CELLS = 3
+
+# The D8 neighbours as (row step, column step), rows running north to south. The flow
+#   direction of a cell is the index of its neighbour here, or NO_DIRECTION.
+D8 = [(-1, -1), (-1, 0), (-1, 1), (0, -1), (0, 1), (1, -1), (1, 0), (1, 1)]
+NO_DIRECTION = -1
+
+# Header keys of ESRI grids, lower case
+HEADER_KEYS = ['ncols', 'nrows', 'xllcorner', 'yllcorner', 'xllcenter', 'yllcenter',
+               'cellsize', 'nodata_value', 'byteorder']
+
+class DemGrid(object): # {{{
+    '''
+    A digital elevation model. elevation is rows x columns from north to south, and may
+      be a memmap. (xll, yll) is the lower left corner of the grid, nodata the value of
+      cells with no elevation or None.
+    '''
+    def __init__(self, elevation, cellsize, xll=0.0, yll=0.0, nodata=None, filename=None):
+        self.elevation = elevation
+        self.cellsize = float(cellsize)
+        self.xll = float(xll)
+        self.yll = float(yll)
+        self.nodata = nodata
+        self.filename = filename
+        self.shape = elevation.shape
+
+    def get_cell(self, x, y):
+        '''
+        Returns (row, column) of the cell at (x, y).
+        Raises ValueError if it is outside the grid.
+        '''
+        (rows, columns) = self.shape
+        column = int(np.floor((x - self.xll) / self.cellsize))
+        row = rows - 1 - int(np.floor((y - self.yll) / self.cellsize))
+        if not (0 <= row < rows and 0 <= column < columns):
+            raise ValueError('%g,%g is outside the DEM' % (x, y))
+        return (row, column)
+
+    def get_xy(self, row, column):
+        '''
+        Returns (x, y) of the centre of a cell, row and column may be arrays.
+        '''
+        x = self.xll + (np.asarray(column) + 0.5) * self.cellsize
+        y = self.yll + (self.shape[0] - np.asarray(row) - 0.5) * self.cellsize
+        return (x, y)
+
+    def get_block(self, start, stop):
+        '''
+        Returns rows start to stop of the elevation as floats, NaN where there is none.
+        '''
+        z = np.array(self.elevation[start:stop], dtype=float)
+        if self.nodata is not None: z[z == self.nodata] = np.nan
+        return z
+    # }}} End of DemGrid
+
+def read_header(f): # {{{
+    '''
+    Reads the 'key value' lines of an ESRI grid header from the file f, leaving f at
+      the first line which is not one.
+    Returns a dict of the values keyed by lower case key.
+    Raises ValueError if ncols, nrows or cellsize are missing.
+    '''
+    header = {}
+    while True:
+        position = f.tell()
+        words = f.readline().split()
+        if len(words) != 2 or words[0].lower() not in HEADER_KEYS:
+            f.seek(position)
+            break
+        header[words[0].lower()] = words[1]
+    for key in ['ncols', 'nrows', 'cellsize']:
+        if key not in header: raise ValueError('No %s in the DEM header' % key)
+    return header
+    # }}} End of read_header
+
+def make_grid(elevation, header, filename): # {{{
+    '''
+    Returns the DemGrid of elevation with the values of an ESRI header.
+    '''
+    cellsize = float(header['cellsize'])
+    # The corner of the grid, or the centre of the corner cell
+    xll = float(header.get('xllcorner', float(header.get('xllcenter', 0.5 * cellsize)) - 0.5 * cellsize))
+    yll = float(header.get('yllcorner', float(header.get('yllcenter', 0.5 * cellsize)) - 0.5 * cellsize))
+    nodata = float(header['nodata_value']) if 'nodata_value' in header else None
+    return DemGrid(elevation, cellsize, xll, yll, nodata, filename)
+    # }}} End of make_grid
+
+def get_dem_cache_file(filename, cache_dir=DEM_CACHE_DIR): # {{{
+    '''
+    Returns the path of the parsed elevations of an ASCII grid. The key is the path, size
+      and time of the file rather than its contents, which would take as long to hash
+      as to parse.
+    '''
+    stat = os.stat(filename)
+    key = hashlib.sha1(repr((DEM_CACHE_VERSION, os.path.abspath(filename), stat.st_size,
+                             stat.st_mtime)))
+    return os.path.join(cache_dir, 'dem_%s.npy' % key.hexdigest())
+    # }}} End of get_dem_cache_file
+
+def read_ascii_grid(filename, cache_dir=DEM_CACHE_DIR): # {{{
+    '''
+    Returns the DemGrid of an ESRI ASCII grid. The elevations are parsed a block at a
+      time into a memory mapped file in cache_dir, and read from there the next time.
+      cache_dir None parses them into memory.
+    Raises ValueError if the grid does not have nrows x ncols values.
+    '''
+    f = open(filename, 'rb')
+    try:
+        header = read_header(f)
+        shape = (int(header['nrows']), int(header['ncols']))
+
+        if cache_dir is not None:
+            cache_file = get_dem_cache_file(filename, cache_dir)
+            if os.path.exists(cache_file):
+                try:
+                    return make_grid(np.load(cache_file, mmap_mode='r'), header, filename)
+                except (IOError, ValueError):
+                    pass # Unreadable cache, just parse it again
+            if not os.path.isdir(cache_dir): os.makedirs(cache_dir)
+            # Write to a temporary file first so a half written cache is never read
+            temp = cache_file + '.%d.tmp' % os.getpid()
+            elevation = np.lib.format.open_memmap(temp, mode='w+', dtype=np.float32, shape=shape)
+        else:
+            elevation = np.empty(shape, dtype=np.float32)
+
+        flat = elevation.reshape(-1)
+        filled = 0
+        rest = ''
+        while True:
+            data = f.read(DEM_READ_BYTES)
+            text = rest + data
+            if data:
+                # A number may run on into the next read
+                cut = max(text.rfind(' '), text.rfind('\n'), text.rfind('\t'))
+                (text, rest) = (text[:cut + 1], text[cut + 1:])
+            values = np.fromstring(text, dtype=float, sep=' ')
+            if filled + len(values) > flat.size: break
+            flat[filled:filled + len(values)] = values
+            filled += len(values)
+            if not data: break
+        if filled != flat.size:
+            raise ValueError('%s should have %d x %d values' % (filename, shape[0], shape[1]))
+    finally:
+        f.close()
+
+    if cache_dir is not None:
+        elevation.flush()
+        del flat, elevation
+        os.rename(temp, cache_file)
+        elevation = np.load(cache_file, mmap_mode='r')
+    return make_grid(elevation, header, filename)
+    # }}} End of read_ascii_grid
+
+def read_float_grid(filename): # {{{
+    '''
+    Returns the DemGrid of an ESRI binary float grid, the 32 bit floats of filename
+      memory mapped, with the header from the .hdr file beside it.
+    Raises ValueError if the file is not the size of the header.
+    '''
+    with open(os.path.splitext(filename)[0] + '.hdr', 'rb') as f:
+        header = read_header(f)
+    shape = (int(header['nrows']), int(header['ncols']))
+    dtype = '>f4' if header.get('byteorder', 'LSBFIRST').upper() == 'MSBFIRST' else '<f4'
+    if os.path.getsize(filename) != shape[0] * shape[1] * 4:
+        raise ValueError('%s should have %d x %d floats' % (filename, shape[0], shape[1]))
+    return make_grid(np.memmap(filename, dtype=dtype, mode='r', shape=shape), header, filename)
+    # }}} End of read_float_grid
+
+def read_dem(filename, cache_dir=DEM_CACHE_DIR): # {{{
+    '''
+    Returns the DemGrid of an ESRI ASCII (.asc) or binary float (.flt) grid.
+    Raises ValueError for any other kind of file.
+    '''
+    extension = os.path.splitext(filename)[1].lower()
+    if extension in ['.asc', '.txt']: return read_ascii_grid(filename, cache_dir)
+    if extension == '.flt': return read_float_grid(filename)
+    raise ValueError('Cannot read %s, use an ESRI ASCII (.asc) or float (.flt) grid' % filename)
+    # }}} End of read_dem
+
+def get_flow_directions(dem, block_rows=DEM_BLOCK_ROWS): # {{{
+    '''
+    Returns the D8 flow direction of every cell of the DemGrid, an int8 array of
+      indexes into D8: the neighbour with the steepest drop, the first of D8 on a tie.
+      Cells with no lower neighbour (pits, flats, no data) have NO_DIRECTION, the grid
+      is never flowed out of.
+    The elevations are read block_rows rows at a time.
+    '''
+    (rows, columns) = dem.shape
+    directions = np.empty(dem.shape, dtype=np.int8)
+    distance = [np.hypot(dr, dc) for (dr, dc) in D8]
+
+    for start in range(0, rows, block_rows):
+        stop = min(rows, start + block_rows)
+        # The block with a border of one cell, NaN outside the grid
+        padded = np.empty((stop - start + 2, columns + 2))
+        padded.fill(np.nan)
+        (first, last) = (max(start - 1, 0), min(stop + 1, rows))
+        padded[first - start + 1:last - start + 1, 1:-1] = dem.get_block(first, last)
+        centre = padded[1:-1, 1:-1]
+
+        steepest = np.zeros(centre.shape)
+        block = np.empty(centre.shape, dtype=np.int8)
+        block.fill(NO_DIRECTION)
+        for (k, (dr, dc)) in enumerate(D8):
+            neighbour = padded[1 + dr:padded.shape[0] - 1 + dr, 1 + dc:padded.shape[1] - 1 + dc]
+            with np.errstate(invalid='ignore'):
+                drop = (centre - neighbour) / distance[k]
+                steeper = drop > steepest # NaN is never steeper
+            block[steeper] = k
+            steepest[steeper] = drop[steeper]
+        directions[start:stop] = block
+    return directions
+    # }}} End of get_flow_directions
+
+def get_flow_accumulation(directions): # {{{
+    '''
+    Returns the number of cells which drain through each cell, itself included, as a
+      uint32 array, from the flow directions of get_flow_directions().
+    The cells are visited once each, in topological order: those with nothing flowing
+      into them first, then each cell once everything upstream of it is done.
+    '''
+    (rows, columns) = directions.shape
+    n = rows * columns
+    offsets = np.array([dr * columns + dc for (dr, dc) in D8], dtype=np.int64)
+
+    # How many neighbours flow into each cell
+    inflows = np.zeros(directions.shape, dtype=np.uint8)
+    for (k, (dr, dc)) in enumerate(D8):
+        source = directions[max(-dr, 0):rows - max(dr, 0), max(-dc, 0):columns - max(dc, 0)] == k
+        inflows[max(dr, 0):rows - max(-dr, 0), max(dc, 0):columns - max(-dc, 0)] += source
+    inflows = inflows.reshape(-1)
+    flat = directions.reshape(-1)
+
+    accumulation = np.ones(n, dtype=np.uint32)
+    ready = np.flatnonzero(inflows == 0)
+    while ready.size:
+        direction = flat[ready]
+        source = ready[direction != NO_DIRECTION]
+        if not source.size: break
+        receiver = source + offsets[flat[source]]
+        if source.size * 16 > n:
+            # A few steps cover much of the grid, a full length count is cheaper than
+            #   sorting, and these steps can only happen 16 times
+            added = np.bincount(receiver, weights=accumulation[source], minlength=n)
+            counts = np.bincount(receiver, minlength=n)
+            cells = np.flatnonzero(counts)
+            (added, counts) = (added[cells], counts[cells])
+        else:
+            (cells, inverse) = np.unique(receiver, return_inverse=True)
+            added = np.bincount(inverse, weights=accumulation[source])
+            counts = np.bincount(inverse)
+        accumulation[cells] += added.astype(np.uint32)
+        inflows[cells] -= counts.astype(np.uint8)
+        ready = cells[inflows[cells] == 0]
+    return accumulation.reshape(directions.shape)
+    # }}} End of get_flow_accumulation
+
+def snap_outlet(dem, accumulation, x, y, snap=DEM_SNAP_CELLS): # {{{
+    '''
+    Returns (row, column) of the cell of largest accumulation within snap cells of
+      (x, y), so a powerhouse a little off the channel is moved onto it.
+    Raises ValueError if (x, y) is outside the grid.
+    '''
+    (row, column) = dem.get_cell(x, y)
+    (top, left) = (max(row - snap, 0), max(column - snap, 0))
+    window = accumulation[top:row + snap + 1, left:column + snap + 1]
+    (r, c) = np.unravel_index(np.argmax(window), window.shape)
+    return (top + int(r), left + int(c))
+    # }}} End of snap_outlet
+
+def trace_channel(directions, accumulation, outlet, min_cells=1): # {{{
+    '''
+    Returns the cells of the channel upstream of outlet, (row, column), as two arrays
+      from the outlet up. Each step is into the neighbour flowing into the cell with the
+      largest accumulation, the first of D8 on a tie, while it has at least min_cells.
+    '''
+    (rows, columns) = directions.shape
+    (r, c) = outlet
+    channel = [(r, c)]
+    while True:
+        best = None
+        for (k, (dr, dc)) in enumerate(D8):
+            # The neighbour which flows into (r, c) in direction k
+            (rr, cc) = (r - dr, c - dc)
+            if 0 <= rr < rows and 0 <= cc < columns and directions[rr, cc] == k:
+                cells = accumulation[rr, cc]
+                if cells >= min_cells and (best is None or cells > best[0]):
+                    best = (cells, rr, cc)
+        if best is None: break
+        (r, c) = best[1:]
+        channel.append((r, c))
+    (channel_rows, channel_columns) = zip(*channel)
+    return (np.array(channel_rows), np.array(channel_columns))
+    # }}} End of trace_channel
+
+def get_channel(dem, outlet=None, snap=DEM_SNAP_CELLS, min_area=0.0): # {{{
+    '''
+    Delineates the catchment of the DemGrid and traces its channel, see the top of this
+      file. outlet is the (x, y) of the powerhouse, by default the cell of largest
+      accumulation.
+    Returns a dict of arrays with a value for each cell of the channel, from the
+      powerhouse up: row, column, x, y, elevation, distance (horizontally along the
+      channel), penstock_length (along the channel, the climb included), head, area
+      (m^2 draining to the cell) and area_frac (area over that of the powerhouse).
+    Raises ValueError if outlet is outside the grid or has no elevation.
+    '''
+    directions = get_flow_directions(dem)
+    accumulation = get_flow_accumulation(directions)
+
+    if outlet is None:
+        start = np.unravel_index(np.argmax(accumulation), accumulation.shape)
+    else:
+        start = snap_outlet(dem, accumulation, outlet[0], outlet[1], snap)
+    cell_area = dem.cellsize**2
+    (rows, columns) = trace_channel(directions, accumulation, start,
+                                    max(1, int(np.ceil(min_area / cell_area))))
+
+    elevation = np.array(dem.elevation[rows, columns], dtype=float)
+    if dem.nodata is not None: elevation[elevation == dem.nodata] = np.nan
+    if np.isnan(elevation[0]): raise ValueError('The powerhouse has no elevation')
+
+    # Prefix sums of the steps up the channel
+    step = dem.cellsize * np.hypot(np.diff(rows), np.diff(columns))
+    climb = np.diff(elevation)
+    distance = np.concatenate([[0.0], np.cumsum(step)])
+    penstock_length = np.concatenate([[0.0], np.cumsum(np.hypot(step, climb))])
+
+    cells = accumulation[rows, columns].astype(float)
+    (x, y) = dem.get_xy(rows, columns)
+    return {'row'             : rows,
+            'column'          : columns,
+            'x'               : x,
+            'y'               : y,
+            'elevation'       : elevation,
+            'distance'        : distance,
+            'penstock_length' : penstock_length,
+            'head'            : elevation - elevation[0],
+            'area'            : cells * cell_area,
+            'area_frac'       : cells / cells[0]}
+    # }}} End of get_channel
+
+def get_intakes(channel): # {{{
+    '''
+    Returns (indexes, geometry) of the candidate intakes of a channel from
+      get_channel(), every cell above the powerhouse. geometry is as
+      hydro_vector.evaluate_geometry(), indexes are the channel cells of the intakes.
+    '''
+    indexes = np.flatnonzero(channel['head'] > 0)
+    geometry = {'head'            : channel['head'][indexes],
+                'penstock_length' : channel['penstock_length'][indexes],
+                'Hz'              : channel['distance'][indexes],
+                'area_frac'       : channel['area_frac'][indexes]}
+    return (indexes, geometry)
+    # }}} End of get_intakes
+
+# Where an intake is, added to each scheme of run_dem(): (key, channel key, column title,
+#   format of the column)
+INTAKE_FIELDS = [('distance',      'distance', 'Upstream (m)', lambda v: '%.01f' % v),
+                 ('x',             'x',        'X',            lambda v: '%.01f' % v),
+                 ('y',             'y',        'Y',            lambda v: '%.01f' % v),
+                 ('upstream_area', 'area',     'Area (km^2)',  lambda v: '%.03f' % (v / 1e6))]
+
+def run_dem(params, pipe_table, dem): # {{{
+    '''
+    Evaluates every candidate intake on the channel of the DemGrid, see the top of this
+      file. params.ca of NaN is the area at the powerhouse.
+    Returns (results, channel): results as EPIC.run_intakes(), each scheme with the
+      INTAKE_FIELDS of its intake, and the channel from get_channel().
+    '''
+    import copy
+    import EPIC
+    outlet = None
+    if params.dem_outlet:
+        try:
+            outlet = [float(v) for v in str(params.dem_outlet).split(',')]
+        except ValueError:
+            outlet = []
+        if len(outlet) != 2: raise ValueError('--dem_outlet should be X,Y: %s' % params.dem_outlet)
+    channel = get_channel(dem, outlet, params.dem_snap, params.dem_min_area)
+
+    if params.ca != params.ca: # NaN
+        params = copy.copy(params)
+        params.ca = float(channel['area'][0])
+    (indexes, geometry) = get_intakes(channel)
+    if not len(indexes): raise ValueError('There is no channel above the powerhouse')
+    results = EPIC.run_intakes(params, pipe_table, geometry)
+    EPIC.add_intake_fields(results, dict((key, channel[channel_key][indexes])
+                                         for (key, channel_key, title, show) in INTAKE_FIELDS))
+    return (results, channel)
+    # }}} End of run_dem
+
+def print_dem(results, channel, params, out=None): # {{{
+    '''
+    Writes the optimum intakes from run_dem() in the format of params.format.
+    '''
+    import EPIC
+    summary = {'cells'          : len(channel['head']),
+               'outlet_x'       : float(channel['x'][0]),
+               'outlet_y'       : float(channel['y'][0]),
+               'catchment_area' : float(channel['area'][0]),
+               'length'         : float(channel['distance'][-1])}
+    title = 'DEM: %s, channel of %d cells, %.0f m long, from %.1f,%.1f draining %.3f km^2' % \
+            (params.dem, summary['cells'], summary['length'], summary['outlet_x'],
+             summary['outlet_y'], summary['catchment_area'] / 1e6)
+    EPIC.print_intake_results(results, params,
+                              [(key, name, show) for (key, k, name, show) in INTAKE_FIELDS],
+                              {'channel': summary}, title, out)
+    # }}} End of print_dem
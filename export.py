@@ -0,0 +1,201 @@
+# export.py
+# This file contains the per head export of EPIC.py (--output FILE), which writes every
+# evaluated head to a file as run_epic() goes, rather than holding them in memory.
+#
+# Each head is one row of HEAD_FIELDS: the flows, the chosen pipe and the economics.
+# The format is given by --output_format, or by the extension of FILE:
+#   csv      - .csv, a header line and then one line per head
+#   jsonl    - .jsonl or .json, one JSON object per head (inf and NaN become null)
+#   columnar - anything else, a directory with one NumPy .npy file per field plus
+#              columns.json, which names the fields and the materials. The material
+#              column is the index of the material in columns.json (-1 for none).
+#              Load it with read_columns(), or np.load() each file with
+#              mmap_mode='r' to read millions of heads without loading them all.
+#
+# Rows are buffered and written in blocks, and the .npy headers are written with a fixed
+# size so the number of rows can be filled in when the file is closed.
+import os
+import csv
+import json
+import struct
+import numpy as np
+
+# The per head values written, in order
+HEAD_FIELDS = ['head', 'penstock_length', 'avg_flow_rate', 'design_flow', 'fit',
+               'diameter', 'material', 'head_loss', 'capacity', 'total_penstock_cost',
+               'total_project_cost', 'annual_revenue', 'payback_period', 'cost_per_kw',
+               'annual_roi']
+
+OUTPUT_FORMATS = ['csv', 'jsonl', 'columnar']
+
+OUTPUT_BUFFER_ROWS  = 4096     # Rows added one at a time are written in blocks of this many
+OUTPUT_BUFFER_BYTES = 1 << 20  # Buffer of each file
+
+NPY_HEADER_SIZE = 128 # Bytes, room for any number of rows
+
+class HeadWriter(object): # {{{
+    '''
+    Writes per head rows to a file. Subclasses write a block of columns in _write().
+    materials are the names of the materials which the material column indexes.
+    '''
+    def __init__(self, filename, materials):
+        self.filename = filename
+        self.materials = list(materials)
+        self.rows = 0
+        self._material_index = dict((m, k) for (k, m) in enumerate(self.materials))
+        self._material_index[''] = -1
+        self._buffer = []
+
+    def write(self, columns):
+        '''
+        Writes a block of rows. columns is a dict with an array for every field of
+          HEAD_FIELDS, such as the results of hydro_vector.evaluate_heads().
+        '''
+        self.flush()
+        block = [np.asarray(columns[field], dtype=int if field == 'material' else float)
+                 for field in HEAD_FIELDS]
+        n = len(block[0])
+        block = [np.broadcast_to(column, (n,)) for column in block]
+        if n:
+            self._write(block)
+            self.rows += n
+
+    def add(self, row):
+        '''
+        Adds one row, a dict of the values of HEAD_FIELDS with the material as its name.
+        '''
+        self._buffer.append([self._material_index[row[field]] if field == 'material' else row[field]
+                             for field in HEAD_FIELDS])
+        if len(self._buffer) >= OUTPUT_BUFFER_ROWS: self.flush()
+
+    def flush(self):
+        if not self._buffer: return
+        columns = zip(*self._buffer)
+        self._buffer = []
+        self.write(dict(zip(HEAD_FIELDS, columns)))
+
+    def close(self):
+        self.flush()
+    # }}} End of HeadWriter
+
+class CSVHeadWriter(HeadWriter): # {{{
+    def __init__(self, filename, materials):
+        HeadWriter.__init__(self, filename, materials)
+        self._file = open(filename, 'wb', OUTPUT_BUFFER_BYTES)
+        self._writer = csv.writer(self._file)
+        self._writer.writerow(HEAD_FIELDS)
+
+    def _write(self, block):
+        names = self.materials + [''] # -1 is no material
+        columns = [[names[k] for k in column.tolist()] if field == 'material' else
+                   [repr(x) for x in column.tolist()]
+                   for (field, column) in zip(HEAD_FIELDS, block)]
+        self._writer.writerows(zip(*columns))
+
+    def close(self):
+        HeadWriter.close(self)
+        self._file.close()
+    # }}} End of CSVHeadWriter
+
+class JSONLHeadWriter(HeadWriter): # {{{
+    def __init__(self, filename, materials):
+        HeadWriter.__init__(self, filename, materials)
+        self._file = open(filename, 'wb', OUTPUT_BUFFER_BYTES)
+
+    def _write(self, block):
+        names = [json.dumps(m) for m in self.materials] + ['""']
+        columns = []
+        for (field, column) in zip(HEAD_FIELDS, block):
+            if field == 'material':
+                values = [names[k] for k in column.tolist()]
+            else:
+                # JSON has no infinity or NaN
+                values = [repr(x) if finite else 'null'
+                          for (x, finite) in zip(column.tolist(), np.isfinite(column).tolist())]
+            columns.append(['"%s": %s' % (field, value) for value in values])
+        self._file.write(''.join('{%s}\n' % ', '.join(row) for row in zip(*columns)))
+
+    def close(self):
+        HeadWriter.close(self)
+        self._file.close()
+    # }}} End of JSONLHeadWriter
+
+def get_npy_header(dtype, rows): # {{{
+    '''
+    Returns a version 1.0 .npy header of NPY_HEADER_SIZE bytes for a 1-D array.
+    '''
+    header = "{'descr': %r, 'fortran_order': False, 'shape': (%d,), }" % (np.dtype(dtype).str, rows)
+    magic = '\x93NUMPY\x01\x00'
+    space = NPY_HEADER_SIZE - len(magic) - 2
+    return magic + struct.pack('<H', space) + header.ljust(space - 1) + '\n'
+    # }}} End of get_npy_header
+
+class ColumnarHeadWriter(HeadWriter): # {{{
+    DTYPES = {'material': '<i2'}
+
+    def __init__(self, filename, materials):
+        HeadWriter.__init__(self, filename, materials)
+        if not os.path.isdir(filename): os.makedirs(filename)
+        self._files = []
+        for field in HEAD_FIELDS:
+            f = open(os.path.join(filename, field + '.npy'), 'wb', OUTPUT_BUFFER_BYTES)
+            f.write(get_npy_header(self.DTYPES.get(field, '<f8'), 0))
+            self._files.append(f)
+
+    def _write(self, block):
+        for (field, f, column) in zip(HEAD_FIELDS, self._files, block):
+            f.write(column.astype(self.DTYPES.get(field, '<f8')).tobytes())
+
+    def close(self):
+        HeadWriter.close(self)
+        # Now the number of rows is known
+        for (field, f) in zip(HEAD_FIELDS, self._files):
+            f.seek(0)
+            f.write(get_npy_header(self.DTYPES.get(field, '<f8'), self.rows))
+            f.close()
+        with open(os.path.join(self.filename, 'columns.json'), 'w') as f:
+            json.dump({'fields'     : HEAD_FIELDS,
+                       'materials'  : self.materials,
+                       'rows'       : self.rows}, f, sort_keys=True)
+            f.write('\n')
+    # }}} End of ColumnarHeadWriter
+
+def get_output_format(filename, output_format=None): # {{{
+    '''
+    Returns the format of --output, from output_format or the extension of filename.
+    '''
+    if output_format: return output_format
+    extension = os.path.splitext(filename)[1].lower()
+    if extension == '.csv': return 'csv'
+    if extension in ['.jsonl', '.json']: return 'jsonl'
+    return 'columnar'
+    # }}} End of get_output_format
+
+def open_head_writer(filename, materials, output_format=None): # {{{
+    '''
+    Returns a HeadWriter for filename in output_format (see get_output_format()).
+    Raises ValueError if the format is unknown.
+    '''
+    output_format = get_output_format(filename, output_format)
+    writers = {'csv'        : CSVHeadWriter,
+               'jsonl'      : JSONLHeadWriter,
+               'columnar'   : ColumnarHeadWriter}
+    if output_format not in writers:
+        raise ValueError('Unknown output format %s, use one of %s' %
+                         (output_format, ', '.join(OUTPUT_FORMATS)))
+    return writers[output_format](filename, materials)
+    # }}} End of open_head_writer
+
+def read_columns(dirname, mmap_mode='r'): # {{{
+    '''
+    Reads a columnar --output directory.
+    Returns a dict of an array for every field, memory mapped unless mmap_mode is None,
+      plus materials, the names of the materials which the material column indexes.
+    '''
+    with open(os.path.join(dirname, 'columns.json')) as f:
+        description = json.load(f)
+    columns = dict((field, np.load(os.path.join(dirname, field + '.npy'), mmap_mode=mmap_mode))
+                   for field in description['fields'])
+    columns['materials'] = description['materials']
+    return columns
+    # }}} End of read_columns
@@ -0,0 +1,208 @@
+# fdc_sweep.py
+# This file contains the flow duration curve sweep of EPIC.py (--fdc_sweep), which
+# evaluates every entry of hydro_utils.flow_duration_curve against every head, rather
+# than the one --flow_duration_curve picks, and finds the (head, design flow) pair which
+# is the optimum of each economic factor.
+#
+# The design flows of every entry and head form one 2-D grid, entries x heads, and the
+# model is worked out over the grid in one go (a few entries at a time to bound memory).
+# The Colebrook-White solver, which takes most of the time, runs over the flows of those
+# entries in blocks of FRICTION_CHUNK_ELEMENTS. The design flow is the average flow of the
+# head times the entry, so flows only repeat where entries or average flows do, which the
+# curve and the catchment shapes never give; the friction is not deduplicated.
+#
+# For each factor the optimum of every entry is the scheme EPIC.py gives with that
+# --flow_duration_curve, and the joint optimum is the best of those, the lower entry
+# winning a tie. The values of every plot axis over the grid are kept as matrices of
+# entries x heads, ready for a heatmap (--plots, or the json format).
+import numpy as np
+from constants import *
+import EPIC
+from hydro_utils import get_head_loss, flow_duration_curve
+from hydro_vector import OPTIMUM_FACTORS, EMPTY_SCHEME, get_head_geometry, get_head_hydrology, \
+                         get_fit_array, get_friction_coeff_array, get_optimum_pipe_array, \
+                         get_economics_array, get_optimum_index, get_scheme
+from pipes import get_pipe_catalogue
+from flow_series import get_annual_energy
+import profiling
+
+# The friction is solved for about this many (flow, diameter) elements at a time, which
+#   keeps the solver's temporaries in the CPU cache and is about twice as quick as all
+#   at once.
+FRICTION_CHUNK_ELEMENTS = 16384
+
+# The values kept for every entry and head, as the names of plotting.PLOTS
+FDC_MATRICES = ['penstock_length', 'avg_flow_rate', 'design_flow', 'fit', 'capacity',
+                'total_penstock_cost', 'total_project_cost', 'annual_revenue',
+                'payback_period', 'cost_per_kw', 'annual_roi']
+
+def get_friction_table(catalogue, flows, params): # {{{
+    '''
+    Returns a list of the friction coefficient of each material of the catalogue for
+      every flow in the 1-D array flows against every diameter.
+    '''
+    chunk = max(1, FRICTION_CHUNK_ELEMENTS // len(catalogue.diameter))
+    table = []
+    for E in catalogue.roughness:
+        table.append(np.empty((len(flows), len(catalogue.diameter))))
+        for start in range(0, len(flows), chunk):
+            table[-1][start:start + chunk] = get_friction_coeff_array(
+                Q = flows[start:start + chunk, np.newaxis],
+                D = catalogue.diameter,
+                E = E,
+                method = getattr(params, 'friction_method', 'fixed_point'),
+                tolerance = getattr(params, 'friction_tolerance', FrictionTolerance))
+    return table
+    # }}} End of get_friction_table
+
+def run_fdc_sweep(params, pipe_table): # {{{
+    '''
+    Evaluates every entry of the flow duration curve against every head.
+    Returns a dict with:
+      max_H       - the maximum head of the catchment
+      heads       - the heads evaluated
+      fdc         - the flow duration curve
+      matrices    - an entries x heads array of each value of FDC_MATRICES
+      schemes     - the joint optimum scheme of each economic factor, keyed as the
+                    scheme dicts of EPIC.py plus fdc_index (counting from 1, as
+                    --flow_duration_curve) and design_flow
+      fdc_schemes - for each economic factor the optimum scheme of every entry
+    Raises ValueError if a head in params.heads is above the maximum head.
+    '''
+    catalogue = get_pipe_catalogue(pipe_table)
+    (heads, max_H) = EPIC.get_heads(params)
+    geometry = get_head_geometry(heads, params)
+    hydrology = get_head_hydrology(geometry, params)
+    fdc = np.array(flow_duration_curve)
+    (n_fdc, n_heads) = (len(fdc), len(heads))
+
+    # The grid, entries x heads
+    design_flow = hydrology['avg_flow_rate'] * fdc[:, np.newaxis]
+    head = np.broadcast_to(geometry['head'], design_flow.shape)
+    penstock_length = np.broadcast_to(geometry['penstock_length'], design_flow.shape)
+    FIT = get_fit_array(design_flow, geometry['head'])
+
+    matrices = dict((name, np.empty(design_flow.shape)) for name in FDC_MATRICES)
+    matrices['diameter'] = np.empty(design_flow.shape)
+    matrices['material'] = np.empty(design_flow.shape, dtype=int)
+
+    elements = max(1, n_heads * len(catalogue) * len(catalogue.materials))
+    chunk = max(1, EPIC.RUN_CHUNK_ELEMENTS // elements)
+    for start in range(0, n_fdc, chunk):
+        rows = slice(start, start + chunk)
+        Q = design_flow[rows]
+        friction = get_friction_table(catalogue, Q.ravel(), params)
+        head_losses = [get_head_loss(F = f.reshape(Q.shape + f.shape[-1:]),
+                                     L = penstock_length[rows][..., np.newaxis],
+                                     D = catalogue.diameter,
+                                     Q = Q[..., np.newaxis])
+                       for f in friction]
+        for head_loss in head_losses:
+            profiling.count_array('get_head_loss', head_loss.size, counted=True)
+        pipe = get_optimum_pipe_array(head            = head[rows],
+                                      pipe_table      = catalogue,
+                                      design_flow     = Q,
+                                      penstock_length = penstock_length[rows],
+                                      FIT             = FIT[rows],
+                                      efficiency      = params.efficiency,
+                                      market_price    = params.market_price,
+                                      interest        = params.interest,
+                                      head_losses     = head_losses)
+        annual_energy = get_annual_energy(params, hydrology['area_frac'], Q, head[rows],
+                                          pipe['head_loss'], params.efficiency)
+        economics = get_economics_array(head                = head[rows],
+                                        design_flow         = Q,
+                                        FIT                 = FIT[rows],
+                                        head_loss           = pipe['head_loss'],
+                                        total_penstock_cost = pipe['annual_capital_cost'] / params.interest,
+                                        efficiency          = params.efficiency,
+                                        market_price        = params.market_price,
+                                        reliability         = params.reliability,
+                                        interest            = params.interest,
+                                        annual_energy       = annual_energy)
+        economics.update({'penstock_length' : penstock_length[rows],
+                          'avg_flow_rate'   : hydrology['avg_flow_rate'],
+                          'design_flow'     : Q,
+                          'fit'             : FIT[rows],
+                          'diameter'        : pipe['diameter'],
+                          'material'        : pipe['material']})
+        for (name, values) in matrices.items():
+            values[rows] = economics[name]
+
+    # The optimum of every entry, and the best of those
+    flat = dict((name, values.ravel()) for (name, values) in matrices.items())
+    flat['materials'] = catalogue.materials
+    schemes = {}
+    fdc_schemes = {}
+    for (key, better, initial, condition) in OPTIMUM_FACTORS:
+        i = get_optimum_index(matrices[key], key)
+        best = np.where(i >= 0, matrices[key][np.arange(n_fdc), i], initial)
+        fdc_schemes[key] = []
+        for k in range(n_fdc):
+            if i[k] < 0:
+                scheme = dict(EMPTY_SCHEME)
+                scheme['design_flow'] = 0.0
+            else:
+                scheme = get_scheme(flat, k * n_heads + i[k], heads[i[k]])
+                scheme['design_flow'] = float(design_flow[k, i[k]])
+            scheme['fdc_index'] = k + 1
+            fdc_schemes[key].append(scheme)
+        k = int(get_optimum_index(best, key))
+        schemes[key] = dict(fdc_schemes[key][k]) if k >= 0 else \
+                       dict(EMPTY_SCHEME, fdc_index=0, design_flow=0.0)
+
+    return {'max_H'         : max_H,
+            'heads'         : heads,
+            'fdc'           : list(flow_duration_curve),
+            'matrices'      : dict((name, matrices[name]) for name in FDC_MATRICES),
+            'schemes'       : schemes,
+            'fdc_schemes'   : fdc_schemes}
+    # }}} End of run_fdc_sweep
+
+def print_fdc_sweep(results, params, out=None): # {{{
+    '''
+    Writes the joint optimum schemes from run_fdc_sweep() in the format of
+      params.format. json also has the fdc, heads and matrices, as lists of rows with
+      null for inf and NaN.
+    '''
+    import sys
+    if out is None: out = sys.stdout
+    rows = [(name, results['schemes'][key]) for (name, key) in EPIC.RESULT_SCHEMES]
+
+    if params.format == 'json':
+        import json
+        clean = lambda row: [x if np.isfinite(x) else None for x in row]
+        document = {'pipe_file' : params.pipe_file,
+                    'max_H'     : results['max_H'],
+                    'heads'     : list(results['heads']),
+                    'fdc'       : results['fdc'],
+                    'schemes'   : dict((key, EPIC.get_json_scheme(results['schemes'][key]))
+                                       for (name, key) in EPIC.RESULT_SCHEMES),
+                    'matrices'  : dict((name, [clean(row) for row in values.tolist()])
+                                       for (name, values) in results['matrices'].items())}
+        json.dump(document, out, sort_keys=True)
+        out.write('\n')
+
+    elif params.format == 'csv':
+        import csv
+        writer = csv.writer(out)
+        writer.writerow(['scheme', 'fdc_index', 'design_flow'] + EPIC.RESULT_FIELDS)
+        for (name, scheme) in rows:
+            writer.writerow([name, scheme['fdc_index'], repr(scheme['design_flow'])] +
+                            [repr(scheme[k]) if isinstance(scheme[k], float) else scheme[k]
+                             for k in EPIC.RESULT_FIELDS])
+
+    else:
+        from prettytable import PrettyTable
+        table = PrettyTable(['Scheme', 'FDC', 'Design Flow (m^3/s)', 'Head (m)', 'Mat',
+                             'Diam (m)', 'Cap (kW)', 'Rev/Yr (GBP)', 'Proj Cost (GBP)',
+                             'Payback Period (Yr)', 'Cost/kW (GBP/kW)'])
+        for (name, scheme) in rows:
+            table.add_row([name, scheme['fdc_index'], '%.04f' % scheme['design_flow'],
+                           scheme['head'], scheme['material']] +
+                          ['%.02f' % scheme[k] for k in ['diameter', 'capacity', 'annual_revenue',
+                                                         'project_cost', 'payback_period',
+                                                         'cost_per_kw']])
+        print >>out, 'Input file: ', params.pipe_file
+        print >>out, table
+    # }}} End of print_fdc_sweep
@@ -0,0 +1,174 @@
+# flow_series.py
+# This file contains the flow series mode of EPIC.py (--flow_series FILE), where the
+# energy a scheme generates is worked out from a series of measured flows, such as years
+# of daily or hourly gauge data, rather than as its capacity all year round times
+# --reliability.
+#
+# The series is the flow in m^3/s at the powerhouse, from the whole catchment, one value
+# every --flow_step hours (24 by default, 1 for hourly data). At an intake the flow is
+# the series times the fraction of the catchment above it (hydro_utils.get_area()). At
+# each time the turbine takes:
+#   - nothing, below --min_flow times the design flow,
+#   - all of the flow, up to the design flow,
+#   - the design flow, above it.
+# Power is (head - head loss) * flow * G * efficiency, with the head loss scaling with
+# the square of the flow from its value at the design flow (the friction factor of the
+# chosen pipe is taken as constant). The annual energy is the sum over the series divided
+# by the years it covers. Revenue is then that energy times (FIT + market price), less
+# the loan repayments; --reliability is not used.
+#
+# As every intake sees the same series scaled, the series is sorted once and the sums of
+# the flow and of its cube are kept for every prefix. Then the energy of any number of
+# heads is two searchsorted()s and a few sums each, whatever the length of the series.
+#
+# The file is one of:
+#   .npy          - a NumPy array, memory mapped
+#   .f4           - raw little endian 4 byte floats, memory mapped
+#   .csv or .txt  - one flow per line in the last column, e.g. date,flow, with an
+#                   optional header line. It is read once and cached in ~/.epic/flows
+#                   as .npy, keyed by a hash of the file.
+#   anything else - raw little endian 8 byte floats, memory mapped
+# Missing values (NaN, or empty in CSV) are left out. Negative flows are an error.
+import os
+import csv
+import hashlib
+import numpy as np
+from constants import *
+
+FLOW_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.epic', 'flows')
+
+def read_flow_csv(filename, cache_dir=FLOW_CACHE_DIR): # {{{
+    '''
+    Returns the flows in the last column of a CSV file as an array, memory mapped from
+      the cache if the file has been read before. cache_dir None skips the cache.
+    Raises ValueError for a flow which is not a number.
+    '''
+    with open(filename, 'rb') as f:
+        data = f.read()
+    cache_file = None
+    if cache_dir is not None:
+        cache_file = os.path.join(cache_dir, 'flows_%s.npy' % hashlib.sha1(data).hexdigest())
+        if os.path.exists(cache_file):
+            try:
+                return np.load(cache_file, mmap_mode='r')
+            except (IOError, ValueError):
+                pass # Unreadable cache, just parse it again
+
+    flows = []
+    for (line, row) in enumerate(csv.reader(data.splitlines())):
+        if not row: continue
+        value = row[-1].strip()
+        try:
+            flows.append(float(value) if value else np.nan)
+        except ValueError:
+            if line == 0: continue # A header
+            raise ValueError('Flow on line %d is not a number: %s' % (line + 1, value))
+    flows = np.array(flows, dtype=float)
+
+    if cache_file:
+        try:
+            if not os.path.isdir(cache_dir): os.makedirs(cache_dir)
+            # Write to a temporary file first so a half written cache is never read
+            temp = cache_file + '.%d.tmp' % os.getpid()
+            with open(temp, 'wb') as f:
+                np.save(f, flows)
+            os.rename(temp, cache_file)
+        except (IOError, OSError):
+            pass # The cache is only to save time
+    return flows
+    # }}} End of read_flow_csv
+
+def read_flows(filename): # {{{
+    '''
+    Returns the flows of a flow series file as an array, memory mapped where it can be.
+      See the top of this file for the formats.
+    '''
+    extension = os.path.splitext(filename)[1].lower()
+    if extension == '.npy': return np.load(filename, mmap_mode='r')
+    if extension in ['.csv', '.txt']: return read_flow_csv(filename)
+    if extension == '.f4': return np.memmap(filename, dtype='<f4', mode='r')
+    return np.memmap(filename, dtype='<f8', mode='r')
+    # }}} End of read_flows
+
+class FlowSeries(object): # {{{
+    '''
+    A flow series, sorted with the sums of the flow and of its cube for every prefix.
+    flows are in m^3/s, one every step hours.
+    Raises ValueError if there are no flows or a flow is negative.
+    '''
+    def __init__(self, flows, step=24.0):
+        # One copy of a memory mapped file, sorted in place
+        self.flows = np.array(flows, dtype=float).ravel()
+        self.flows.sort()
+        self.flows = self.flows[:np.searchsorted(self.flows, np.inf, side='right')] # NaN sort last
+        if not len(self.flows): raise ValueError('The flow series has no flows')
+        if self.flows[0] < 0: raise ValueError('The flow series has a negative flow: %r' % self.flows[0])
+        if np.isinf(self.flows[-1]): raise ValueError('The flow series has an infinite flow')
+
+        self.step = float(step)
+        self.years = len(self.flows) * self.step / (365 * 24)
+        self._sum = np.concatenate([[0.0], np.cumsum(self.flows)])
+        self._sum_cubes = np.concatenate([[0.0], np.cumsum(self.flows**3)])
+        self.digest = hashlib.sha1(repr(self.step) + self.flows.tobytes()).hexdigest()
+
+    def __len__(self):
+        return len(self.flows)
+
+    def annual_energy(self, area_frac, design_flow, head, head_loss, efficiency,
+                      min_flow=TurbineMinFlow):
+        '''
+        Returns the energy generated in an average year in kWh at intakes with the
+          fractions of the catchment area_frac, see the top of this file.
+        head_loss is the head loss at the design flow. Every argument may be an array,
+          they broadcast against each other, but area_frac and design_flow are usually
+          per head and cheapest as small arrays.
+        '''
+        a = np.asarray(area_frac, dtype=float)
+        Qd = np.asarray(design_flow, dtype=float)
+        n = len(self.flows)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            # Series flows the turbine takes all of, flows[lo:hi], and n - hi above the
+            #   design flow where it takes the design flow. No area gives NaN, which
+            #   sorts after every flow.
+            lo = np.searchsorted(self.flows, min_flow * Qd / a, side='left')
+            hi = np.maximum(np.searchsorted(self.flows, Qd / a, side='right'), lo)
+            flow = a * (self._sum[hi] - self._sum[lo])
+            cubes = a**3 * (self._sum_cubes[hi] - self._sum_cubes[lo])
+            energy = (n - hi) * (head - head_loss) * Qd + \
+                     head * flow - head_loss / Qd**2 * cubes
+            energy = np.where(Qd > 0, energy, 0.0)
+        return energy * G * efficiency * DWater / 1000 * self.step / self.years
+    # }}} End of FlowSeries
+
+_series = {}
+
+def get_flow_series(params): # {{{
+    '''
+    Returns the FlowSeries of params.flow_series, read once per file and step, or None
+      if there is no flow series.
+    Raises ValueError if the file cannot be read as a flow series.
+    '''
+    filename = getattr(params, 'flow_series', None)
+    if not filename: return None
+    step = getattr(params, 'flow_step', 24.0)
+    try:
+        stat = os.stat(filename)
+        key = (os.path.abspath(filename), stat.st_mtime, stat.st_size, step)
+        if key not in _series:
+            _series.clear() # Only the latest series is kept
+            _series[key] = FlowSeries(read_flows(filename), step)
+    except (IOError, OSError), e:
+        raise ValueError('Cannot read flow series %s: %s' % (filename, e))
+    return _series[key]
+    # }}} End of get_flow_series
+
+def get_annual_energy(params, area_frac, design_flow, head, head_loss, efficiency): # {{{
+    '''
+    Returns the annual energy in kWh from the flow series of params (see
+      FlowSeries.annual_energy()), or None if there is no flow series.
+    '''
+    series = get_flow_series(params)
+    if series is None: return None
+    return series.annual_energy(area_frac, design_flow, head, head_loss, efficiency,
+                                getattr(params, 'min_flow', TurbineMinFlow))
+    # }}} End of get_annual_energy
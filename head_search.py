@@ -0,0 +1,312 @@
+# head_search.py
+# This file contains the continuous head search of EPIC.py (--head_search). Rather than
+# evaluating every whole metre from 1 to the maximum head, it finds the head of each
+# optimum scheme to within --head_tolerance meters.
+#
+# The economic factors are smooth functions of the head except where something in the
+# model switches from one formula to another. The known switches split the heads into
+# pieces:
+#   - the catchment shape, where get_area_array() changes formula (a kink),
+#   - PVC_Constraint_MaxHead, above which PVC may not be used (a jump),
+#   - the FIT threshold, where the capacity estimate passes 100 kW (a jump).
+# Each piece is scanned coarsely, all in one call of evaluate_heads(). The chosen pipe
+# also changes with the head, which puts jumps inside the pieces that nothing predicts,
+# so the pieces are split again wherever the pipe differs between neighbouring scan
+# points, at the head where it changes (found by bisection). The whole metres between
+# the scanned neighbours of the best few local optima are evaluated too, in one more
+# array call, and the best of them and of the scan is kept unless narrowing beats it:
+# the brackets either side of those local optima are narrowed by Brent's method
+# (parabolic steps where the function is smooth, golden-section steps where it is not),
+# each side on its own. So wherever the optimum of the integer scan is next to one of
+# those local optima, the search cannot return a worse one; bench_hot_paths.py check
+# compares the two.
+#
+# A search needs HeadSearchSamples heads and the whole metres around the optima in two
+# array calls plus a few hundred single evaluations for all five factors. On the example
+# catchment that is 372 heads against the 528 of the integer scan. Over 288 catchments
+# (4 types x 3 slopes x 4 curves x 2 prices x 3 areas) it saved about a third on those
+# of 300 heads or more, but evaluated more than the integer scan on smaller ones. Its
+# gain is the tolerance: a grid to 0.01 m would need (max_H / tolerance) heads.
+from math import sqrt
+import numpy as np
+from constants import *
+import EPIC
+from hydro_vector import OPTIMUM_FACTORS, EMPTY_SCHEME, get_area_breaks, get_head_flows, \
+                         evaluate_heads, get_scheme
+
+HeadSearchMin        = 1.0   # Smallest head searched, the same as the integer scan
+HeadSearchTolerance  = 0.01  # Meters
+HeadSearchSamples    = 64    # Points in the coarse scan, shared out between the pieces
+HeadSearchCandidates = 3     # Local optima of the coarse scan which are narrowed down
+
+class HeadEvaluator(object): # {{{
+    '''
+    Evaluates heads for one set of params and counts the evaluations.
+    Single heads are remembered, so asking for one again costs nothing.
+    '''
+    def __init__(self, params, pipe_table):
+        self.params = params
+        self.pipe_table = pipe_table
+        self.evaluations = 0
+        self._single = {}
+
+    def __call__(self, heads):
+        heads = np.atleast_1d(np.asarray(heads, dtype=float))
+        if len(heads) == 1 and float(heads[0]) in self._single:
+            return self._single[float(heads[0])]
+        self.evaluations += len(heads)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            results = evaluate_heads(heads, self.pipe_table, self.params)
+        if len(heads) == 1: self._single[float(heads[0])] = results
+        return results
+    # }}} End of HeadEvaluator
+
+def get_objective(key): # {{{
+    '''
+    Returns a function of an array of values of the economic factor key which is
+      smallest at the optimum and inf where the value could not be an optimum, as
+      chosen by get_optimum_index().
+    '''
+    (better, initial, condition) = [f[1:] for f in OPTIMUM_FACTORS if f[0] == key][0]
+    sign = 1.0 if better is np.less else -1.0
+    def objective(values):
+        values = np.asarray(values, dtype=float)
+        ok = better(values, initial) & ~np.isnan(values)
+        if condition: ok &= condition(values)
+        return np.where(ok, sign * values, np.inf)
+    return objective
+    # }}} End of get_objective
+
+def get_head_pieces(params, lo, hi, tolerance=HeadSearchTolerance): # {{{
+    '''
+    Splits the heads from lo to hi where the model switches formula (see the top of
+      this file).
+    Returns a sorted list of (first, last) heads of the pieces. Where the function
+      jumps, last of one piece and first of the next are either side of the jump.
+    '''
+    slope = np.tan(np.radians(params.slope))
+    # (last head of the lower piece, first head of the upper piece)
+    breaks = [(Hz * slope, Hz * slope) for Hz in get_area_breaks(params.catch_type, params.cl)]
+    breaks.append((float(PVC_Constraint_MaxHead), np.nextafter(PVC_Constraint_MaxHead, np.inf)))
+
+    # The FIT threshold, found from a scan of the flows and then by bisection
+    excess = lambda h: get_head_flows(h, params)['design_flow'] * h * HEP - 100
+    heads = np.linspace(lo, hi, 257)
+    high = excess(heads) <= 0 # FIT is GTHigh where the estimate is 100 kW or less
+    for i in np.flatnonzero(high[1:] != high[:-1]):
+        (a, b) = (heads[i], heads[i + 1])
+        while b - a > tolerance / 4:
+            m = 0.5 * (a + b)
+            if (excess(m) <= 0) == high[i]: a = m
+            else:                           b = m
+        breaks.append((a, b))
+
+    breaks = sorted(b for b in breaks if lo < b[0] and b[1] < hi)
+    edges = [lo] + [x for b in breaks for x in b] + [hi]
+    return zip(edges[0::2], edges[1::2])
+    # }}} End of get_head_pieces
+
+def _brent(f, a, b, tolerance, max_iterations=100): # {{{
+    '''
+    Brent's method for the minimum of f between a and b, to within tolerance.
+    Returns (x, f(x)) of the best point found. f may return inf.
+    '''
+    golden = 0.5 * (3 - sqrt(5))
+    sqrt_eps = sqrt(2.2e-16)
+    x = w = v = a + golden * (b - a)
+    fx = fw = fv = f(x)
+    d = e = 0.0
+
+    for i in range(max_iterations):
+        m = 0.5 * (a + b)
+        tol1 = sqrt_eps * abs(x) + tolerance / 3
+        tol2 = 2 * tol1
+        if abs(x - m) <= tol2 - 0.5 * (b - a): break
+
+        # Try a parabola through x, w and v, otherwise a golden section step
+        parabolic = False
+        if abs(e) > tol1:
+            with np.errstate(invalid='ignore'): # inf - inf where heads could not be optima
+                r = (x - w) * (fx - fv)
+                q = (x - v) * (fx - fw)
+                p = (x - v) * q - (x - w) * r
+                q = 2 * (q - r)
+            if q > 0: p = -p
+            q = abs(q)
+            (r, e) = (e, d)
+            # Comparisons with NaN (from inf values) are False, so no parabola is used
+            if abs(p) < abs(0.5 * q * r) and p > q * (a - x) and p < q * (b - x):
+                d = p / q
+                u = x + d
+                if u - a < tol2 or b - u < tol2: d = tol1 if x < m else -tol1
+                parabolic = True
+        if not parabolic:
+            e = (b - x) if x < m else (a - x)
+            d = golden * e
+
+        if abs(d) >= tol1: u = x + d
+        elif d > 0:        u = x + tol1
+        else:              u = x - tol1
+        fu = f(u)
+
+        if fu <= fx:
+            if u < x: b = x
+            else:     a = x
+            (v, fv, w, fw, x, fx) = (w, fw, x, fx, u, fu)
+        else:
+            if u < x: a = u
+            else:     b = u
+            if fu <= fw or w == x:
+                (v, fv, w, fw) = (w, fw, u, fu)
+            elif fu <= fv or v == x or v == w:
+                (v, fv) = (u, fu)
+
+    return (x, fx)
+    # }}} End of _brent
+
+def get_head_scans(pieces): # {{{
+    '''
+    Returns the heads of the coarse scan of each piece from get_head_pieces().
+    HeadSearchSamples are shared out by length, with at least both ends and the middle.
+    '''
+    span = sum(last - first for (first, last) in pieces)
+    return [np.linspace(first, last, max(3, int(HeadSearchSamples * (last - first) / span) + 1))
+            for (first, last) in pieces]
+    # }}} End of get_head_scans
+
+def split_at_pipe_changes(evaluate, scans, scanned, tolerance=HeadSearchTolerance): # {{{
+    '''
+    Splits the scans from get_head_scans() wherever the chosen pipe differs between
+      neighbouring heads, at the head where it changes, found by bisection to within
+      tolerance.
+    Returns (scans, scanned) like the arguments, where last of one scan and first of
+      the next are either side of a change.
+    '''
+    pipe = lambda results, i: (float(results['diameter'][i]), int(results['material'][i]))
+
+    def changes(a, pa, b, pb):
+        # The (last, first) heads either side of each change between a and b
+        if pa == pb: return []
+        if b - a <= tolerance: return [(a, b)]
+        m = 0.5 * (a + b)
+        pm = pipe(evaluate(m), 0)
+        return changes(a, pa, m, pm) + changes(m, pm, b, pb)
+
+    # Each new piece as a list of (results, index) of its heads
+    pieces = []
+    start = 0
+    for heads in scans:
+        piece = []
+        for i in range(len(heads)):
+            piece.append((scanned, start + i))
+            if i == len(heads) - 1: continue
+            (pa, pb) = (pipe(scanned, start + i), pipe(scanned, start + i + 1))
+            for (a, b) in changes(heads[i], pa, heads[i + 1], pb):
+                if a != heads[i]: piece.append((evaluate(a), 0))
+                pieces.append(piece)
+                piece = [(evaluate(b), 0)] if b != heads[i + 1] else []
+        pieces.append(piece)
+        start += len(heads)
+
+    merged = dict(scanned)
+    for (key, values) in scanned.items():
+        if isinstance(values, np.ndarray):
+            merged[key] = np.array([results[key][i] for piece in pieces for (results, i) in piece])
+    return ([np.array([results['head'][i] for (results, i) in piece]) for piece in pieces],
+            merged)
+    # }}} End of split_at_pipe_changes
+
+def get_candidates(key, scans, scanned): # {{{
+    '''
+    Returns the local optima of the scans for the economic factor key, best first, as
+      a list of (objective value, scan, index in the scan, index in scanned).
+    '''
+    values = get_objective(key)(scanned[key])
+    candidates = []
+    start = 0
+    for (n, heads) in enumerate(scans):
+        y = values[start:start + len(heads)]
+        for i in range(len(heads)):
+            if np.isinf(y[i]): continue
+            if (i == 0 or y[i] <= y[i - 1]) and (i == len(heads) - 1 or y[i] <= y[i + 1]):
+                candidates.append((y[i], n, i, start + i))
+        start += len(heads)
+    candidates.sort()
+    return candidates
+    # }}} End of get_candidates
+
+def get_whole_heads(scans, scanned, max_H): # {{{
+    '''
+    Returns the whole metres, as evaluated by the integer scan, between the scanned
+      neighbours of the best HeadSearchCandidates local optima of every economic factor.
+      Across a pipe change the neighbour is on the far side of it, so a whole metre just
+      past the change is among them.
+    '''
+    heads = scanned['head']
+    whole = set()
+    for (key, better, initial, condition) in OPTIMUM_FACTORS:
+        for (value, n, i, j) in get_candidates(key, scans, scanned)[:HeadSearchCandidates]:
+            (a, b) = (heads[max(j - 1, 0)], heads[min(j + 1, len(heads) - 1)])
+            whole.update(range(int(np.ceil(max(a, HeadSearchMin))), int(np.floor(b)) + 1))
+    return np.array(sorted(h for h in whole if h < max_H), dtype=float)
+    # }}} End of get_whole_heads
+
+def search_head(evaluate, key, scans, scanned, whole, tolerance=HeadSearchTolerance): # {{{
+    '''
+    Finds the head of the optimum scheme for the economic factor key.
+    evaluate is a HeadEvaluator, scans from get_head_scans() and scanned the results
+      of evaluating all of them, and whole the results of evaluating the heads of
+      get_whole_heads() (or None), which are shared by every key.
+    Returns the scheme dict of the optimum, or None if no head could be an optimum.
+    '''
+    objective = get_objective(key)
+    f = lambda h: float(objective(evaluate(h)[key])[0])
+    candidates = get_candidates(key, scans, scanned)
+    if not candidates: return None
+
+    # The best scanned point, or whole metre around the candidates, stands unless a
+    #   narrowed bracket beats it
+    (best_value, n, i, j) = candidates[0]
+    best = get_scheme(scanned, j)
+    if whole is not None:
+        values = objective(whole[key])
+        k = int(np.argmin(values))
+        if values[k] <= best_value: (best, best_value) = (get_scheme(whole, k), values[k])
+    for (value, n, i, j) in candidates[:HeadSearchCandidates]:
+        heads = scans[n]
+        # Each side on its own, a jump inside a bracket would lead Brent's method away
+        for (a, b) in [(heads[max(i - 1, 0)], heads[i]),
+                       (heads[i], heads[min(i + 1, len(heads) - 1)])]:
+            if b <= a: continue
+            (x, fx) = _brent(f, a, b, tolerance)
+            if fx < best_value: (best, best_value) = (get_scheme(evaluate(x), 0), fx)
+
+    return best
+    # }}} End of search_head
+
+def run_head_search(params, pipe_table, tolerance=HeadSearchTolerance): # {{{
+    '''
+    Finds the optimum schemes over continuous heads.
+    Returns a dict like EPIC.run_epic() without the per head axes, plus evaluations,
+      the number of heads which were evaluated.
+    '''
+    if params.heads:
+        raise ValueError('--head_search finds its own heads, so cannot be used with --heads')
+    (heads, max_H) = EPIC.get_heads(params)
+    evaluate = HeadEvaluator(params, pipe_table)
+    schemes = dict((key, dict(EMPTY_SCHEME)) for (key, better, initial, condition) in OPTIMUM_FACTORS)
+    if max_H > HeadSearchMin: # Otherwise there are no heads, as in the integer scan
+        scans = get_head_scans(get_head_pieces(params, HeadSearchMin, max_H, tolerance))
+        (scans, scanned) = split_at_pipe_changes(evaluate, scans, evaluate(np.concatenate(scans)),
+                                                 tolerance)
+        heads = get_whole_heads(scans, scanned, max_H)
+        whole = evaluate(heads) if len(heads) else None
+        for (key, better, initial, condition) in OPTIMUM_FACTORS:
+            schemes[key] = search_head(evaluate, key, scans, scanned, whole, tolerance) or \
+                           schemes[key]
+
+    return {'max_H'         : max_H,
+            'schemes'       : schemes,
+            'head_schemes'  : [],
+            'evaluations'   : evaluate.evaluations}
+    # }}} End of run_head_search
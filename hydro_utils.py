@@ -4,11 +4,71 @@
 # This allows EPIC to be easier to read
 from constants import *
 from math import pi, sqrt, log
+import profiling
+
+_counters = profiling.counters # Calls of the hot functions, see profiling.py
+
+# The catchment shapes which --catchment_type selects, added with
+#   register_catchment_shape(): catchment type -> (name, pieces, breaks).
+# The fractional area of a catchment above an intake Hz upstream of the powerhouse is
+#   pieces[i](cl, Hz) where breaks(cl)[i - 1] < Hz <= breaks(cl)[i], so a shape of n
+#   pieces has n - 1 breaks. The pieces only use arithmetic, so get_area() calls them
+#   with a float and hydro_vector.get_area_array() with an array of Hz.
+CATCHMENT_SHAPES = {}
+
+def register_catchment_shape(catch_type, name, pieces, breaks=None): # {{{
+    '''
+    Adds a catchment shape, see CATCHMENT_SHAPES.
+    pieces is a list of functions area(cl, Hz) and breaks a function of cl which
+      returns the increasing horizontal distances between them, one fewer than pieces.
+    '''
+    if breaks is None: breaks = lambda cl: []
+    CATCHMENT_SHAPES[catch_type] = (name, list(pieces), breaks)
+    # }}} End of register_catchment_shape
+
+def get_catchment_shape(catch_type): # {{{
+    '''
+    Returns (name, pieces, breaks) of the catchment type.
+    Raises ValueError if there is no such catchment type.
+    '''
+    if catch_type not in CATCHMENT_SHAPES:
+        raise ValueError('We don\'t have that catchment type: %s' % catch_type)
+    return CATCHMENT_SHAPES[catch_type]
+    # }}} End of get_catchment_shape
+
+def get_area_breaks(catch_type, cl): # {{{
+    '''
+    Returns the horizontal distances at which get_area() changes from one formula to
+      the next, where the area has a kink.
+    Raises ValueError if there is no such catchment type.
+    '''
+    (name, pieces, breaks) = get_catchment_shape(catch_type)
+    return list(breaks(cl))
+    # }}} End of get_area_breaks
+
+register_catchment_shape(1, 'Triangle',
+    [lambda cl, Hz: ((cl**2 * 0.5) - (Hz**2 * 0.5)) / (cl**2 * 0.5)])
+
+register_catchment_shape(2, 'Rectangle', # c by c/2
+    [lambda cl, Hz: ((cl**2 * 0.5) - (Hz * cl * 0.5)) / (cl**2 * 0.5)])
+
+register_catchment_shape(3, 'Pentagon',
+    # Intake is within rectangular section boundary
+    [lambda cl, Hz: ((3 * cl**2 / 8) - (Hz * cl * 0.5)) / (3 * cl**2 / 8),
+    # Intake is past rectangular section boundary
+     lambda cl, Hz: ((3 * cl**2 / 8) - (cl**2 / 4) - ((cl**2 / 8) - (cl - Hz)**2 * 0.5)) / (3 * cl**2 / 8)],
+    lambda cl: [cl / 2])
+
+register_catchment_shape(4, 'Hexagon',
+    [lambda cl, Hz: ((2 * cl**2 / 9) - (Hz**2 * 0.5)) / (2 * cl**2 / 9),
+     lambda cl, Hz: ((2 * cl**2 / 9) - (cl**2 / 18) - ((Hz - cl / 3) * (cl / 3))) / (2 * cl**2 / 9),
+     lambda cl, Hz: ((cl - Hz)**2 * 0.5) / (2 * cl**2 / 9)],
+    lambda cl: [cl / 3, 2 * cl / 3])
 
 def get_area(catch_type, cl, Hz, verbose): # {{{
     '''
     get_area() returns the fractional area of a catchment above the intake.
-    Catchment type is an integer which indicates the shape.
+    Catchment type is an integer which indicates the shape, see CATCHMENT_SHAPES.
     1: Triangle
     2: Rectangle
     3: Pentagon
@@ -16,59 +76,39 @@ def get_area(catch_type, cl, Hz, verbose): # {{{
     
     cl - catchment length
     Hz - Horizontal distance upstream from powerhouse
+    Raises ValueError if there is no such catchment type.
     '''
-    
-    if catch_type == 1: # Triangle
-        area = ((cl**2 * 0.5) - (Hz**2 * 0.5)) / (cl**2 * 0.5)
-        if verbose: print '\tcatch 1'
-        if verbose: print '\tArea = %(a)f' % {'a': area}
-    # End of Triangle
-    
-    elif catch_type == 2: # Rectangle c by c/2
-        area = ((cl**2 * 0.5) - (Hz * cl * 0.5)) / (cl**2 * 0.5)
-        if verbose: print '\tcatch 2'
-        if verbose: print '\tArea = %(a)f' % {'a': area}
-    # End of Rectangle
-    
-    elif catch_type == 3: # Pentagon
-        
-        if Hz <= cl / 2: # Intake is within rectangular section boundary
-            area = ((3 * cl**2 / 8) - (Hz * cl * 0.5)) / (3 * cl**2 / 8)
-            if verbose: print '\tcatch 3.1'
-            if verbose: print '\tArea = %(a)f' % {'a': area}
-        
-        else: # Intake is past rectangular section boundary
-            area = ((3 * cl**2 / 8) - (cl**2 / 4) - ((cl**2 / 8) - (cl - Hz)**2 * 0.5)) / (3 * cl**2 / 8)
-            if verbose: print '\tcatch 3.2'
-            if verbose: print '\tArea = %(a)f' % {'a': area}
-    # End of Pentagon
-    
-    
-    elif catch_type == 4: # Hexagon
-        
-        if Hz <= cl / 3:
-            area = ((2 * cl**2 / 9) - (Hz**2 * 0.5)) / (2 * cl**2 / 9)
-            if verbose: print '\tcatch 4.1'
-            if verbose: print '\tArea = %(a)f' % {'a': area}
-        
-        elif (cl / 3) < Hz and Hz <= (2 * cl / 3):
-            area = ((2 * cl**2 / 9) - (cl**2 / 18) - ((Hz - cl / 3) * (cl / 3))) / (2 * cl**2 / 9)
-            if verbose: print '\tcatch 4.2'
-            if verbose: print '\tArea = %(a)f' % {'a': area}
-        
-        else:
-            area = ((cl - Hz)**2 * 0.5) / (2 * cl**2 / 9)
-            if verbose: print '\tcatch 4.3'
-            if verbose: print '\tArea = %(a)f' % {'a': area}
-    # End of Hexagon
-    
-    else:
-        print 'We don\'t have that catchment type'
-        sys.exit(1) # We don't have that catchment type
-    
+    _counters['get_area'] += 1
+    (name, pieces, breaks) = get_catchment_shape(catch_type)
+
+    # The piece of the shape the intake is in
+    piece = 0
+    for b in breaks(cl):
+        if Hz <= b: break
+        piece += 1
+    area = pieces[piece](cl, Hz)
+
+    if verbose:
+        if len(pieces) == 1: print '\tcatch %d' % catch_type
+        else:                print '\tcatch %d.%d' % (catch_type, piece + 1)
+        print '\tArea = %(a)f' % {'a': area}
+
     return area
     # }}} End of get_area
 
+def get_evaporation(aar=0.0, aae=0.0): # {{{
+    '''
+    Returns the actual annual evaporation in mm.
+    aar - Anticipated annual rainfall in mm
+    aae - Anticipated (potential) annual evaporation in mm
+    Potential evaporation calculated from Layman's Guidebook - On How
+    To Develop A Small Hydro Site, Chapter 3, page 69.
+    '''
+    if aar < 850:
+        return (0.00061 * aar + 0.475) * aae
+    return aae
+    # }}} End of get_evaporation
+
 def get_scheme_capacity(head        = 0.0, # {{{
                         head_loss   = 0.0,
                         Q           = 0.0,
@@ -85,12 +125,18 @@ def get_scheme_annual_revenue(C     = 0.0, # {{{
                               P     = 0.0,
                               R     = 0.0,
                               interest = 0.0,
-                              total = 0.0):
+                              total = 0.0,
+                              E     = None):
     '''
     This returns the annual revenue for a scheme in GBP.
+    E is the energy generated in a year in kWh, from a flow series (see
+      flow_series.py). If it is None the capacity C is generated all year, times the
+      reliability R.
     '''
     # The whole scheme is on a loan which has annual servicing costs which must
     #   be taken from the annual revenue.
+    if E is not None:
+        return E * (FIT + P) - (interest * total)
     r = C * (365 * 24) * (FIT + P) * R - (interest * total)
     return r
     # }}} End of get_scheme_capacity
@@ -101,8 +147,11 @@ def get_head_loss(F=0.0, L=0.0, D=0.0, Q=0.0): # {{{
     L = Penstock Length
     Q = Design Flow
     D = Diameter
+    F, L, D and Q may be arrays, see hydro_vector.get_head_loss_array(), whose callers
+      count the values with profiling.count_array().
     '''
     h = F * L / D * Q**2 / (2 * G * (pi * (D / 2)**2 )**2)
+    _counters['get_head_loss'] += 1
     return h
     # }}} End of get_head_loss
 
@@ -116,13 +165,49 @@ def get_renaulds_number(Q=0.0, D=0.0): # {{{
     return r
     # }}} End of get_friction_coeff
 
-def get_friction_coeff(Q=0.0, D=0.0, E=0.0, M=''): # {{{
+def get_explicit_friction_coeff(Rn=0.0, D=0.0, E=0.0, method='swamee_jain'): # {{{
+    '''
+    Explicit approximations to the Colebrook-White equation, used on their own or as
+      the seed for get_friction_coeff().
+    Rn = Reynolds number
+    D = Diameter
+    E = Surface Roughness of pipe
+    method = swamee_jain or haaland
+    '''
+    if method == 'swamee_jain':
+        f = 0.25 / log((E / (3.7 * D)) + (5.74 / Rn**0.9), 10)**2
+    elif method == 'haaland':
+        f = (1 / (-1.8 * log((E / (3.7 * D))**1.11 + (6.9 / Rn), 10)))**2
+    else:
+        raise ValueError('Unknown explicit friction method: %s' % method)
+    return f
+    # }}} End of get_explicit_friction_coeff
+
+def get_friction_coeff(Q=0.0, D=0.0, E=0.0, M='', # {{{
+                       method            = 'fixed_point',
+                       seed              = None,
+                       tolerance         = FrictionTolerance,
+                       max_iterations    = FrictionMaxIterations,
+                       return_iterations = False):
     '''
     Q = Design Flow
     D = Diameter
     E = Surface Roughness of pipe
     M = Material of pipe (PVC, DI, GRP)
+
+    The Colebrook-White equation is solved by one of these methods:
+    fixed_point - substitute f back into the equation (the original method).
+    newton      - Newton-Raphson on 1/sqrt(f), normally converges in 2 or 3 iterations.
+    swamee_jain, haaland - explicit approximations, no iterations.
+    moody       - interpolated from the precomputed table in moody.py, no iterations.
+
+    seed is the starting friction factor for the iterative methods, either a number
+      or the name of an explicit method. The default is 1 for fixed_point and
+      swamee_jain for newton.
+    Iteration stops once the relative change in f is no more than tolerance, or after
+      max_iterations. If return_iterations is set (f, iterations) is returned.
     '''
+    _counters['get_friction_coeff'] += 1
     f = 0.0
     Rn = get_renaulds_number(Q = Q, D = D)
 
@@ -131,21 +216,156 @@ def get_friction_coeff(Q=0.0, D=0.0, E=0.0, M=''): # {{{
     ####    f = 0.079 / Rn**0.25
     ####
     ####elif M == 'DI' or M == 'GRP':
-    if True: # Just a place holder to use the same eqn for all
-        area_of_pipe = pi * (D / 2)**2
-        
-        seed = 1
-        iterations = 100
-
-        fl = []
-        fl.append(float(seed))
-        for i in range(1, iterations):
-            f = ((1) / (-2 * log((  (E / (3.7 * D)) + (2.51 / (Rn * sqrt(fl[i-1])))   ), 10)))**2
-            fl.append(f)
+    if method in ('swamee_jain', 'haaland'):
+        f = get_explicit_friction_coeff(Rn = Rn, D = D, E = E, method = method)
+        if return_iterations: return (f, 0)
+        return f
+
+    if method == 'moody':
+        from moody import get_moody_friction_coeff # Needs NumPy, so only when asked for
+        f = get_moody_friction_coeff(Q = Q, D = D, E = E)
+        if return_iterations: return (f, 0)
+        return f
 
+    if seed is None:
+        if method == 'newton': seed = 'swamee_jain'
+        else:                  seed = 1
+    if isinstance(seed, str):
+        f = get_explicit_friction_coeff(Rn = Rn, D = D, E = E, method = seed)
+    else:
+        f = float(seed)
+
+    a = E / (3.7 * D)
+    b = 2.51 / Rn
+    iterations = 0
+
+    if method == 'fixed_point':
+        while iterations < max_iterations - 1:
+            f_last = f
+            f = ((1) / (-2 * log((  a + (b / sqrt(f_last))   ), 10)))**2
+            iterations += 1
+            if abs(f - f_last) <= tolerance * f: break
+
+    elif method == 'newton':
+        # g(x) = x + 2 s log10(a + b x) = 0 where x = 1/sqrt(f). The fixed point
+        #   iteration squares away the sign of the log, so when the roughness term a is
+        #   1 or more (very rough, small pipes) the root is on the s = -1 branch.
+        x = 1 / sqrt(f)
+        s = 1 if a < 1 else -1
+        while iterations < max_iterations - 1:
+            g = x + 2 * s * log(a + b * x, 10)
+            dg = 1 + 2 * s * b / ((a + b * x) * log(10))
+            x_last = x
+            x = x - g / dg
+            # Damp the step if it leaves the domain of the log (low Reynolds numbers)
+            while x <= 0 or a + b * x <= 0:
+                x = 0.5 * (x + x_last)
+            iterations += 1
+            if abs(x - x_last) <= 0.5 * tolerance * x: break # |df/f| ~ 2|dx/x|
+        f = 1 / x**2
+
+    else:
+        raise ValueError('Unknown friction method: %s' % method)
+
+    _counters['friction_iterations'] += iterations
+    if return_iterations: return (f, iterations)
     return f
     # }}} End of get_friction_coeff
     
+def get_pipe_for_diameter(head               = 0.0, # {{{
+                          diameter           = 0.0,
+                          costs              = [],
+                          catalogue          = None,
+                          design_flow        = 0.0,
+                          penstock_length    = 0.0,
+                          FIT                = 0.0,
+                          efficiency         = 0.0,
+                          market_price       = 0.0,
+                          interest           = 0.0,
+                          verbose            = True,
+                          friction_method    = 'fixed_point',
+                          friction_tolerance = FrictionTolerance):
+    '''
+    This returns the preferred pipe of one diameter of the catalogue (a pipes.PipeCatalogue),
+      given the cost/m of each of its materials, with its costs.
+    '''
+    pipe = {'diameter'              : diameter,
+            'material'              : '',
+            'head_loss'             : 0.0,
+            'annual_head_loss_cost' : 0.0,
+            'annual_capital_cost'   : 0.0,
+            'total_annual_cost'     : float('inf')} # Total Annual Cost is just the sum
+                                                    #   of head loss and capital costs.
+
+    if verbose: print '\tDiameter = ', diameter
+    for (material, cost) in zip(catalogue.materials, costs):
+        if verbose: print '\t\t%s Cost/m = ' % material, cost
+
+    # This condition means that if a preferred material (PVC) is available (according to
+    #   head and diameter constraints) then always use it. Otherwise the cheapest of the
+    #   rest, the later material winning a tie. Materials with no cost are not available.
+    properties = catalogue.properties()
+    materials = [k for (k, (E, preferred, max_head, max_diameter)) in enumerate(properties)
+                 if costs[k] == costs[k] and preferred and head <= max_head and
+                 diameter <= max_diameter][:1]
+    if not materials:
+        materials = [k for (k, (E, preferred, max_head, max_diameter)) in enumerate(properties)
+                     if costs[k] == costs[k] and not preferred]
+
+    for k in materials:
+        material = catalogue.materials[k]
+        annual_capital_cost = penstock_length * costs[k] * interest
+
+        friction_coeff = get_friction_coeff(Q = design_flow, D = diameter, E = properties[k][0],
+                                            M = material, method = friction_method,
+                                            tolerance = friction_tolerance)
+        if verbose: print '\t\t%s friction coeff = ' % material, friction_coeff
+
+        head_loss = get_head_loss(F = friction_coeff, L = penstock_length, D = diameter, Q = design_flow)
+
+        annual_head_loss_cost = head_loss * design_flow * G * efficiency * (365 * 24) * (FIT + market_price)
+
+        total_annual_cost = annual_capital_cost + annual_head_loss_cost
+
+        if verbose: print '\t\t%s head loss = ' % material, head_loss
+        if verbose: print '\t\t%s annual head loss cost = ' % material, annual_head_loss_cost
+        if verbose: print '\t\t%s annual capital cost = ' % material, annual_capital_cost
+        if verbose: print '\t\t%s total annual cost = ' % material, total_annual_cost
+
+        if pipe['material'] == '' or not total_annual_cost > pipe['total_annual_cost']:
+            pipe['annual_capital_cost']     = annual_capital_cost
+            pipe['annual_head_loss_cost']   = annual_head_loss_cost
+            pipe['head_loss']               = head_loss
+            pipe['material']                = material
+            pipe['total_annual_cost']       = total_annual_cost
+
+    return pipe
+    # }}} End of get_pipe_for_diameter
+
+def get_pipe_search_order(catalogue, head): # {{{
+    '''
+    Returns [(cost/m, row index)] for the rows of the catalogue, cheapest first, where
+      cost/m is the cheapest material a pipe of that diameter may be made of at head.
+      Rows where no material has a cost are left out, they can never be chosen.
+    The catalogue is only sorted once for each set of materials the head allows.
+    '''
+    allowed = tuple(head <= max_head for (E, p, max_head, max_diameter) in catalogue.properties())
+    if allowed in catalogue.search_orders: return catalogue.search_orders[allowed]
+
+    order = []
+    for (i, (diameter, costs)) in enumerate(catalogue.rows()):
+        properties = zip(costs, allowed, catalogue.properties())
+        preferred = [c for (c, ok, (E, p, max_head, max_diameter)) in properties
+                     if c == c and p and ok and diameter <= max_diameter][:1]
+        others = [c for (c, ok, (E, p, max_head, max_diameter)) in properties if c == c and not p]
+        costs = preferred or others # NaN never equals itself
+        if costs: order.append((min(costs), i))
+    order.sort()
+
+    catalogue.search_orders[allowed] = order
+    return order
+    # }}} End of get_pipe_search_order
+
 def get_optimum_pipe_for_head(head               = 0.0, # {{{
                               pipe_table         = [],
                               design_flow        = 0.0,
@@ -154,11 +374,30 @@ def get_optimum_pipe_for_head(head               = 0.0, # {{{
                               efficiency         = 0.0,
                               market_price       = 0.0,
                               interest           = 0.0,
-                              verbose            = True):
+                              verbose            = True,
+                              friction_method    = 'fixed_point',
+                              friction_tolerance = FrictionTolerance,
+                              search             = 'exhaustive'):
     '''
     This iterates through the entries in pipe_table and returns the most cost efficient diameter,
       material, and its associated cost.
+    pipe_table is a pipes.PipeCatalogue, or rows of (diameter, PVC, DI, GRP) cost/m.
+    friction_method and friction_tolerance are passed to get_friction_coeff().
+
+    search is how the diameters are searched:
+    exhaustive - every row of pipe_table, in order (the original method).
+    bound      - branch and bound. The head loss cost is never negative, so the capital
+                 cost of a pipe is a lower bound on its total annual cost. The rows are
+                 tried cheapest capital cost first and the search stops once the capital
+                 cost alone is more than the best total annual cost found. The pipe is
+                 exactly the one the exhaustive search finds, including which of two
+                 pipes of equal cost is chosen.
+    The returned pipe has 'skipped', the number of diameters which were not evaluated.
     '''
+    from pipes import get_pipe_catalogue # Needs NumPy, hydro_utils does not otherwise
+    catalogue = get_pipe_catalogue(pipe_table)
+    rows = catalogue.rows()
+
     optimum_pipe = {'diameter'              : 0.0,
                     'material'              : '',
                     'head_loss'             : 0.0,
@@ -166,112 +405,61 @@ def get_optimum_pipe_for_head(head               = 0.0, # {{{
                     'annual_capital_cost'   : 0.0,
                     'total_annual_cost'     : 999999999.9} # Total Annual Cost is just the sum
                                                    #   of head loss and capital costs.
-    
-    for (diameter, pvc, di, grp) in pipe_table: # {{{
-        diameter    = float(diameter)
-        pvc         = float(pvc)
-        di          = float(di)
-        grp         = float(grp)
-        total_annual_cost = 0
-        
-        if verbose: print '\tDiameter = ', diameter
-        if verbose: print '\t\tPVC Cost/m = ', pvc
-        if verbose: print '\t\tDI  Cost/m = ', di
-        if verbose: print '\t\tGRP Cost/m = ', grp
-        
-        pipe = {'diameter'              : diameter,
-                'material'              : '',
-                'head_loss'             : 0.0,
-                'annual_head_loss_cost' : 0.0,
-                'annual_capital_cost'   : 0.0,
-                'total_annual_cost'     : 0.0} # Total Annual Cost is just the sum
-                                               #   of head loss and capital costs.
-
-        # This condition means that if PVC is available (according to head and diameter constraints)
-        #   then always use it.
-        if head <= PVC_Constraint_MaxHead and diameter <= PVC_Constraint_MaxDiameter:
-            # PVC {{{
-            annual_capital_cost_pvc = penstock_length * pvc * interest
-
-            friction_coeff = get_friction_coeff(Q = design_flow, D = diameter, E = E_PVC, M = 'PVC')
-            if verbose: print '\t\tPVC friction coeff = ', friction_coeff
-            
-            head_loss_pvc = get_head_loss(F = friction_coeff, L = penstock_length, D = diameter, Q = design_flow)
-            
-            annual_head_loss_cost_pvc = head_loss_pvc * design_flow * G * efficiency * (365 * 24) * (FIT + market_price)
-
-            total_annual_cost = annual_capital_cost_pvc + annual_head_loss_cost_pvc
-            
-            if verbose: print '\t\tPVC head loss = ', head_loss_pvc
-            if verbose: print '\t\tPVC annual head loss cost = ', annual_head_loss_cost_pvc
-            if verbose: print '\t\tPVC annual capital cost = ', annual_capital_cost_pvc
-            if verbose: print '\t\tPVC total annual cost = ', total_annual_cost
-            # }}} End of PVC
-            pipe['annual_capital_cost']     = annual_capital_cost_pvc
-            pipe['annual_head_loss_cost']   = annual_head_loss_cost_pvc
-            pipe['head_loss']               = head_loss_pvc
-            pipe['material']                = 'PVC'
-        
-        else:
-            # Ductile Iron {{{
-            annual_capital_cost_di = penstock_length * di * interest
-
-            friction_coeff = get_friction_coeff(Q = design_flow, D = diameter, E = E_DI, M = 'DI')
-            if verbose: print '\t\tDI friction coeff = ', friction_coeff
-            
-            head_loss_di = get_head_loss(F = friction_coeff, L = penstock_length, D = diameter, Q = design_flow)
-            
-            annual_head_loss_cost_di = head_loss_di * design_flow * G * efficiency * (365 * 24) * (FIT + market_price)
-
-            total_annual_cost_di = annual_capital_cost_di + annual_head_loss_cost_di
-            
-            if verbose: print '\t\tDI head loss = ', head_loss_di
-            if verbose: print '\t\tDI annual head loss cost = ', annual_head_loss_cost_di
-            if verbose: print '\t\tDI annual capital cost = ', annual_capital_cost_di
-            if verbose: print '\t\tDI total annual cost = ', total_annual_cost_di
-            # }}} End of Ductile Iron
-            # Glass Reinforced Plastic {{{
-            annual_capital_cost_grp = penstock_length * grp * interest
-            
-            friction_coeff = get_friction_coeff(Q = design_flow, D = diameter, E = E_GRP, M = 'GRP')
-            if verbose: print '\t\tGRP friction coeff = ', friction_coeff
-            
-            head_loss_grp = get_head_loss(F = friction_coeff, L = penstock_length, D = diameter, Q = design_flow)
-            
-            annual_head_loss_cost_grp = head_loss_grp * design_flow * G * efficiency * (365 * 24) * (FIT + market_price)
-
-            total_annual_cost_grp = annual_capital_cost_grp + annual_head_loss_cost_grp
-            
-            if verbose: print '\t\tGRP head loss = ', head_loss_grp
-            if verbose: print '\t\tGRP annual head loss cost = ', annual_head_loss_cost_grp
-            if verbose: print '\t\tGRP annual capital cost = ', annual_capital_cost_grp
-            if verbose: print '\t\tGRP total annual cost = ', total_annual_cost_grp
-            # }}} End of Glass Reinforced Plastic
-
-            if total_annual_cost_grp > total_annual_cost_di:
-                total_annual_cost = total_annual_cost_di
-                pipe['annual_capital_cost']     = annual_capital_cost_di
-                pipe['annual_head_loss_cost']   = annual_head_loss_cost_di
-                pipe['head_loss']               = head_loss_di
-                pipe['material']                = 'DI'
-            else:
-                total_annual_cost = total_annual_cost_grp
-                pipe['annual_capital_cost']     = annual_capital_cost_grp
-                pipe['annual_head_loss_cost']   = annual_head_loss_cost_grp
-                pipe['head_loss']               = head_loss_grp
-                pipe['material']                = 'GRP'
-        
-        # Now we have the total_annual_cost for a given head/diameter
-        pipe['total_annual_cost'] = total_annual_cost
-
-        # Our preferred pipe for this diameter is now chosen
-        
-        # Now we get the preferred pipe for the given head
-        #   by choosing from a range of pipes of different diameters.
-        if pipe['total_annual_cost'] < optimum_pipe['total_annual_cost']:
-            optimum_pipe = pipe
-
-        # }}} End of for each diameter
+
+    args = {'head'               : head,
+            'catalogue'          : catalogue,
+            'design_flow'        : design_flow,
+            'penstock_length'    : penstock_length,
+            'FIT'                : FIT,
+            'efficiency'         : efficiency,
+            'market_price'       : market_price,
+            'interest'           : interest,
+            'verbose'            : verbose,
+            'friction_method'    : friction_method,
+            'friction_tolerance' : friction_tolerance}
+
+    # The bound only holds if the head loss cost cannot be negative and the capital
+    #   cost rises with the cost/m
+    if search == 'bound' and (efficiency * (FIT + market_price) < 0 or
+                              penstock_length * interest < 0):
+        search = 'exhaustive'
+
+    if search == 'exhaustive':
+        for (diameter, costs) in rows: # {{{
+            pipe = get_pipe_for_diameter(diameter = diameter, costs = costs, **args)
+
+            # Our preferred pipe for this diameter is now chosen
+
+            # Now we get the preferred pipe for the given head
+            #   by choosing from a range of pipes of different diameters.
+            if pipe['total_annual_cost'] < optimum_pipe['total_annual_cost']:
+                optimum_pipe = pipe
+
+            # }}} End of for each diameter
+        optimum_pipe['skipped'] = 0
+
+    elif search == 'bound':
+        best_row = None
+        evaluated = 0
+        for (cost_per_m, i) in get_pipe_search_order(catalogue, head): # {{{
+            # Every row from here on costs at least this much. On an exact tie the
+            #   exhaustive search keeps the first row, so one may still win.
+            if penstock_length * cost_per_m * interest > optimum_pipe['total_annual_cost']: break
+
+            (diameter, costs) = rows[i]
+            pipe = get_pipe_for_diameter(diameter = diameter, costs = costs, **args)
+            evaluated += 1
+
+            if pipe['total_annual_cost'] < optimum_pipe['total_annual_cost'] or \
+               (best_row is not None and i < best_row and
+                pipe['total_annual_cost'] == optimum_pipe['total_annual_cost']):
+                optimum_pipe = pipe
+                best_row = i
+            # }}} End of for each diameter
+        optimum_pipe['skipped'] = len(rows) - evaluated
+
+    else:
+        raise ValueError('Unknown pipe search: %s' % search)
 
     return optimum_pipe
     # }}} End of get_optimum_pipe_for_head 
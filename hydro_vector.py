@@ -0,0 +1,566 @@
+# hydro_vector.py
+# This file contains array versions of the calculations in hydro_utils.py and of the
+# per-head loop in EPIC.py. Every head, diameter and material is evaluated in one go
+# using NumPy broadcasting rather than one head at a time in pure Python.
+#
+# Shape convention: anything derived from the head (penstock length, Hz, design flow,
+# FIT, ...) has the shape of the heads array. Anything which also depends on the pipe
+# has one extra trailing axis, the rows of pipe_table. Parameters in opts may be arrays
+# which broadcast against the heads, so many parameter sets are evaluated at once.
+#
+# The results agree with the scalar path in EPIC.py to VECTOR_RTOL of each value, with
+# an absolute floor of VECTOR_ATOL of the largest value of its axis, as checked by
+# get_engine_errors() and './bench_hot_paths.py check'. The only difference is the order
+# of floating point operations, but where the head loss nearly takes up the whole head
+# the net head, and so the capacity, loses most of its significant digits: near a
+# capacity of 0 only the floor holds. The cost per kW is divided by the capacity, so it
+# is held to the relative error allowed the capacity. The optimum schemes are the same.
+import numpy as np
+from math import radians as rad
+from constants import *
+from hydro_utils import get_head_loss, get_renaulds_number, \
+                        get_scheme_capacity, get_scheme_annual_revenue, \
+                        get_catchment_shape, get_area_breaks, flow_duration_curve
+from pipes import get_pipe_catalogue
+from flow_series import get_annual_energy
+import profiling
+
+# Tolerance to which the vector engine matches the scalar engine: relative, and absolute
+#   as a fraction of the largest value of the axis
+VECTOR_RTOL = 1e-8
+VECTOR_ATOL = 1e-8
+
+# Materials in the order of the columns of the original pipe files
+MATERIALS = [m[0] for m in PipeMaterials]
+
+def get_area_array(catch_type, cl, Hz): # {{{
+    '''
+    Array version of hydro_utils.get_area(). Hz may be an array of horizontal
+      distances upstream from the powerhouse, the fractional areas are returned
+      with the same shape. Where the distances increase, as they do with the heads,
+      each piece of the shape is only worked out for the slice of them it covers.
+    Raises ValueError if there is no such catchment type.
+    '''
+    (name, pieces, breaks) = get_catchment_shape(catch_type)
+    Hz = np.asarray(Hz, dtype=float)
+    profiling.count_array('get_area', Hz.size)
+    if len(pieces) == 1: return pieces[0](cl, Hz)
+    cuts = breaks(cl)
+
+    # breaks[i - 1] < Hz <= breaks[i] is piece i, as get_area()
+    flat = Hz.ravel()
+    if flat.size > 1 and not (flat[1:] >= flat[:-1]).all():
+        return np.select([Hz <= b for b in cuts], [area_of(cl, Hz) for area_of in pieces[:-1]],
+                         pieces[-1](cl, Hz))
+    edges = [0] + np.searchsorted(flat, cuts, side='right').tolist() + [flat.size]
+    area = np.empty(flat.shape)
+    for (k, area_of) in enumerate(pieces):
+        (start, stop) = (edges[k], edges[k + 1])
+        if start < stop: area[start:stop] = area_of(cl, flat[start:stop])
+    return area.reshape(Hz.shape)
+    # }}} End of get_area_array
+
+def get_evaporation_array(aar=0.0, aae=0.0): # {{{
+    '''
+    Array version of hydro_utils.get_evaporation().
+    '''
+    return np.where(np.asarray(aar) < 850, (0.00061 * np.asarray(aar) + 0.475) * aae, aae)
+    # }}} End of get_evaporation_array
+
+def get_explicit_friction_coeff_array(Rn=0.0, D=0.0, E=0.0, method='swamee_jain'): # {{{
+    '''
+    Array version of hydro_utils.get_explicit_friction_coeff().
+    '''
+    if method == 'swamee_jain':
+        f = 0.25 / np.log10((E / (3.7 * D)) + (5.74 / Rn**0.9))**2
+    elif method == 'haaland':
+        f = (1 / (-1.8 * np.log10((E / (3.7 * D))**1.11 + (6.9 / Rn))))**2
+    else:
+        raise ValueError('Unknown explicit friction method: %s' % method)
+    return f
+    # }}} End of get_explicit_friction_coeff_array
+
+def get_friction_coeff_array(Q=0.0, D=0.0, E=0.0, # {{{
+                             method            = 'fixed_point',
+                             seed              = None,
+                             tolerance         = FrictionTolerance,
+                             max_iterations    = FrictionMaxIterations,
+                             return_iterations = False):
+    '''
+    Array version of hydro_utils.get_friction_coeff(), which describes the arguments.
+    Q, D and E are broadcast against each other so many (Q, D, E) triples are solved
+      at once. Iteration stops when every element has converged, and if
+      return_iterations is set (f, iterations) is returned where iterations is an
+      integer array of the iterations each element needed.
+    '''
+    Q = np.asarray(Q, dtype=float)
+    D = np.asarray(D, dtype=float)
+    E = np.asarray(E, dtype=float)
+    Rn = get_renaulds_number(Q = Q, D = D)
+    shape = np.broadcast(Q, D, E).shape
+    iterations = np.zeros(shape, dtype=int)
+    profiling.count_array('get_friction_coeff', iterations.size)
+
+    if method in ('swamee_jain', 'haaland'):
+        f = np.broadcast_to(get_explicit_friction_coeff_array(Rn, D, E, method), shape)
+        if return_iterations: return (f, iterations)
+        return f
+
+    if method == 'moody':
+        from moody import get_moody_friction_coeff # moody.py imports this module
+        f = np.broadcast_to(get_moody_friction_coeff(Q = Q, D = D, E = E), shape)
+        if return_iterations: return (f, iterations)
+        return f
+
+    if seed is None:
+        if method == 'newton': seed = 'swamee_jain'
+        else:                  seed = 1
+    if isinstance(seed, str):
+        f = np.array(np.broadcast_to(get_explicit_friction_coeff_array(Rn, D, E, seed), shape))
+    else:
+        f = np.empty(shape)
+        f.fill(seed)
+
+    a = np.broadcast_to(E / (3.7 * D), shape)
+    b = np.broadcast_to(2.51 / Rn, shape)
+    active = np.ones(shape, dtype=bool)
+
+    if method == 'fixed_point':
+        x = f
+        s = a # Not used by the fixed point step
+        step = lambda x, a, b, s: (1 / (-2 * np.log10(a + (b / np.sqrt(x)))))**2
+        rtol = tolerance
+    elif method == 'newton':
+        # g(x) = x + 2 s log10(a + b x) = 0 where x = 1/sqrt(f), see get_friction_coeff()
+        x = np.array(1 / np.sqrt(f))
+        s = np.where(a < 1, 1.0, -1.0)
+        def step(x, a, b, s):
+            x_next = x - (x + 2 * s * np.log10(a + b * x)) / \
+                         (1 + 2 * s * b / ((a + b * x) * np.log(10)))
+            # Damp the step if it leaves the domain of the log (low Reynolds numbers)
+            bad = (x_next <= 0) | (a + b * x_next <= 0)
+            while bad.any():
+                x_next = np.where(bad, 0.5 * (x_next + x), x_next)
+                bad = (x_next <= 0) | (a + b * x_next <= 0)
+            return x_next
+        rtol = 0.5 * tolerance # |df/f| ~ 2|dx/x|
+    else:
+        raise ValueError('Unknown friction method: %s' % method)
+
+    # Only the elements which have not converged yet are carried into the next iteration
+    for i in range(1, max_iterations):
+        x_last = x[active]
+        x_next = step(x_last, a[active], b[active], s[active])
+        x[active] = x_next
+        iterations[active] += 1
+        still = np.abs(x_next - x_last) > rtol * np.abs(x_next)
+        if still.all(): continue
+        active[active] = still
+        if not active.any(): break
+
+    if method == 'newton': f = 1 / x**2
+    else:                  f = x
+    profiling.counters['friction_iterations'] += int(iterations.sum())
+
+    if return_iterations: return (f, iterations)
+    return f
+    # }}} End of get_friction_coeff_array
+
+def get_head_loss_array(design_flow, penstock_length, diameter, E, # {{{
+                        friction_method='fixed_point', friction_tolerance=FrictionTolerance):
+    '''
+    Returns the head loss of one material for every head against every diameter.
+    Head derived arguments have the shape of the heads, diameter is 1-D.
+    '''
+    Q = design_flow[..., np.newaxis]
+    L = penstock_length[..., np.newaxis]
+    friction_coeff = get_friction_coeff_array(Q = Q, D = diameter, E = E,
+                                              method = friction_method,
+                                              tolerance = friction_tolerance)
+    head_loss = get_head_loss(F = friction_coeff, L = L, D = diameter, Q = Q)
+    profiling.count_array('get_head_loss', head_loss.size, counted=True)
+    return head_loss
+    # }}} End of get_head_loss_array
+
+def get_head_losses_array(catalogue, design_flow, penstock_length, # {{{
+                          friction_method='fixed_point', friction_tolerance=FrictionTolerance):
+    '''
+    Returns a list of the head loss of each material of the catalogue for every head
+      against every diameter. These only depend on the flows and the friction, not on
+      the prices, so they can be kept while the prices change.
+    '''
+    return [get_head_loss_array(design_flow, penstock_length, catalogue.diameter, E,
+                                friction_method, friction_tolerance)
+            for E in catalogue.roughness]
+    # }}} End of get_head_losses_array
+
+def get_pipe_costs_array(head, diameter, price, E, design_flow, penstock_length, # {{{
+                         FIT, efficiency, market_price, interest,
+                         friction_method='fixed_point', friction_tolerance=FrictionTolerance,
+                         head_loss=None):
+    '''
+    Returns the annual capital cost, head loss, annual head loss cost and total annual
+      cost of one material for every head against every diameter.
+    Head derived arguments have the shape of the heads, pipe arguments are 1-D.
+    efficiency, market_price and interest may be scalars or arrays which broadcast
+      against the heads (e.g. one row per Monte Carlo sample).
+    head_loss is the head loss from get_head_loss_array(), worked out if it is None.
+    '''
+    Q = design_flow[..., np.newaxis]
+    L = penstock_length[..., np.newaxis]
+    efficiency   = np.asarray(efficiency)[..., np.newaxis]
+    market_price = np.asarray(market_price)[..., np.newaxis]
+    interest     = np.asarray(interest)[..., np.newaxis]
+
+    annual_capital_cost = L * price * interest
+
+    if head_loss is None:
+        head_loss = get_head_loss_array(design_flow, penstock_length, diameter, E,
+                                        friction_method, friction_tolerance)
+
+    annual_head_loss_cost = head_loss * Q * G * efficiency * (365 * 24) * \
+                            (FIT[..., np.newaxis] + market_price)
+
+    total_annual_cost = annual_capital_cost + annual_head_loss_cost
+
+    return (annual_capital_cost, head_loss, annual_head_loss_cost, total_annual_cost)
+    # }}} End of get_pipe_costs_array
+
+def get_material_choice_array(catalogue, head, total_annual_cost): # {{{
+    '''
+    Chooses the material of every head and diameter, see pipes.py.
+    total_annual_cost is a list of the costs of each material of the catalogue for every
+      head against every diameter.
+    Returns an array of the index of the material, or -1 where none is available.
+    '''
+    head = np.asarray(head)[..., np.newaxis]
+    diameter = catalogue.diameter
+    material = np.empty(np.broadcast(head, diameter).shape, dtype=int)
+    material.fill(-1)
+
+    # If a preferred material (PVC) is available (according to head and diameter
+    #   constraints) then always use it
+    preferred = np.zeros(material.shape, dtype=bool)
+    for k in np.flatnonzero(catalogue.preferred):
+        use = ~preferred & ~np.isnan(catalogue.cost[k]) & \
+              (head <= catalogue.max_head[k]) & (diameter <= catalogue.max_diameter[k])
+        material = np.where(use, k, material)
+        preferred |= use
+
+    # Otherwise the cheapest of the others, with the later material winning a tie
+    best = np.empty(material.shape)
+    best.fill(np.inf)
+    for k in np.flatnonzero(~catalogue.preferred):
+        with np.errstate(invalid='ignore'): # Costs of unavailable pipes are NaN
+            cheaper = ~(total_annual_cost[k] > best)
+        use = ~preferred & ~np.isnan(catalogue.cost[k]) & cheaper
+        material = np.where(use, k, material)
+        best = np.where(use, total_annual_cost[k], best)
+
+    return material
+    # }}} End of get_material_choice_array
+
+def get_optimum_pipe_array(head             = 0.0, # {{{
+                           pipe_table       = [],
+                           design_flow      = 0.0,
+                           penstock_length  = 0.0,
+                           FIT              = 0.0,
+                           efficiency       = 0.0,
+                           market_price     = 0.0,
+                           interest         = 0.0,
+                           friction_method  = 'fixed_point',
+                           friction_tolerance = FrictionTolerance,
+                           head_losses      = None):
+    '''
+    Array version of hydro_utils.get_optimum_pipe_for_head().
+    head_losses are from get_head_losses_array(), worked out if they are None.
+    Returns a dict of arrays with the shape of head: diameter, material (an index into
+      the materials of the catalogue), head_loss, annual_head_loss_cost, annual_capital_cost and
+      total_annual_cost.
+    '''
+    head            = np.asarray(head, dtype=float)
+    design_flow     = np.asarray(design_flow, dtype=float)
+    penstock_length = np.asarray(penstock_length, dtype=float)
+    FIT             = np.asarray(FIT, dtype=float)
+
+    catalogue = get_pipe_catalogue(pipe_table)
+    diameter = catalogue.diameter
+
+    args = (design_flow, penstock_length, FIT, efficiency, market_price, interest,
+            friction_method, friction_tolerance)
+    if head_losses is None: head_losses = [None] * len(catalogue.materials)
+    costs = [get_pipe_costs_array(head, diameter, catalogue.cost[k], catalogue.roughness[k], *args,
+                                  head_loss=head_losses[k])
+             for k in range(len(catalogue.materials))]
+
+    material = get_material_choice_array(catalogue, head, [c[3] for c in costs])
+    chosen = []
+    for field in range(4):
+        value = np.zeros(material.shape)
+        for (k, c) in enumerate(costs):
+            value = np.where(material == k, c[field], value)
+        chosen.append(value)
+    (annual_capital_cost, head_loss, annual_head_loss_cost, total_annual_cost) = chosen
+    total_annual_cost = np.where(material < 0, np.inf, total_annual_cost)
+
+    # The scalar path keeps the first diameter with the strictly smallest cost, which
+    #   is what argmin does.
+    total_annual_cost = np.where(np.isnan(total_annual_cost), np.inf, total_annual_cost)
+    best = np.argmin(total_annual_cost, axis=-1)[..., np.newaxis]
+    take = lambda a: np.take_along_axis(np.broadcast_to(a, material.shape), best, axis=-1)[..., 0]
+
+    optimum_pipe = {'diameter'              : take(diameter),
+                    'material'              : take(material),
+                    'head_loss'             : take(head_loss),
+                    'annual_head_loss_cost' : take(annual_head_loss_cost),
+                    'annual_capital_cost'   : take(annual_capital_cost),
+                    'total_annual_cost'     : take(total_annual_cost)}
+
+    # No pipe beat the initial cost in the scalar path
+    none = optimum_pipe['total_annual_cost'] >= 999999999.9
+    if none.any():
+        for key in optimum_pipe:
+            optimum_pipe[key] = np.where(none, 0, optimum_pipe[key])
+        optimum_pipe['total_annual_cost'] = np.where(none, 999999999.9,
+                                                     optimum_pipe['total_annual_cost'])
+        optimum_pipe['material'] = np.where(none, -1, optimum_pipe['material'])
+
+    return optimum_pipe
+    # }}} End of get_optimum_pipe_array
+
+def get_head_geometry(heads, opts): # {{{
+    '''
+    Returns a dict of the parts of evaluate_heads() which depend only on the head and
+      the slope: head, penstock_length and Hz, the horizontal distance to the intake.
+    '''
+    h = np.asarray(heads, dtype=float)
+    return {'head'              : h,
+            'penstock_length'   : h / np.sin(rad(opts.slope)),
+            'Hz'                : h / np.tan(rad(opts.slope))}
+    # }}} End of get_head_geometry
+
+def get_fit_array(design_flow, head): # {{{
+    '''
+    Returns the feed in tariff of schemes with the design flows at the heads.
+    '''
+    # The Hydro Estimation Parameter (HEP) quickly estimates the capacity in kW
+    capacity_estimate = design_flow * head * HEP
+    return np.where(capacity_estimate <= 100, GTHigh, GTLow)
+    # }}} End of get_fit_array
+
+def get_head_hydrology(geometry, opts): # {{{
+    '''
+    Returns a dict of the flows at the heads of get_head_geometry(): area_frac (the
+      fraction of the catchment above the intake), avg_flow_rate, design_flow and fit.
+    Where geometry has area_frac, measured rather than from the catchment shape (see
+      dem.py), it is used as it is.
+    '''
+    h = geometry['head']
+
+    # Flow rate
+    if 'area_frac' in geometry: area_frac = np.asarray(geometry['area_frac'], dtype=float)
+    else:                       area_frac = get_area_array(opts.catch_type, opts.cl, geometry['Hz'])
+    avail_ca = opts.ca * area_frac
+    aae = get_evaporation_array(opts.aar, opts.aae)
+    catchment_vol = avail_ca * ((opts.aar - aae) / 1000) # Divide by 1000 to put mm into meters
+    avg_flow_rate = catchment_vol / (365 * 24 * 60 * 60) # In cumecs
+
+    # Design flow
+    design_flow = avg_flow_rate * flow_duration_curve[opts.fdc_index]
+
+    return {'area_frac'         : area_frac,
+            'avg_flow_rate'     : avg_flow_rate,
+            'design_flow'       : design_flow,
+            'fit'               : get_fit_array(design_flow, h)}
+    # }}} End of get_head_hydrology
+
+def get_head_flows(heads, opts): # {{{
+    '''
+    Returns a dict of the parts of evaluate_heads() which depend only on the head and
+      the catchment: head, penstock_length, avg_flow_rate, design_flow and fit.
+    '''
+    geometry = get_head_geometry(heads, opts)
+    flows = get_head_hydrology(geometry, opts)
+    flows['head'] = geometry['head']
+    flows['penstock_length'] = geometry['penstock_length']
+    return flows
+    # }}} End of get_head_flows
+
+def get_economics_array(head, design_flow, FIT, head_loss, total_penstock_cost, # {{{
+                        efficiency, market_price, reliability, interest, annual_energy=None):
+    '''
+    Returns a dict of the economics of the chosen pipes, see the head loop in EPIC.py:
+      capacity, total_penstock_cost, total_project_cost, annual_revenue,
+      payback_period, cost_per_kw and annual_roi.
+    annual_energy is from flow_series.get_annual_energy(), or None to generate the
+      capacity all year times the reliability.
+    '''
+    capacity = get_scheme_capacity(head = head,
+                                   head_loss = head_loss,
+                                   Q = design_flow,
+                                   efficiency = efficiency)
+    total_project_cost = total_penstock_cost / PenFrac
+    annual_revenue = get_scheme_annual_revenue(C = capacity,
+                                               FIT = FIT,
+                                               P = market_price,
+                                               R = reliability,
+                                               interest = interest,
+                                               total = total_project_cost,
+                                               E = annual_energy)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        payback_period = total_project_cost / annual_revenue
+        cost_per_kw = total_project_cost / capacity
+        annual_roi = annual_revenue / total_project_cost * 100
+
+    return {'capacity'              : capacity,
+            'total_penstock_cost'   : total_penstock_cost,
+            'total_project_cost'    : total_project_cost,
+            'annual_revenue'        : annual_revenue,
+            'payback_period'        : payback_period,
+            'cost_per_kw'           : cost_per_kw,
+            'annual_roi'            : annual_roi}
+    # }}} End of get_economics_array
+
+def evaluate_heads(heads, pipe_table, opts, head_losses=None): # {{{
+    '''
+    Evaluates every head in heads at once.
+    opts carries the same fields as the command line options of EPIC.py.
+    head_losses are from get_head_losses_array() for these heads and flows, worked out
+      if they are None.
+    Returns a dict of arrays, one entry per plot axis plus the chosen pipe, and
+      materials, the names of the materials which the chosen material indexes.
+    '''
+    return evaluate_geometry(get_head_geometry(heads, opts), pipe_table, opts, head_losses)
+    # }}} End of evaluate_heads
+
+def evaluate_geometry(geometry, pipe_table, opts, head_losses=None): # {{{
+    '''
+    Evaluates every intake of geometry at once, as evaluate_heads(). geometry is as
+      get_head_geometry(): head, penstock_length and Hz, or area_frac in place of Hz
+      for intakes on a measured river (see dem.py). If it has intake, an index for each
+      intake, the schemes of get_scheme() have it too.
+    '''
+    results = get_head_hydrology(geometry, opts)
+    for key in ['head', 'penstock_length', 'intake']:
+        if key in geometry: results[key] = geometry[key]
+    catalogue = get_pipe_catalogue(pipe_table)
+
+    # Get optimum pipe
+    pipe = get_optimum_pipe_array(head            = results['head'],
+                                  pipe_table      = catalogue,
+                                  design_flow     = results['design_flow'],
+                                  penstock_length = results['penstock_length'],
+                                  FIT             = results['fit'],
+                                  efficiency      = opts.efficiency,
+                                  market_price    = opts.market_price,
+                                  interest        = opts.interest,
+                                  friction_method = getattr(opts, 'friction_method', 'fixed_point'),
+                                  friction_tolerance = getattr(opts, 'friction_tolerance', FrictionTolerance),
+                                  head_losses     = head_losses)
+
+    # Economics, see the head loop in EPIC.py
+    annual_energy = get_annual_energy(opts, results['area_frac'], results['design_flow'],
+                                      results['head'], pipe['head_loss'], opts.efficiency)
+    results.update(get_economics_array(head                = results['head'],
+                                       design_flow         = results['design_flow'],
+                                       FIT                 = results['fit'],
+                                       head_loss           = pipe['head_loss'],
+                                       total_penstock_cost = pipe['annual_capital_cost'] / opts.interest,
+                                       efficiency          = opts.efficiency,
+                                       market_price        = opts.market_price,
+                                       reliability         = opts.reliability,
+                                       interest            = opts.interest,
+                                       annual_energy       = annual_energy))
+    results['diameter']  = pipe['diameter']
+    results['material']  = pipe['material']
+    results['head_loss'] = pipe['head_loss']
+    results['materials'] = catalogue.materials
+    return results
+    # }}} End of evaluate_geometry
+
+def get_scheme(results, i, head=None): # {{{
+    '''
+    Returns the scheme dict, as used in EPIC.py, for entry i of the results of
+      evaluate_heads().
+    '''
+    material = int(results['material'][i])
+    materials = results.get('materials', MATERIALS)
+    if head is None: head = float(results['head'][i])
+    scheme = {'diameter'       : float(results['diameter'][i]),
+              'material'       : materials[material] if material >= 0 else '',
+              'head'           : head,
+              'capacity'       : float(results['capacity'][i]),
+              'project_cost'   : float(results['total_project_cost'][i]),
+              'cost_per_kw'    : float(results['cost_per_kw'][i]),
+              'payback_period' : float(results['payback_period'][i]),
+              'annual_roi'     : float(results['annual_roi'][i]),
+              'annual_revenue' : float(results['annual_revenue'][i])}
+    if 'intake' in results: scheme['intake'] = int(results['intake'][i])
+    return scheme
+    # }}} End of get_scheme
+
+# A scheme where no head beat the initial values, as initialised in EPIC.run_epic()
+EMPTY_SCHEME = {'diameter'       : 0.0,
+                'material'       : '',
+                'head'           : 0.0,
+                'capacity'       : 0.0,
+                'project_cost'   : 0.0,
+                'cost_per_kw'    : 999999999.9,
+                'payback_period' : 999999999.9,
+                'annual_roi'     : 0.0,
+                'annual_revenue' : 0.0}
+
+# The economic factors which have an optimum scheme, as chosen by the head loop in
+#   EPIC.py: (key, better than, initial value, extra condition)
+OPTIMUM_FACTORS = [('cost_per_kw',    np.less,    999999999.9, None),
+                   ('payback_period', np.less,    999999999.9, lambda v: v > 0),
+                   ('annual_roi',     np.greater, 0.0,         None),
+                   ('annual_revenue', np.greater, 0.0,         None),
+                   ('capacity',       np.greater, 0.0,         None)]
+
+def get_optimum_index(values, key): # {{{
+    '''
+    Returns the index along the last axis of values (the heads) of the optimum for the
+      economic factor key, or -1 where no head beat the initial value.
+    '''
+    (better, initial, condition) = [f[1:] for f in OPTIMUM_FACTORS if f[0] == key][0]
+    values = np.asarray(values, dtype=float)
+    ok = better(values, initial) & ~np.isnan(values)
+    if condition: ok &= condition(values)
+
+    # First head which is strictly better than all those before it
+    masked = np.where(ok, values, np.inf if better is np.less else -np.inf)
+    if better is np.less: i = np.argmin(masked, axis=-1)
+    else:                 i = np.argmax(masked, axis=-1)
+    return np.where(ok.any(axis=-1), i, -1)
+    # }}} End of get_optimum_index
+
+def get_engine_errors(vector_axes, scalar_axes): # {{{
+    '''
+    Returns a dict of the worst error of each axis of vector_axes, the axes of run_epic()
+      with the vector engine, against scalar_axes, from the scalar engine, as a multiple
+      of the tolerance (see the top of this file): above 1 the engines disagree. A value
+      which is finite in only one of them is an error of inf.
+    '''
+    errors = {}
+    capacity = np.abs(np.asarray(scalar_axes['capacity'], dtype=float))
+    for name in scalar_axes:
+        x = np.asarray(vector_axes[name], dtype=float)
+        y = np.asarray(scalar_axes[name], dtype=float)
+        ok = np.isfinite(y)
+        if x.shape != y.shape or (np.isfinite(x) != ok).any():
+            errors[name] = np.inf
+            continue
+        if not ok.any():
+            errors[name] = 0.0
+            continue
+        if name == 'cost_per_kw':
+            floor = VECTOR_ATOL * capacity[ok].max()
+            allowed = np.abs(y[ok]) * (VECTOR_RTOL + floor / np.maximum(capacity[ok], floor))
+        else:
+            allowed = VECTOR_RTOL * np.abs(y[ok]) + VECTOR_ATOL * np.abs(y[ok]).max()
+        d = np.abs(x[ok] - y[ok])
+        with np.errstate(divide='ignore', invalid='ignore'):
+            errors[name] = float(np.where(d > 0, d / allowed, 0.0).max())
+    return errors
+    # }}} End of get_engine_errors
@@ -0,0 +1,114 @@
+# long_profile.py
+# This file contains the long profile mode of EPIC.py (--long_profile FILE), which takes
+# the river as surveyed, (chainage, elevation) points along it, rather than a constant
+# --slope, and evaluates an intake at every survey point above the powerhouse.
+#
+# The file is CSV, one point per line: chainage (m along the river, in either
+# direction) and elevation (m), optionally after a header line. The powerhouse is at
+# --powerhouse_chainage, by default the lower end of the profile, and the intakes are
+# the points on the uphill side of it which are higher than it.
+#
+# Walking up the river from the powerhouse, the distance, the penstock length (laid along
+# the river bed, so the climb counts) and the head of every point are prefix sums of the
+# steps between points, and the fraction of the catchment above each is the shape of
+# --catchment_type at that distance, looked up for the whole sorted profile at once by
+# get_area_array(). All the intakes are then evaluated in one go by EPIC.run_intakes(),
+# so a profile of 100k points is one vectorised pass.
+import warnings
+
+import numpy as np
+
+# Where an intake is, added to each scheme of run_long_profile(): (key, column title,
+#   format of the column)
+INTAKE_FIELDS = [('chainage',  'Chainage (m)',  lambda v: '%.01f' % v),
+                 ('distance',  'Upstream (m)',  lambda v: '%.01f' % v),
+                 ('area_frac', 'Area Fraction', lambda v: '%.03f' % v)]
+
+def read_long_profile(filename): # {{{
+    '''
+    Reads a long profile file, see the top of this file.
+    Returns (chainage, elevation) arrays sorted by chainage.
+    Raises ValueError if it is not two columns of numbers, or has fewer than two points.
+    '''
+    with open(filename, 'rb') as f:
+        first = f.readline()
+        try:
+            [float(value) for value in first.split(',')[:2]]
+            skip = 0
+        except ValueError:
+            skip = 1 # A header
+        f.seek(0)
+        try:
+            with warnings.catch_warnings(): # Only a header, reported below
+                warnings.simplefilter('ignore')
+                points = np.loadtxt(f, delimiter=',', usecols=(0, 1), skiprows=skip, ndmin=2)
+        except (ValueError, IndexError), e:
+            raise ValueError('%s should be lines of chainage,elevation: %s' % (filename, e))
+    if len(points) < 2: raise ValueError('%s has fewer than two points' % filename)
+    order = np.argsort(points[:, 0], kind='mergesort')
+    return (points[order, 0], points[order, 1])
+    # }}} End of read_long_profile
+
+def get_profile_intakes(chainage, elevation, powerhouse=None): # {{{
+    '''
+    Returns a dict of arrays for every point of the profile from the powerhouse up the
+      river: chainage, elevation, distance (from the powerhouse along the river),
+      penstock_length and head. The river runs up towards the higher end of the profile,
+      the powerhouse is the point nearest the chainage powerhouse, by default the lower
+      end.
+    '''
+    if elevation[-1] < elevation[0]: # Chainage runs upstream to downstream
+        (chainage, elevation) = (chainage[::-1], elevation[::-1])
+    start = 0
+    if powerhouse is not None: start = int(np.argmin(np.abs(chainage - powerhouse)))
+    (chainage, elevation) = (chainage[start:], elevation[start:])
+
+    # Prefix sums of the steps up the river
+    step = np.abs(np.diff(chainage))
+    climb = np.diff(elevation)
+    return {'chainage'        : chainage,
+            'elevation'       : elevation,
+            'distance'        : np.concatenate([[0.0], np.cumsum(step)]),
+            'penstock_length' : np.concatenate([[0.0], np.cumsum(np.hypot(step, climb))]),
+            'head'            : elevation - elevation[0]}
+    # }}} End of get_profile_intakes
+
+def run_long_profile(params, pipe_table, chainage, elevation): # {{{
+    '''
+    Evaluates an intake at every point of the profile above the powerhouse, see the top
+      of this file. Points further up the river than --catchment_length are outside
+      the catchment and left out.
+    Returns (results, profile): results as EPIC.run_intakes(), each scheme with the
+      INTAKE_FIELDS of its intake, and the profile from get_profile_intakes().
+    Raises ValueError if there is no point to put an intake at.
+    '''
+    import EPIC
+    from hydro_vector import get_area_array
+    profile = get_profile_intakes(chainage, elevation, params.powerhouse_chainage)
+    profile['area_frac'] = get_area_array(params.catch_type, params.cl, profile['distance'])
+
+    intakes = np.flatnonzero((profile['head'] > 0) & (profile['distance'] < params.cl))
+    if not len(intakes): raise ValueError('There is no point of the profile above the powerhouse')
+    geometry = {'head'            : profile['head'][intakes],
+                'penstock_length' : profile['penstock_length'][intakes],
+                'area_frac'       : profile['area_frac'][intakes]}
+    results = EPIC.run_intakes(params, pipe_table, geometry)
+    EPIC.add_intake_fields(results, dict((key, profile[key][intakes])
+                                         for (key, title, show) in INTAKE_FIELDS))
+    return (results, profile)
+    # }}} End of run_long_profile
+
+def print_long_profile(results, profile, params, out=None): # {{{
+    '''
+    Writes the optimum intakes from run_long_profile() in the format of params.format.
+    '''
+    import EPIC
+    summary = {'points'              : len(profile['head']),
+               'powerhouse_chainage' : float(profile['chainage'][0]),
+               'length'              : float(profile['distance'][-1]),
+               'evaluations'         : results['evaluations']}
+    title = 'Long profile: %s, %d points over %.0f m up from chainage %.1f, %d intakes' % \
+            (params.long_profile, summary['points'], summary['length'],
+             summary['powerhouse_chainage'], summary['evaluations'])
+    EPIC.print_intake_results(results, params, INTAKE_FIELDS, {'profile': summary}, title, out)
+    # }}} End of print_long_profile
@@ -0,0 +1,239 @@
+# pareto.py
+# This file contains the Pareto front mode of EPIC.py (--pareto OBJECTIVES), which shows
+# the trade off between economic factors rather than the optimum of each on its own: the
+# schemes which no other scheme beats on every one of the objectives at once. Moving
+# along the front, one objective only gets better by another getting worse.
+#
+# The objectives are some of PARETO_OBJECTIVES, e.g. --pareto annual_revenue,payback_period.
+# A scheme is only on the front where each of its values could be an optimum, as
+# reducer.py chooses them (a payback period above 0, an ROI above 0, ...).
+#
+# The front is found by a skyline algorithm rather than comparing every pair of schemes.
+# The schemes are sorted on their objectives, so no scheme can be beaten by one after it,
+# and then:
+#   - for two objectives, a scheme is on the front where its second objective is better
+#     than any before it, a running minimum,
+#   - for three, a scheme is on the front where no scheme before it is better on both
+#     the second and third, which a staircase of the front so far answers by bisection
+#     (Kung, Luccio and Preparata),
+#   - for four or more, each scheme is checked against the front so far (sort filter
+#     skyline), which is still far fewer comparisons than every pair as fronts are small.
+# Of schemes with equal values only the first, the lowest head, is kept.
+#
+# ParetoFront is given the heads by run_epic() as they are evaluated, in the same way as
+# the --output writers of export.py, and only keeps the front of the heads so far, so
+# its memory does not grow with the number of heads.
+from bisect import bisect_right
+import numpy as np
+import EPIC
+from export import HeadWriter, HEAD_FIELDS
+from hydro_vector import OPTIMUM_FACTORS, get_scheme
+
+# The objectives which can be traded off: (key of the scheme, key of the per head
+#   values, label)
+PARETO_OBJECTIVES = [('capacity',       'capacity',           'Capacity (kW)'),
+                     ('annual_revenue', 'annual_revenue',     'Annual revenue (GBP)'),
+                     ('annual_roi',     'annual_roi',         'Annual ROI (%)'),
+                     ('payback_period', 'payback_period',     'Payback period (years)'),
+                     ('cost_per_kw',    'cost_per_kw',        'Cost/kW (GBP/kW)'),
+                     ('project_cost',   'total_project_cost', 'Project cost (GBP)')]
+
+ParetoFilterBlock = 256 # Points checked against the front at once, for four or more objectives
+
+# (key, better than, initial value, extra condition) of each objective, as OPTIMUM_FACTORS
+PARETO_FACTORS = OPTIMUM_FACTORS + [('project_cost', np.less, np.inf, lambda v: v > 0)]
+
+def parse_objectives(text): # {{{
+    '''
+    Returns the objectives of --pareto, a comma separated string of keys of
+      PARETO_OBJECTIVES, as a list in the order given.
+    Raises ValueError for an unknown objective, a repeated one, or fewer than two.
+    '''
+    known = [key for (key, column, label) in PARETO_OBJECTIVES]
+    objectives = [key.strip() for key in str(text).split(',') if key.strip()]
+    for key in objectives:
+        if key not in known:
+            raise ValueError('Unknown objective %s, use some of %s' % (key, ','.join(known)))
+    if len(set(objectives)) != len(objectives):
+        raise ValueError('Each objective can only be given once')
+    if len(objectives) < 2:
+        raise ValueError('A Pareto front needs at least two objectives')
+    return objectives
+    # }}} End of parse_objectives
+
+def get_ranks(columns, objectives): # {{{
+    '''
+    Returns (ranks, ok) for the per head values columns: ranks is heads x objectives,
+      every objective smallest best (maximised ones negated), and ok is True for the
+      heads where every value could be an optimum.
+    '''
+    n = len(columns['head'])
+    ranks = np.empty((n, len(objectives)))
+    ok = np.ones(n, dtype=bool)
+    for (j, key) in enumerate(objectives):
+        column = [c for (k, c, label) in PARETO_OBJECTIVES if k == key][0]
+        (better, initial, condition) = [f[1:] for f in PARETO_FACTORS if f[0] == key][0]
+        values = np.asarray(columns[column], dtype=float)
+        with np.errstate(invalid='ignore'):
+            ok &= better(values, initial) & ~np.isnan(values)
+            if condition: ok &= condition(values)
+        ranks[:, j] = values if better is np.less else -values
+    return (ranks, ok)
+    # }}} End of get_ranks
+
+def get_staircase_front(y, z): # {{{
+    '''
+    Returns a mask of the points (x, y, z) on the front, for points sorted on (x, y, z)
+      of which only y and z are needed.
+    '''
+    keep = np.zeros(len(y), dtype=bool)
+    # The front so far on (y, z): y increasing and z decreasing
+    (ys, zs) = ([], [])
+    for (i, (yi, zi)) in enumerate(zip(y.tolist(), z.tolist())):
+        k = bisect_right(ys, yi)
+        if k and zs[k - 1] <= zi: continue # The best z of the points with y <= yi
+        keep[i] = True
+        if k and ys[k - 1] == yi: k -= 1
+        j = k
+        while j < len(zs) and zs[j] >= zi: j += 1
+        ys[k:j] = [yi]
+        zs[k:j] = [zi]
+    return keep
+    # }}} End of get_staircase_front
+
+def get_filtered_front(ranks): # {{{
+    '''
+    Returns a mask of the sorted rows of ranks on the front, each checked against the
+      front before it.
+    '''
+    keep = np.zeros(len(ranks), dtype=bool)
+    front = np.empty_like(ranks)
+    m = 0 # Rows of front so far
+    for start in range(0, len(ranks), ParetoFilterBlock):
+        # A block at a time against the front before it, then one by one within the block
+        block = ranks[start:start + ParetoFilterBlock]
+        beaten = (front[:m, np.newaxis, :] <= block[np.newaxis]).all(axis=2).any(axis=0)
+        before = m
+        for i in np.flatnonzero(~beaten).tolist():
+            if not (front[before:m] <= block[i]).all(axis=1).any():
+                keep[start + i] = True
+                front[m] = block[i]
+                m += 1
+    return keep
+    # }}} End of get_filtered_front
+
+def get_front_indices(ranks): # {{{
+    '''
+    Returns the indices of the rows of ranks (points x objectives, smallest best) which
+      no other row beats on every objective, in order of the first objective. See the
+      top of this file.
+    '''
+    (n, d) = ranks.shape
+    if not n: return np.zeros(0, dtype=int)
+    order = np.lexsort(ranks.T[::-1]) # Stable, on the first objective, then the second, ...
+    if d == 1: return order[:1]
+    if d == 2:
+        y = ranks[order, 1]
+        keep = np.ones(n, dtype=bool)
+        keep[1:] = y[1:] < np.minimum.accumulate(y)[:-1]
+        return order[keep]
+    if d == 3: return order[get_staircase_front(ranks[order, 1], ranks[order, 2])]
+    return order[get_filtered_front(ranks[order])]
+    # }}} End of get_front_indices
+
+class ParetoFront(HeadWriter): # {{{
+    '''
+    Keeps the Pareto front of the objectives of the heads written to it, as the output
+      of run_epic(). materials are the names of the materials of the pipe table.
+      output is an export.HeadWriter every head is passed on to, or None.
+    '''
+    def __init__(self, materials, objectives, output=None):
+        HeadWriter.__init__(self, None, materials)
+        self.objectives = list(objectives)
+        self.output = output
+        self._front = dict((field, np.zeros(0)) for field in HEAD_FIELDS)
+
+    def _write(self, block):
+        columns = dict(zip(HEAD_FIELDS, block))
+        if self.output: self.output.write(columns)
+        (ranks, ok) = get_ranks(columns, self.objectives)
+        chunk = np.flatnonzero(ok)
+        chunk = chunk[get_front_indices(ranks[chunk])]
+
+        # The front so far goes first, so on a tie the earlier head is kept
+        merged = dict((field, np.concatenate([self._front[field], columns[field][chunk]]))
+                      for field in HEAD_FIELDS)
+        front = get_front_indices(get_ranks(merged, self.objectives)[0])
+        self._front = dict((field, merged[field][front]) for field in HEAD_FIELDS)
+
+    def schemes(self):
+        '''
+        Returns the schemes of the front, as the schemes of run_epic(), in order of the
+          first objective.
+        '''
+        front = dict(self._front, materials=self.materials)
+        return [get_scheme(front, i) for i in range(len(front['head']))]
+    # }}} End of ParetoFront
+
+def run_pareto(params, pipe_table, objectives, output=None): # {{{
+    '''
+    Evaluates every head, as run_epic(), and finds the Pareto front of the objectives
+      (see parse_objectives()). output is an export.HeadWriter which every head is also
+      written to, or None.
+    Returns a dict with objectives, front (the schemes of the front, in order of the
+      first objective), schemes (the optimum of each economic factor on its own),
+      max_H and evaluations.
+    Raises ValueError if a head in params.heads is above the maximum head.
+    '''
+    front = ParetoFront(pipe_table.materials, objectives, output)
+    results = EPIC.run_epic(params, pipe_table, keep_axes=False, output=front)
+    front.close()
+    return {'objectives'    : list(objectives),
+            'front'         : front.schemes(),
+            'schemes'       : results['schemes'],
+            'max_H'         : results['max_H'],
+            'evaluations'   : results['evaluations']}
+    # }}} End of run_pareto
+
+def print_pareto(results, params, out=None): # {{{
+    '''
+    Writes the Pareto front from run_pareto() in the format of params.format, one
+      scheme per row.
+    '''
+    import sys
+    if out is None: out = sys.stdout
+    front = results['front']
+
+    if params.format == 'json':
+        import json
+        document = {'pipe_file'     : params.pipe_file,
+                    'max_H'         : results['max_H'],
+                    'objectives'    : results['objectives'],
+                    'evaluations'   : results['evaluations'],
+                    'front'         : [EPIC.get_json_scheme(scheme) for scheme in front]}
+        json.dump(document, out, sort_keys=True)
+        out.write('\n')
+
+    elif params.format == 'csv':
+        import csv
+        writer = csv.writer(out)
+        writer.writerow(EPIC.RESULT_FIELDS)
+        for scheme in front:
+            writer.writerow([repr(scheme[k]) if isinstance(scheme[k], float) else scheme[k]
+                             for k in EPIC.RESULT_FIELDS])
+
+    else:
+        from prettytable import PrettyTable
+        table = PrettyTable(['Head (m)', 'Mat', 'Diam (m)', 'Cap (kW)', 'Rev/Yr (GBP)',
+                             'Proj Cost (GBP)', 'Payback Period (Yr)', 'Cost/kW (GBP/kW)',
+                             'ROI (%)'])
+        for scheme in front:
+            table.add_row([scheme['head'], scheme['material']] +
+                          ['%.02f' % scheme[k] for k in ['diameter', 'capacity', 'annual_revenue',
+                                                         'project_cost', 'payback_period',
+                                                         'cost_per_kw', 'annual_roi']])
+        print >>out, 'Input file: ', params.pipe_file
+        print >>out, 'Pareto front of %s: %d schemes of %d heads' % \
+                     (', '.join(results['objectives']), len(front), results['evaluations'])
+        print >>out, table
+    # }}} End of print_pareto
@@ -0,0 +1,218 @@
+# pipes.py
+# This file contains the pipe catalogue: the cost/m of every diameter of pipe in each
+# material, as read from a pipe file.
+#
+# A pipe file is CSV with a header line and then one diameter per line, e.g.
+#   Diameter (m), PVC (GBP/m), Ductile Iron (GBP/m), GRP (GBP/m), HDPE [0.007]
+#   0.1,          27.71,       39.58,                45.52,       31.20
+# The first column is the diameter in meters and every other column is a material.
+# Materials in PipeMaterials (constants.py) are recognised by name, ignoring anything in
+# round brackets, and take their surface roughness from there. Any other material
+# needs its surface roughness in square brackets after its name. An empty cost means
+# the diameter is not made in that material.
+#
+# Which material is used for a diameter:
+#   - a material in PreferredMaterials (PVC) is always used where the head and the
+#     diameter allow it,
+#   - otherwise the material with the cheapest total annual cost, where on an exact
+#     tie the later column wins (GRP over DI, as it always has).
+#
+# A parsed catalogue is cached in ~/.epic as arrays, keyed by a hash of the pipe file
+# and of the materials in constants.py, so a pipe file is only parsed once.
+import os
+import re
+import csv
+import hashlib
+import numpy as np
+from constants import *
+
+# Bump this when the layout of the cache file changes
+PIPE_CACHE_VERSION = 1
+
+PIPE_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.epic')
+
+class PipeCatalogue(object): # {{{
+    '''
+    The diameters of pipe and their cost/m in each material, as contiguous float
+      arrays:
+      diameter     - diameters in meters
+      cost         - materials x diameters cost/m, NaN where a diameter is not made in
+                     that material, so cost[k] is the costs of material k
+      materials    - the names of the materials
+      roughness    - surface roughness of each material
+      preferred    - True for materials in PreferredMaterials
+      max_head     - highest head each material may be used at (inf for no limit)
+      max_diameter - largest diameter each material may be used at (inf for no limit)
+    Iterating over a catalogue gives rows of (diameter, cost of each material), the
+      same layout as the pipe file.
+    '''
+    def __init__(self, diameter, cost, materials, roughness=None, filename=None):
+        self.diameter = np.ascontiguousarray(diameter, dtype=float)
+        self.cost = np.ascontiguousarray(np.reshape(cost, (len(materials), len(self.diameter))),
+                                         dtype=float)
+        self.materials = [str(m) for m in materials]
+        self.filename = filename
+
+        if roughness is None: roughness = [get_material(m)[1] for m in self.materials]
+        self.roughness = np.asarray(roughness, dtype=float)
+
+        self.preferred = np.array([m in PreferredMaterials for m in self.materials])
+        limits = [PreferredMaterials.get(m, (np.inf, np.inf)) for m in self.materials]
+        self.max_head = np.array([l[0] for l in limits], dtype=float)
+        self.max_diameter = np.array([l[1] for l in limits], dtype=float)
+
+        self._rows = None
+        self._properties = None
+        self.search_orders = {} # For hydro_utils.get_pipe_search_order()
+
+    def __len__(self):
+        return len(self.diameter)
+
+    def __iter__(self):
+        return iter([tuple([d] + costs) for (d, costs) in self.rows()])
+
+    def __getstate__(self):
+        # The Python rows are quicker to rebuild than to pickle
+        state = dict(self.__dict__)
+        state['_rows'] = state['_properties'] = None
+        return state
+
+    def rows(self):
+        '''
+        Returns a list of (diameter, [cost of each material]) as Python floats, which
+          are quicker than NumPy scalars one at a time.
+        '''
+        if self._rows is None:
+            self._rows = zip(self.diameter.tolist(), self.cost.T.tolist())
+        return self._rows
+
+    def properties(self):
+        '''
+        Returns a list of (roughness, preferred, max_head, max_diameter) of each material
+          as Python values, for the same reason as rows().
+        '''
+        if self._properties is None:
+            self._properties = zip(self.roughness.tolist(), self.preferred.tolist(),
+                                   self.max_head.tolist(), self.max_diameter.tolist())
+        return self._properties
+    # }}} End of PipeCatalogue
+
+def get_material(name): # {{{
+    '''
+    Returns (name, roughness) of the material in PipeMaterials called name in the header
+      of a pipe file, or None if it is not one of them.
+    '''
+    name = name.strip().lower()
+    for (material, roughness, names) in PipeMaterials:
+        if name == material.lower() or name in names: return (material, roughness)
+    return None
+    # }}} End of get_material
+
+def parse_material(column): # {{{
+    '''
+    Returns (name, roughness) from a header column of a pipe file.
+    Raises ValueError if the material is unknown and has no roughness.
+    '''
+    match = re.search(r'\[\s*([^\]]*?)\s*\]', column)
+    name = re.sub(r'\[[^\]]*\]|\([^)]*\)', '', column).strip()
+    known = get_material(name)
+    if match:
+        try:
+            roughness = float(match.group(1))
+        except ValueError:
+            raise ValueError('Cannot read the roughness of pipe material: %s' % column)
+        return (known[0] if known else name, roughness)
+    if known: return known
+    raise ValueError('Unknown pipe material %s, give its roughness like %s [0.007]' % (name, name))
+    # }}} End of parse_material
+
+def parse_pipe_file(data, filename=None): # {{{
+    '''
+    Parses the contents of a pipe file into a PipeCatalogue.
+    Raises ValueError if it cannot be understood.
+    '''
+    lines = [line for line in data.splitlines() if line.strip()]
+    if not lines: raise ValueError('Empty pipe file')
+    reader = csv.reader(lines)
+    header = reader.next()
+    if len(header) < 2: raise ValueError('A pipe file needs a diameter and at least one material')
+    (materials, roughness) = zip(*[parse_material(column) for column in header[1:]])
+
+    rows = []
+    for row in reader:
+        if len(row) != len(header):
+            raise ValueError('Pipe file line has %d columns, not %d: %s' %
+                             (len(row), len(header), ','.join(row)))
+        rows.append([float(x) if x.strip() else np.nan for x in row])
+    table = np.array(rows, dtype=float).reshape((-1, len(header)))
+
+    return PipeCatalogue(diameter = table[:, 0],
+                         cost = table[:, 1:].T,
+                         materials = materials,
+                         roughness = roughness,
+                         filename = filename)
+    # }}} End of parse_pipe_file
+
+def get_pipe_cache_file(data, cache_dir=PIPE_CACHE_DIR): # {{{
+    '''
+    Returns the path of the cached catalogue for the contents of a pipe file.
+    '''
+    key = hashlib.sha1(data)
+    key.update(repr((PIPE_CACHE_VERSION, PipeMaterials, sorted(PreferredMaterials.items()))))
+    return os.path.join(cache_dir, 'pipes_%s.npz' % key.hexdigest())
+    # }}} End of get_pipe_cache_file
+
+def read_pipe_catalogue(filename, cache_dir=PIPE_CACHE_DIR): # {{{
+    '''
+    Returns the PipeCatalogue of a pipe file, from the cache if this file has been
+      read before, otherwise by parsing it (and writing the cache). cache_dir None
+      skips the cache.
+    '''
+    pipe_file = open(filename, 'rb')
+    data = pipe_file.read()
+    pipe_file.close()
+    if cache_dir is None: return parse_pipe_file(data, filename)
+
+    cache_file = get_pipe_cache_file(data, cache_dir)
+    if os.path.exists(cache_file):
+        try:
+            cached = np.load(cache_file)
+            catalogue = PipeCatalogue(diameter = cached['diameter'],
+                                      cost = cached['cost'],
+                                      materials = cached['materials'].tolist(),
+                                      roughness = cached['roughness'],
+                                      filename = filename)
+            cached.close()
+            return catalogue
+        except (IOError, ValueError, KeyError):
+            pass # Unreadable cache, just parse it again
+
+    catalogue = parse_pipe_file(data, filename)
+    try:
+        if not os.path.isdir(cache_dir): os.makedirs(cache_dir)
+        # Write to a temporary file first so a half written cache is never read
+        temp = cache_file + '.%d.tmp' % os.getpid()
+        with open(temp, 'wb') as f:
+            np.savez(f, diameter = catalogue.diameter,
+                        cost = catalogue.cost,
+                        materials = np.array(catalogue.materials),
+                        roughness = catalogue.roughness)
+        os.rename(temp, cache_file)
+    except (IOError, OSError):
+        pass # The cache is only to save time
+    return catalogue
+    # }}} End of read_pipe_catalogue
+
+def get_pipe_catalogue(pipe_table): # {{{
+    '''
+    Returns pipe_table as a PipeCatalogue. pipe_table may already be one, or rows of
+      (diameter, PVC, DI, GRP) cost/m as numbers or strings, as read_pipe_table() used
+      to return.
+    '''
+    if isinstance(pipe_table, PipeCatalogue): return pipe_table
+    table = np.array([[float(x) for x in row] for row in pipe_table], dtype=float)
+    table = table.reshape((-1, 4))
+    return PipeCatalogue(diameter = table[:, 0],
+                         cost = table[:, 1:].T,
+                         materials = [m[0] for m in PipeMaterials])
+    # }}} End of get_pipe_catalogue
@@ -0,0 +1,316 @@
+# plotting.py
+# This file contains the plot stage of EPIC.py (--plots), which saves a PNG of per head
+# values against the head for each plot asked for.
+#
+# Every plot goes through the same pipeline:
+#   - long continuous series are cut down to --plot_points points by Largest Triangle
+#     Three Buckets (LTTB) downsampling, which keeps the peaks and troughs a plot shows,
+#   - the points are drawn on a matplotlib Figure with the Agg canvas, without pyplot,
+#   - each plot is timed.
+# With --plot_layout separate (the default) each plot is its own file and, when there is
+# more than one, they are rendered across a pool of --processes processes. With
+# --plot_layout grid they are the subplots of one figure, saved once.
+#
+# --fdc_sweep has a value for every flow duration curve entry and head, so its plots are
+# heatmaps of entry against head instead, each its own file, marking the optimum.
+# --pareto plots each pair of its objectives against each other for the schemes on the
+# front, coloured by head.
+import os
+import time
+import datetime
+import multiprocessing
+import numpy as np
+
+# (name, title, y label) of every plot, in the order the grid layout draws them
+PLOTS = [('penstock_length',     'Penstock_length',     'Penstock_length (m)'),
+         ('avg_flow_rate',       'Avg_flow_rate',       'Avg_flow_rate (m^3/s)'),
+         ('design_flow',         'Design_flow',         'Design_flow (m^3/s)'),
+         ('fit',                 'FIT',                 'FIT (GBP/kWh)'),
+         ('capacity',            'Capacity',            'Capacity (kW)'),
+         ('total_penstock_cost', 'Total_penstock_cost', 'Total_penstock_cost (GBP)'),
+         ('total_project_cost',  'Total_project_cost',  'Total_project_cost (GBP)'),
+         ('annual_revenue',      'Annual_revenue',      'Annual_revenue (GBP)'),
+         ('payback_period',      'payback_period',      'payback_period (years)'),
+         ('cost_per_kw',         'Cost_per_kw',         'Cost_per_kw (GBP/kW)'),
+         ('annual_roi',          'Annual_roi',          'Annual_roi (%)')]
+
+PLOT_POINTS = 2000   # Continuous series longer than this are downsampled
+PLOT_DIR    = 'plots'
+GRID_COLUMNS = 2
+
+def downsample_lttb(x, y, points): # {{{
+    '''
+    Largest Triangle Three Buckets downsampling of the line through x and y.
+    Points which are not finite are left out, as they are not drawn anyway.
+    Returns (x, y) of at most points points, including the first and last.
+    '''
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    finite = np.isfinite(x) & np.isfinite(y)
+    if not finite.all(): (x, y) = (x[finite], y[finite])
+    n = len(x)
+    if points < 3 or n <= points: return (x, y)
+
+    # points - 2 buckets between the first and last points, which are always kept
+    edges = np.linspace(1, n - 1, points - 1).astype(int).tolist() + [n]
+    chosen = [0]
+    a = 0
+    for i in range(points - 2):
+        (start, stop) = (edges[i], edges[i + 1])
+        # The third corner is the average of the next bucket
+        (next_start, next_stop) = (edges[i + 1], edges[i + 2])
+        avg_x = x[next_start:next_stop].mean()
+        avg_y = y[next_start:next_stop].mean()
+        # Twice the area of the triangle of the last chosen point, each point of this
+        #   bucket and the average of the next
+        area = np.abs((x[a] - avg_x) * (y[start:stop] - y[a]) -
+                      (x[a] - x[start:stop]) * (avg_y - y[a]))
+        a = start + int(np.argmax(area))
+        chosen.append(a)
+    chosen.append(n - 1)
+    return (x[chosen], y[chosen])
+    # }}} End of downsample_lttb
+
+def get_plot_limits(x, y): # {{{
+    '''
+    Returns the [xmin, xmax, ymin, ymax] the plots have always used, from the finite
+      values only so infinite paybacks do not break the axes.
+    '''
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    x = x[np.isfinite(x)]
+    y = y[np.isfinite(y)]
+    if not len(x) or not len(y): return None
+    return [x.min() - 5, x.max() + 5, y.min() - 5, y.max() * 1.05]
+    # }}} End of get_plot_limits
+
+def draw_plot(ax, name, x, y, discrete, limits): # {{{
+    '''
+    Draws one plot onto the matplotlib axes ax.
+    '''
+    (title, ylabel) = [(t, l) for (n, t, l) in PLOTS if n == name][0]
+    if discrete: ax.plot(x, y, 'bo')
+    else:        ax.plot(x, y, '-')
+    ax.set_title(title)
+    ax.set_ylabel(ylabel)
+    ax.set_xlabel('Head (m)')
+    if limits: ax.axis(limits)
+    # }}} End of draw_plot
+
+def get_figure(rows=1, columns=1): # {{{
+    '''
+    Returns a matplotlib Figure on an Agg canvas, sized for rows x columns plots.
+    The plots are only ever saved to files, so pyplot and its backends are not needed.
+    '''
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    figure = Figure(figsize=(8 * columns, 6 * rows))
+    FigureCanvasAgg(figure)
+    return figure
+    # }}} End of get_figure
+
+def render_plot(job): # {{{
+    '''
+    Renders and saves one plot. job is (name, x, y, discrete, limits, filename).
+    Returns (name, filename, seconds).
+    '''
+    start = time.time()
+    (name, x, y, discrete, limits, filename) = job
+    figure = get_figure()
+    draw_plot(figure.add_subplot(111), name, x, y, discrete, limits)
+    figure.savefig(filename)
+    return (name, filename, time.time() - start)
+    # }}} End of render_plot
+
+def render_heatmap(job): # {{{
+    '''
+    Renders and saves one heatmap. job is (name, heads, matrix, optimum, filename),
+      matrix is flow duration curve entries x heads and optimum is (entry, head) to mark
+      or None.
+    Returns (name, filename, seconds).
+    '''
+    start = time.time()
+    (name, heads, matrix, optimum, filename) = job
+    (title, label) = [(t, l) for (n, t, l) in PLOTS if n == name][0]
+    figure = get_figure()
+    ax = figure.add_subplot(111)
+    heads = np.asarray(heads, dtype=float)
+    entries = np.arange(1, matrix.shape[0] + 1)
+    # Cells are centred on their head and entry; inf and NaN are left blank
+    image = ax.pcolormesh(get_cell_edges(heads), get_cell_edges(entries),
+                          np.ma.masked_invalid(matrix), **get_heatmap_limits(matrix))
+    figure.colorbar(image, ax=ax).set_label(label)
+    from matplotlib.ticker import MaxNLocator
+    ax.yaxis.set_major_locator(MaxNLocator(integer=True))
+    if optimum: ax.plot([optimum[1]], [optimum[0]], 'w*', markersize=12)
+    ax.set_title(title + ' by flow duration curve and head')
+    ax.set_xlabel('Head (m)')
+    ax.set_ylabel('Flow duration curve')
+    figure.savefig(filename)
+    return (name, filename, time.time() - start)
+    # }}} End of render_heatmap
+
+def render_pareto(job): # {{{
+    '''
+    Renders and saves one plot of a Pareto front. job is (name, (x label, y label), x, y,
+      heads, filename), x and y the values of two objectives of each scheme of the front.
+    Returns (name, filename, seconds).
+    '''
+    start = time.time()
+    (name, (xlabel, ylabel), x, y, heads, filename) = job
+    figure = get_figure()
+    ax = figure.add_subplot(111)
+    order = np.argsort(x, kind='mergesort')
+    ax.plot(x[order], y[order], '-', color='0.7', zorder=1)
+    image = ax.scatter(x, y, c=heads, zorder=2)
+    figure.colorbar(image, ax=ax).set_label('Head (m)')
+    ax.set_title('Pareto front')
+    ax.set_xlabel(xlabel)
+    ax.set_ylabel(ylabel)
+    figure.savefig(filename)
+    return (name, filename, time.time() - start)
+    # }}} End of render_pareto
+
+def get_heatmap_limits(matrix): # {{{
+    '''
+    Returns the colour keywords of a heatmap of matrix: limits at the 2nd and 98th
+      percentiles of its finite values, on a log scale if they are positive and more
+      than a hundred times apart. Near the top of the catchment the flow runs out and
+      costs grow without bound, which would otherwise wash out the rest.
+    '''
+    finite = matrix[np.isfinite(matrix)]
+    if not len(finite): return {}
+    (vmin, vmax) = np.percentile(finite, [2, 98])
+    if vmin > 0 and vmax > 100 * vmin:
+        from matplotlib.colors import LogNorm
+        return {'norm': LogNorm(vmin, vmax)}
+    return {'vmin': vmin, 'vmax': vmax}
+    # }}} End of get_heatmap_limits
+
+def get_cell_edges(centres): # {{{
+    '''
+    Returns the edges of cells centred on the increasing values centres.
+    '''
+    centres = np.asarray(centres, dtype=float)
+    if len(centres) == 1: return np.array([centres[0] - 0.5, centres[0] + 0.5])
+    middle = (centres[1:] + centres[:-1]) / 2
+    return np.concatenate([[2 * centres[0] - middle[0]], middle, [2 * centres[-1] - middle[-1]]])
+    # }}} End of get_cell_edges
+
+def get_heatmap_jobs(matrices, heads, names, optimums={}, directory=PLOT_DIR): # {{{
+    '''
+    Returns a list of render_heatmap() jobs for the plots in names (see
+      get_plot_names()), from the matrices of fdc_sweep.run_fdc_sweep(). optimums are
+      the (entry, head) to mark on each plot, by name.
+    Raises ValueError for a plot which does not exist.
+    '''
+    return [(name, heads, np.asarray(matrices[name], dtype=float), optimums.get(name),
+             get_plot_filename(name + '_fdc', False, directory))
+            for name in get_plot_names(names)]
+    # }}} End of get_heatmap_jobs
+
+def get_pareto_jobs(front, objectives, directory=PLOT_DIR): # {{{
+    '''
+    Returns a list of render_pareto() jobs, one for each pair of objectives, from the
+      schemes of the front of pareto.run_pareto(). objectives are (key, label).
+    '''
+    heads = np.array([scheme['head'] for scheme in front], dtype=float)
+    jobs = []
+    for (i, (xkey, xlabel)) in enumerate(objectives):
+        for (ykey, ylabel) in objectives[i + 1:]:
+            name = 'pareto_%s_%s' % (xkey, ykey)
+            jobs.append((name, (xlabel, ylabel),
+                         np.array([scheme[xkey] for scheme in front], dtype=float),
+                         np.array([scheme[ykey] for scheme in front], dtype=float),
+                         heads, get_plot_filename(name, True, directory)))
+    return jobs
+    # }}} End of get_pareto_jobs
+
+def render_grid(jobs, filename): # {{{
+    '''
+    Renders every job of render_plot() as a subplot of one figure, saved as filename.
+    Returns [(name, filename, seconds)], the time of each subplot plus a share of the
+      time to save the figure.
+    '''
+    rows = (len(jobs) + GRID_COLUMNS - 1) // GRID_COLUMNS
+    columns = min(GRID_COLUMNS, len(jobs))
+    figure = get_figure(rows, columns)
+    timings = []
+    for (k, (name, x, y, discrete, limits, plot_filename)) in enumerate(jobs):
+        start = time.time()
+        draw_plot(figure.add_subplot(rows, columns, k + 1), name, x, y, discrete, limits)
+        timings.append(time.time() - start)
+    start = time.time()
+    figure.tight_layout()
+    figure.savefig(filename)
+    save = (time.time() - start) / len(jobs)
+    return [(name, filename, seconds + save) for ((name, x, y, d, l, f), seconds) in zip(jobs, timings)]
+    # }}} End of render_grid
+
+def get_plot_filename(name, discrete, directory=PLOT_DIR): # {{{
+    '''
+    Returns the file name, without the extension, of the plot name.
+    '''
+    # Name the files correctly so I can find them easily
+    datestring = '_' + datetime.datetime.now().strftime('%Y%m%d-%H%M')
+    typestring = '_discrete' if discrete else '_continuous'
+    return os.path.join(directory, name + typestring + datestring)
+    # }}} End of get_plot_filename
+
+def get_plot_names(names): # {{{
+    '''
+    Returns the plots in names, a list or a comma separated string, in the order of
+      PLOTS and each once.
+    Raises ValueError for a plot which does not exist.
+    '''
+    if isinstance(names, basestring): names = names.split(',')
+    known = [name for (name, title, ylabel) in PLOTS]
+    for name in names:
+        if name not in known:
+            raise ValueError('Unknown plot %s, use some of %s' % (name, ','.join(known)))
+    return [name for name in known if name in names]
+    # }}} End of get_plot_names
+
+def get_plot_jobs(axes, names, discrete, points=PLOT_POINTS, directory=PLOT_DIR): # {{{
+    '''
+    Returns a list of render_plot() jobs for the plots in names (see get_plot_names()),
+      from the per head axes of EPIC.run_epic().
+    Raises ValueError for a plot which does not exist.
+    '''
+    jobs = []
+    for name in get_plot_names(names):
+        (x, y) = (axes['head'], axes[name])
+        limits = get_plot_limits(x, y)
+        if not discrete and points: (x, y) = downsample_lttb(x, y, points)
+        jobs.append((name, np.asarray(x, dtype=float), np.asarray(y, dtype=float), discrete,
+                     limits, get_plot_filename(name, discrete, directory)))
+    return jobs
+    # }}} End of get_plot_jobs
+
+def render_plots(jobs, layout='separate', processes=None, directory=PLOT_DIR, # {{{
+                 render=render_plot):
+    '''
+    Renders the jobs from get_plot_jobs(), see the top of this file. render is the
+      function which renders one job, render_heatmap for get_heatmap_jobs() and
+      render_pareto for get_pareto_jobs(), which are always separate.
+    Returns [(name, filename, seconds)] for every plot.
+    '''
+    if not jobs: return []
+    if not os.path.isdir(directory): os.makedirs(directory)
+
+    if layout == 'grid' and render is render_plot:
+        return render_grid(jobs, get_plot_filename('plots', jobs[0][3], directory))
+
+    if processes is None: processes = multiprocessing.cpu_count()
+    processes = min(processes, len(jobs))
+    if processes <= 1: return [render(job) for job in jobs]
+
+    # matplotlib is imported before the fork so the workers do not each import it
+    get_figure()
+    pool = multiprocessing.Pool(processes)
+    try:
+        return pool.map(render, jobs, 1)
+    finally:
+        pool.terminate()
+        pool.join()
+    # }}} End of render_plots
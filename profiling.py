@@ -0,0 +1,191 @@
+# profiling.py
+# This file contains the profiling of EPIC.py (--profile FILE), which writes a JSON report
+# of where the time of a run went:
+#   - the wall time of each stage of the run (reading the pipe file, the heads, printing,
+#     the plots, ...) and the peak memory of the process when it ended,
+#   - the calls of the hot functions of COUNTED and the values they worked out, and the
+#     iterations of the Colebrook-White solver,
+#   - with --profile_dump FILE, a cProfile dump of the whole run (read it with pstats or
+#     snakeviz), whose most expensive functions are also put in the report.
+#
+# The counters are always on. Each counted scalar call only adds one to a dict, which is
+# small against the work of any of the counted functions, so they can be left on in
+# production. The array versions in hydro_vector.py count under the same names, one call
+# for many values. Work done in other processes (--batch, the plot pool) is not counted.
+# A profiled run skips the result cache, so it always times the model rather than a read.
+import os
+import sys
+import time
+
+# The hot functions which are counted
+COUNTED = ['get_friction_coeff', 'get_head_loss', 'get_area']
+
+# Calls of each counted function, scalar and array alike, and friction_iterations, the
+#   iterations of the Colebrook-White solver over every value. The scalar functions add
+#   to these themselves, as cheaply as Python allows.
+counters = dict.fromkeys(COUNTED + ['friction_iterations'], 0)
+
+# Calls of the array versions and the values they worked out, see count_array()
+array_calls = dict.fromkeys(COUNTED, 0)
+array_values = dict.fromkeys(COUNTED, 0)
+
+# The functions of a --profile_dump put in the report
+PROFILE_FUNCTIONS = 20
+
+def count_array(name, size, counted=False): # {{{
+    '''
+    Counts a call of the array version of the function name which worked out size
+      values. counted is True where the call itself was already counted, by the scalar
+      function being called with arrays.
+    '''
+    if not counted: counters[name] += 1
+    array_calls[name] += 1
+    array_values[name] += size
+    # }}} End of count_array
+
+def reset_counters(): # {{{
+    '''
+    Sets every counter back to 0.
+    '''
+    for name in counters: counters[name] = 0
+    for name in COUNTED:
+        array_calls[name] = 0
+        array_values[name] = 0
+    # }}} End of reset_counters
+
+def get_counters(): # {{{
+    '''
+    Returns a copy of the counters: {function: {'calls': n, 'values': n}} and
+      friction_iterations. A scalar call works out one value, an array call one per
+      element.
+    '''
+    report = dict((name, {'calls'  : counters[name],
+                          'values' : counters[name] - array_calls[name] + array_values[name]})
+                  for name in COUNTED)
+    report['friction_iterations'] = counters['friction_iterations']
+    return report
+    # }}} End of get_counters
+
+def get_peak_memory(): # {{{
+    '''
+    Returns the peak resident memory of this process in MB, or None where it is not
+      known (Windows).
+    '''
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin': return peak / 1024.0 / 1024.0 # bytes
+    return peak / 1024.0 # kB
+    # }}} End of get_peak_memory
+
+class Stage(object): # {{{
+    '''
+    Times one stage of a Profiler, see Profiler.stage().
+    '''
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, kind, value, traceback):
+        self.profiler.stages.append({'name'           : self.name,
+                                     'seconds'        : time.time() - self.start,
+                                     'peak_memory_mb' : get_peak_memory()})
+        return False
+    # }}} End of Stage
+
+class Profiler(object): # {{{
+    '''
+    Records the stages of a run and the counters while it is running.
+    dump is the file a cProfile dump of the run is written to, or None.
+    '''
+    def __init__(self, dump=None):
+        self.dump = dump
+        self.stages = []
+        self._profile = None
+
+    def start(self):
+        '''
+        Resets the counters and starts the clock, and cProfile if there is a dump.
+        '''
+        reset_counters()
+        self.start_time = time.time()
+        if self.dump:
+            import cProfile
+            self._profile = cProfile.Profile()
+            self._profile.enable()
+
+    def stop(self):
+        '''
+        Stops the clock and writes the cProfile dump.
+        '''
+        self.seconds = time.time() - self.start_time
+        if self._profile:
+            self._profile.disable()
+            self._profile.dump_stats(self.dump)
+
+    def stage(self, name):
+        '''
+        Returns a context manager which times the stage name, e.g.
+          with profiler.stage('read_pipe_table'): ...
+        '''
+        return Stage(self, name)
+
+    def get_functions(self):
+        '''
+        Returns the PROFILE_FUNCTIONS functions of the cProfile dump which took the most
+          time of their own, most first.
+        '''
+        import pstats
+        stats = pstats.Stats(self._profile).stats
+        functions = []
+        for ((filename, line, name), (primitive, total, own, cumulative, callers)) in stats.items():
+            functions.append({'function'           : '%s:%d(%s)' % (os.path.basename(filename),
+                                                                    line, name),
+                              'calls'              : total,
+                              'seconds'            : own,
+                              'cumulative_seconds' : cumulative})
+        functions.sort(key=lambda f: -f['seconds'])
+        return functions[:PROFILE_FUNCTIONS]
+
+    def report(self):
+        '''
+        Returns the report written by write_report().
+        '''
+        report = {'seconds'        : self.seconds,
+                  'stages'         : self.stages,
+                  'counters'       : get_counters(),
+                  'peak_memory_mb' : get_peak_memory()}
+        if self._profile:
+            report['profile_dump'] = self.dump
+            report['functions'] = self.get_functions()
+        return report
+
+    def write_report(self, filename):
+        '''
+        Writes the report as JSON to filename.
+        '''
+        import json
+        with open(filename, 'w') as f:
+            json.dump(self.report(), f, indent=2, sort_keys=True)
+            f.write('\n')
+    # }}} End of Profiler
+
+class NoProfiler(object): # {{{
+    '''
+    A Profiler which records nothing, for runs without --profile.
+    '''
+    def stage(self, name):
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, kind, value, traceback):
+        return False
+    # }}} End of NoProfiler
@@ -0,0 +1,89 @@
+# reducer.py
+# This file contains the streaming reducer which chooses the optimum schemes of a run.
+# Schemes are offered to it one head, or one chunk of heads, at a time and it only keeps
+# the best k schemes of each economic factor of hydro_vector.OPTIMUM_FACTORS, so its
+# memory does not grow with the number of heads.
+#
+# A scheme only counts where its value is strictly better than the initial value of the
+# factor (and the extra condition holds, e.g. payback period above 0), and on a tie the
+# earlier head wins, as the head loop in EPIC.py has always chosen. With k = 1 the best
+# scheme of each factor is the optimum scheme EPIC.py prints.
+import heapq
+import numpy as np
+from hydro_vector import OPTIMUM_FACTORS, EMPTY_SCHEME, get_scheme
+
+class SchemeReducer(object): # {{{
+    '''
+    Keeps the best k schemes of each economic factor of the schemes offered to it.
+    factors are (key, better than, initial value, extra condition) as OPTIMUM_FACTORS.
+    '''
+    def __init__(self, k=1, factors=OPTIMUM_FACTORS):
+        if k < 1: raise ValueError('The number of top schemes must be at least 1')
+        self.k = k
+        # Every factor is ranked smallest first, so maximised factors are negated
+        self.factors = [(key, 1.0 if better is np.less else -1.0, initial, condition)
+                        for (key, better, initial, condition) in factors]
+        # A heap of (-rank, -order, scheme) per factor, the worst kept scheme on top
+        self._heaps = dict((key, []) for (key, sign, initial, condition) in self.factors)
+        self.count = 0 # Schemes offered so far, which orders them
+
+    def _offer(self, key, rank, order, make_scheme):
+        # make_scheme is only called if the scheme is kept
+        heap = self._heaps[key]
+        entry = (-rank, -order)
+        if len(heap) < self.k:
+            heapq.heappush(heap, entry + (make_scheme(),))
+        elif entry > heap[0][:2]:
+            heapq.heapreplace(heap, entry + (make_scheme(),))
+
+    def add(self, scheme):
+        '''
+        Offers one scheme dict, keyed as the schemes of EPIC.py. Schemes must be offered
+          in head order.
+        '''
+        order = self.count
+        self.count += 1
+        for (key, sign, initial, condition) in self.factors:
+            value = scheme[key]
+            # NaN never equals itself, and never beats the initial value
+            if value != value or not sign * value < sign * initial: continue
+            if condition and not condition(value): continue
+            self._offer(key, sign * value, order, lambda: dict(scheme))
+
+    def add_results(self, results, heads=None):
+        '''
+        Offers every head of the results of hydro_vector.evaluate_heads(), in order.
+        heads are the heads as they should appear in the schemes, as get_scheme().
+        '''
+        n = len(results['head'])
+        for (key, sign, initial, condition) in self.factors:
+            rank = sign * np.asarray(results[key], dtype=float)
+            with np.errstate(invalid='ignore'):
+                ok = (rank < sign * initial) & ~np.isnan(rank)
+                if condition: ok &= condition(results[key])
+            candidates = np.flatnonzero(ok)
+            if len(candidates) > self.k:
+                # Only the best k of a chunk can be among the best k of the run
+                candidates = candidates[np.lexsort((candidates, rank[candidates]))[:self.k]]
+            for i in candidates.tolist():
+                self._offer(key, float(rank[i]), self.count + i,
+                            lambda: get_scheme(results, i, heads[i] if heads is not None else None))
+        self.count += n
+
+    def top(self, key):
+        '''
+        Returns a list of the kept schemes of the factor key, best first.
+        '''
+        return [dict(entry[2]) for entry in sorted(self._heaps[key], reverse=True)]
+
+    def schemes(self):
+        '''
+        Returns a dict of the best scheme of each factor, EMPTY_SCHEME where no scheme
+          beat the initial value.
+        '''
+        best = {}
+        for (key, sign, initial, condition) in self.factors:
+            top = self.top(key)
+            best[key] = top[0] if top else dict(EMPTY_SCHEME)
+        return best
+    # }}} End of SchemeReducer
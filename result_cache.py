@@ -0,0 +1,171 @@
+# result_cache.py
+# This file contains the result cache of EPIC.py. The full results of a run are stored in
+# ~/.epic/results, keyed by a hash of everything they depend on:
+#   - every option which changes the results (not --format, --plots, ... which only change
+#     how they are shown, see RESULT_CACHE_IGNORED), after normalise_params(),
+#   - whether the per head axes are kept,
+#   - the contents of the pipe file, as the arrays of its PipeCatalogue, and of the
+#     --flow_series file,
+#   - the values in constants.py and the flow duration curves,
+#   - the source of the model files, so changing the code never returns old results.
+# So the same site and parameters asked for again is read back rather than worked out.
+#
+# The cache holds at most --cache_size MB. When a new result takes it over, the least
+# recently used results are removed first; a cache hit counts as a use. --no_cache skips
+# the cache and --clear_cache empties it.
+import os
+import hashlib
+import cPickle as pickle
+
+import constants
+from flow_series import get_flow_series
+
+RESULT_CACHE_VERSION = 1 # Bump this when the layout of the results changes
+RESULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.epic', 'results')
+RESULT_CACHE_MAX_BYTES = 256 * 1024 * 1024
+
+# Options which do not change the results. The pipe file and the flow series are hashed
+#   by their contents, not their names.
+RESULT_CACHE_IGNORED = set(['v', 'format', 'plots', 'plot_layout', 'plot_points', 'processes',
+                            'output', 'output_format', 'batch', 'pipe_file', 'flow_series',
+                            'no_cache', 'clear_cache', 'cache_size', 'interactive',
+                            'profile', 'profile_dump', 'serve', 'host', 'port', 'queue',
+                            'dem', 'dem_outlet', 'dem_snap', 'dem_min_area', 'long_profile',
+                            'powerhouse_chainage', 'pareto', 'pareto_plot'])
+
+# Modules whose source decides the results
+MODEL_MODULES = ['constants', 'hydro_utils', 'hydro_vector', 'moody', 'pipes', 'reducer',
+                 'flow_series', 'EPIC']
+
+_model_hash = None
+
+def get_model_hash(): # {{{
+    '''
+    Returns a hash of the constants and of the source of MODEL_MODULES, worked out once.
+    '''
+    global _model_hash
+    if _model_hash is not None: return _model_hash
+
+    model = hashlib.sha1(repr(RESULT_CACHE_VERSION))
+    for name in sorted(dir(constants)):
+        value = getattr(constants, name)
+        if not name.startswith('_') and isinstance(value, (int, long, float, str, list, tuple, dict)):
+            model.update(repr((name, value)))
+    from hydro_utils import flow_duration_curve
+    model.update(repr(flow_duration_curve))
+
+    directory = os.path.dirname(os.path.abspath(__file__))
+    for name in MODEL_MODULES:
+        with open(os.path.join(directory, name + '.py'), 'rb') as f:
+            model.update(f.read())
+
+    _model_hash = model.hexdigest()
+    return _model_hash
+    # }}} End of get_model_hash
+
+def get_result_key(params, catalogue, keep_axes): # {{{
+    '''
+    Returns the cache key of the results of EPIC.run_epic(params, catalogue, keep_axes),
+      catalogue is a pipes.PipeCatalogue.
+    '''
+    key = hashlib.sha1(get_model_hash())
+    options = sorted((name, value) for (name, value) in vars(params).items()
+                     if name not in RESULT_CACHE_IGNORED)
+    key.update(repr((options, bool(keep_axes))))
+    key.update(repr(catalogue.materials))
+    for array in [catalogue.diameter, catalogue.cost, catalogue.roughness]:
+        key.update(array.tobytes())
+    series = get_flow_series(params)
+    if series is not None: key.update(series.digest)
+    return key.hexdigest()
+    # }}} End of get_result_key
+
+class ResultCache(object): # {{{
+    '''
+    A directory of pickled results, one file per key, at most max_bytes in all.
+    '''
+    def __init__(self, directory=RESULT_CACHE_DIR, max_bytes=RESULT_CACHE_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + '.pkl')
+
+    def get(self, key):
+        '''
+        Returns the results stored for key, or None.
+        '''
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                results = pickle.load(f)
+        except (IOError, OSError):
+            return None
+        except Exception:
+            # A damaged file, which will be written again
+            self._remove(path)
+            return None
+        try:
+            os.utime(path, None) # Now the most recently used
+        except OSError:
+            pass
+        return results
+
+    def put(self, key, results):
+        '''
+        Stores results for key, then removes the least recently used results if the
+          cache is too big. The cache only saves time, so failures are ignored.
+        '''
+        try:
+            if not os.path.isdir(self.directory): os.makedirs(self.directory)
+            # Write to a temporary file first so a half written result is never read
+            path = self._path(key)
+            temp = path + '.%d.tmp' % os.getpid()
+            with open(temp, 'wb') as f:
+                pickle.dump(results, f, pickle.HIGHEST_PROTOCOL)
+            os.rename(temp, path)
+        except (IOError, OSError, pickle.PicklingError):
+            return
+        self.evict()
+
+    def _entries(self):
+        # [(last used, size, path)] of every result, oldest first
+        entries = []
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return entries
+        for name in names:
+            if not name.endswith('.pkl'): continue
+            path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        entries.sort()
+        return entries
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+            return True
+        except OSError:
+            return False
+
+    def evict(self):
+        '''
+        Removes the least recently used results until the cache fits in max_bytes.
+        '''
+        entries = self._entries()
+        total = sum(size for (used, size, path) in entries)
+        for (used, size, path) in entries:
+            if total <= self.max_bytes: break
+            if self._remove(path): total -= size
+
+    def clear(self):
+        '''
+        Removes every result. Returns the number removed.
+        '''
+        return len([path for (used, size, path) in self._entries() if self._remove(path)])
+    # }}} End of ResultCache
@@ -0,0 +1,374 @@
+# serve.py
+# This file contains the evaluation service of EPIC.py (--serve), a local HTTP server
+# which answers JSON requests, so a front end does not pay for starting Python, NumPy and
+# reading the pipe files on every evaluation.
+#
+#   POST /run      a JSON object of options named as on the command line without their
+#                  leading dashes, e.g. {"catchment_type": 4, "slope": 10, "heads": "50,100"}.
+#                  Options not in the object are taken from the --serve command line, as
+#                  with --batch. A true value gives a flag such as no_cache. The answer is
+#                  the json format of EPIC.py.
+#   GET /metrics   requests, rejections, cache hits, throughput and latency percentiles.
+#   GET /health    {"status": "ok"}
+#
+# What is kept warm between requests:
+#   - the pipe catalogues, read once per file until the file changes, in the server and
+#     in each worker,
+#   - the moody tables (moody.py) and the results of the last SERVE_CACHE_RESULTS
+#     different requests, held in memory; the result cache on disk is used as by EPIC.py.
+#
+# Evaluations run in a pool of --processes worker processes. At most --queue requests
+# wait for a worker, beyond that the server answers 503 with Retry-After at once rather
+# than letting requests pile up. An evaluation which runs past SERVE_TIMEOUT is answered
+# 500 but keeps its place until the worker is done with it, or for SERVE_TIMEOUT more
+# at most, as a worker which died never answers. Python 2 has no asyncio, so each
+# connection is handled by a thread; the threads only read, check the cache and wait on
+# the pool.
+#
+# Run with something like:
+# ./EPIC.py --serve --port 8340 --pipe_file pipes_1.csv --efficiency 0.82
+# curl -d '{"catchment_type": 4, "slope": 10, ...}' http://127.0.0.1:8340/run
+import os
+import sys
+import copy
+import json
+import time
+import threading
+import collections
+import multiprocessing
+import BaseHTTPServer
+import SocketServer
+
+import EPIC
+
+SERVE_PORT = 8340
+SERVE_QUEUE = 64            # Requests which may wait for a worker
+SERVE_CACHE_RESULTS = 1024  # Results kept in memory
+SERVE_TIMEOUT = 300         # Seconds an evaluation may take
+SERVE_MAX_BODY = 1024 * 1024
+LATENCY_SAMPLES = 1000      # Latest latencies the percentiles are taken over
+THROUGHPUT_SECONDS = 60     # The recent throughput is over this many seconds
+
+# Options a request may not give: they write files, change the mode of EPIC.py or
+#   only make sense at the command line
+SERVE_IGNORED = set(['v', 'plots', 'plot_layout', 'plot_points', 'output', 'output_format',
+                     'batch', 'processes', 'monte_carlo', 'uncertain', 'seed', 'sweep',
+                     'fdc_sweep', 'head_search', 'head_tolerance', 'interactive',
+                     'clear_cache', 'cache_size', 'profile', 'profile_dump', 'format',
+                     'serve', 'host', 'port', 'queue',
+                     'dem', 'dem_outlet', 'dem_snap', 'dem_min_area', 'long_profile',
+                     'powerhouse_chainage', 'pareto', 'pareto_plot'])
+
+_pipe_tables = {} # Pipe catalogues of this process, keyed by file name: (mtime, catalogue)
+
+def get_pipe_table(filename): # {{{
+    '''
+    Returns the pipe catalogue of filename, only read again if the file has changed.
+    Raises ValueError if there is no such file.
+    '''
+    if filename is None: raise ValueError('No pipe_file')
+    try:
+        mtime = os.path.getmtime(filename)
+    except OSError:
+        raise ValueError('No such pipe file: %s' % filename)
+    if filename not in _pipe_tables or _pipe_tables[filename][0] != mtime:
+        _pipe_tables[filename] = (mtime, EPIC.read_pipe_table(filename))
+    return _pipe_tables[filename][1]
+    # }}} End of get_pipe_table
+
+def evaluate_request(params): # {{{
+    '''
+    Runs in a worker: evaluates params from get_request_params().
+    Returns (document, error), the results as get_results_document() or an error
+      message.
+    '''
+    try:
+        results = EPIC.run_epic_cached(params, get_pipe_table(params.pipe_file))
+        return (EPIC.get_results_document(results, params), None)
+    except (ValueError, TypeError, KeyError, IOError), e:
+        return (None, str(e) or e.__class__.__name__)
+    # }}} End of evaluate_request
+
+def evaluate_guarded(params): # {{{
+    '''
+    Runs in a worker: evaluate_request(), which never raises, so the callback which
+      frees the slot of the request always runs.
+    Returns (document, error, failure), failure the message of an unexpected exception
+      or None.
+    '''
+    try:
+        return evaluate_request(params) + (None,)
+    except Exception, e:
+        return (None, None, str(e) or e.__class__.__name__)
+    # }}} End of evaluate_guarded
+
+def get_request_params(request, defaults, parser): # {{{
+    '''
+    Returns params for run_epic() from the options of a request, a dict, with the
+      options not in it taken from defaults, the options before normalise_params().
+    Raises ValueError for an option which cannot be understood.
+    '''
+    if not isinstance(request, dict): raise ValueError('The request must be a JSON object')
+    args = []
+    for (name, value) in sorted(request.items()):
+        option = parser.get_option('--' + str(name).lstrip('-'))
+        if option is None: raise ValueError('Unknown option: %s' % name)
+        if option.dest in SERVE_IGNORED: raise ValueError('%s cannot be given to --serve' % name)
+        if option.action == 'store_true':
+            if value: args.append(option.get_opt_string())
+        else:
+            args += [option.get_opt_string(), str(value)]
+
+    # optparse exits on a value it cannot parse
+    try:
+        (opts, rest) = parser.parse_args(args, copy.copy(defaults))
+    except SystemExit:
+        raise ValueError('Cannot read the options %s' % ' '.join(args))
+    try:
+        return EPIC.normalise_params(opts)
+    except (TypeError, ValueError), e:
+        # float(None) for an option given nowhere
+        raise ValueError('Missing or bad option: %s' % e)
+    # }}} End of get_request_params
+
+class ServiceMetrics(object): # {{{
+    '''
+    Counts of the requests of a Service, and the latency of those answered.
+    '''
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.counts = collections.defaultdict(int)
+        self.in_flight = 0
+        self.latencies = collections.deque(maxlen=LATENCY_SAMPLES)
+        self.finished = collections.deque() # Times of the recent answers
+
+    def count(self, name):
+        with self.lock: self.counts[name] += 1
+
+    def begin(self):
+        with self.lock:
+            self.counts['requests'] += 1
+            self.in_flight += 1
+
+    def end(self, seconds, status):
+        '''
+        Records a request of /run answered with the HTTP status after seconds.
+        '''
+        now = time.time()
+        with self.lock:
+            self.in_flight -= 1
+            self.counts[status] += 1
+            self.latencies.append(seconds)
+            self.finished.append(now)
+            while self.finished and self.finished[0] < now - THROUGHPUT_SECONDS:
+                self.finished.popleft()
+
+    def report(self):
+        '''
+        Returns the metrics as a dict, latencies in ms.
+        '''
+        with self.lock:
+            now = time.time()
+            latencies = sorted(self.latencies)
+            recent = len([t for t in self.finished if t >= now - THROUGHPUT_SECONDS])
+            report = {'uptime_seconds' : now - self.started,
+                      'requests'       : self.counts['requests'],
+                      'answered'       : self.counts[200],
+                      'bad_requests'   : self.counts[400],
+                      'rejected'       : self.counts[503],
+                      'failed'         : self.counts[500],
+                      'cache_hits'     : self.counts['cache_hits'],
+                      'evaluations'    : self.counts['evaluations'],
+                      'in_flight'      : self.in_flight,
+                      'throughput_per_second' : recent / float(min(THROUGHPUT_SECONDS,
+                                                                   max(now - self.started, 1e-9)))}
+        if latencies:
+            for p in [50, 90, 99]:
+                report['latency_p%d_ms' % p] = latencies[min(len(latencies) - 1,
+                                                              len(latencies) * p // 100)] * 1000
+            report['latency_max_ms'] = latencies[-1] * 1000
+        return report
+    # }}} End of ServiceMetrics
+
+class Service(object): # {{{
+    '''
+    Evaluates requests in a pool of processes, with their results kept in memory.
+    defaults are the options before normalise_params() which requests start from.
+    '''
+    def __init__(self, defaults, processes=None, queue=SERVE_QUEUE,
+                 cache_results=SERVE_CACHE_RESULTS):
+        if processes is None: processes = multiprocessing.cpu_count()
+        self.defaults = defaults
+        self.parser = EPIC.get_option_parser()
+        self.pool = multiprocessing.Pool(max(1, processes))
+        # Running plus waiting, a request which cannot take one is turned away
+        self.slots = threading.BoundedSemaphore(max(1, processes) + max(0, queue))
+        self.cache = collections.OrderedDict()
+        self.cache_results = cache_results
+        self.lock = threading.Lock() # For the cache and the pipe catalogues
+        self.metrics = ServiceMetrics()
+
+    def get_key(self, params):
+        import result_cache
+        with self.lock: catalogue = get_pipe_table(params.pipe_file)
+        return result_cache.get_result_key(params, catalogue, False)
+
+    def get_slot_release(self):
+        '''
+        Returns a function which frees one slot the first time it is called, and does
+          nothing after that.
+        '''
+        released = []
+        lock = threading.Lock()
+        def release(*args):
+            with lock:
+                if released: return
+                released.append(True)
+            self.slots.release()
+        return release
+
+    def run(self, request):
+        '''
+        Evaluates a request, a dict of options.
+        Returns (HTTP status, document), the document is the results or {'error': message}.
+        '''
+        try:
+            params = get_request_params(request, self.defaults, self.parser)
+            key = self.get_key(params)
+        except ValueError, e:
+            return (400, {'error': str(e)})
+
+        with self.lock:
+            if key in self.cache:
+                self.cache[key] = document = self.cache.pop(key) # Now the most recently used
+                self.metrics.count('cache_hits')
+                return (200, document)
+
+        if not self.slots.acquire(False):
+            return (503, {'error': 'Too many requests, try again later'})
+        # The slot is held until the worker is done, not until this request gives up on it
+        release = self.get_slot_release()
+        try:
+            pending = self.pool.apply_async(evaluate_guarded, (params,), callback=release)
+        except:
+            release()
+            raise
+        self.metrics.count('evaluations')
+        try:
+            (document, error, failure) = pending.get(SERVE_TIMEOUT)
+        except multiprocessing.TimeoutError:
+            # A worker which died (killed, out of memory) never answers, so the slot is
+            #   freed after SERVE_TIMEOUT more whatever happens
+            timer = threading.Timer(SERVE_TIMEOUT, release)
+            timer.daemon = True
+            timer.start()
+            return (500, {'error': 'The evaluation took more than %d s' % SERVE_TIMEOUT})
+        finally:
+            if pending.ready(): release() # The callback is only called on success
+        if failure: return (500, {'error': failure})
+        if error: return (400, {'error': error})
+
+        with self.lock:
+            self.cache[key] = document
+            while len(self.cache) > self.cache_results: self.cache.popitem(last=False)
+        return (200, document)
+
+    def close(self):
+        self.pool.terminate()
+        self.pool.join()
+    # }}} End of Service
+
+class RequestHandler(BaseHTTPServer.BaseHTTPRequestHandler): # {{{
+    '''
+    Answers the requests of a ServiceServer, see the top of this file.
+    '''
+    protocol_version = 'HTTP/1.1' # Connections are kept open between requests
+
+    def send_json(self, status, document):
+        body = json.dumps(document, sort_keys=True)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        if status == 503: self.send_header('Retry-After', '1')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        service = self.server.service
+        if self.path == '/metrics': self.send_json(200, service.metrics.report())
+        elif self.path == '/health': self.send_json(200, {'status': 'ok'})
+        else: self.send_json(404, {'error': 'No such page: %s' % self.path})
+
+    def do_POST(self):
+        service = self.server.service
+        length = int(self.headers.getheader('Content-Length') or 0)
+        if self.path != '/run':
+            self.rfile.read(length)
+            return self.send_json(404, {'error': 'No such page: %s' % self.path})
+        if length > SERVE_MAX_BODY:
+            self.close_connection = 1
+            return self.send_json(413, {'error': 'The request is too big'})
+
+        start = time.time()
+        service.metrics.begin()
+        status = 500
+        try:
+            try:
+                request = json.loads(self.rfile.read(length) or '{}')
+            except ValueError:
+                (status, document) = (400, {'error': 'The request is not JSON'})
+            else:
+                (status, document) = service.run(request)
+        except Exception, e:
+            (status, document) = (500, {'error': str(e) or e.__class__.__name__})
+        finally:
+            service.metrics.end(time.time() - start, status)
+        self.send_json(status, document)
+
+    def log_message(self, format, *args):
+        pass # Counted in /metrics rather than written for every request
+    # }}} End of RequestHandler
+
+class ServiceServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer): # {{{
+    '''
+    The HTTP server of a Service, each connection is handled by its own thread.
+    '''
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 128
+
+    def __init__(self, address, service):
+        BaseHTTPServer.HTTPServer.__init__(self, address, RequestHandler)
+        self.service = service
+    # }}} End of ServiceServer
+
+def make_server(defaults, host='127.0.0.1', port=SERVE_PORT, processes=None, queue=SERVE_QUEUE): # {{{
+    '''
+    Returns a ServiceServer listening on (host, port), port 0 picks a free port (see
+      server.server_address). Call serve_forever() to answer requests, e.g. in a thread
+      for a test, then shutdown() and server.service.close().
+    '''
+    service = Service(defaults, processes, queue)
+    try:
+        return ServiceServer((host, port), service)
+    except:
+        service.close()
+        raise
+    # }}} End of make_server
+
+def serve(defaults, host='127.0.0.1', port=SERVE_PORT, processes=None, queue=SERVE_QUEUE): # {{{
+    '''
+    Answers requests until interrupted.
+    '''
+    server = make_server(defaults, host, port, processes, queue)
+    print 'EPIC serving on http://%s:%d/' % server.server_address[:2]
+    sys.stdout.flush()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        server.service.close()
+    # }}} End of serve
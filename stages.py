@@ -0,0 +1,176 @@
+# stages.py
+# This file contains the staged pipeline of EPIC.py, the model of run_epic() split into
+# the stages it naturally falls into, each with the options it reads and the stages it
+# depends on:
+#
+#   geometry    - the heads, penstock length and Hz         (slope, catchment length, heads)
+#   hydrology   - area, average and design flow, FIT        (catchment, rainfall, FDC)
+#   hydraulics  - head loss of every diameter and material  (friction method and tolerance)
+#   pipe_choice - the cheapest pipe of every head           (efficiency, market price, interest)
+#   economics   - capacity, costs, revenue and the optimums (and reliability, --top,
+#                 --flow_series)
+#
+# The outputs of each stage are remembered, keyed by the options it reads and the keys of
+# the stages it depends on. When the pipeline is run again only the stages whose inputs
+# changed are worked out, so changing only --market_price or --interest reuses the flows
+# and the head losses, which take nearly all of the time, and only chooses the pipes and
+# works out the economics again. EPIC.py --interactive uses it for what-if sessions.
+#
+# The stages are those of the vector engine (hydro_vector.py) over every head at once, so
+# the results are the same as run_epic() with --engine vector.
+import time
+from collections import OrderedDict
+
+import EPIC
+from constants import FrictionTolerance
+from hydro_vector import get_head_geometry, get_head_hydrology, get_head_losses_array, \
+                         get_optimum_pipe_array, get_economics_array, get_scheme
+from pipes import get_pipe_catalogue
+from flow_series import get_annual_energy
+
+STAGE_MEMO_SIZE = 4 # Outputs remembered per stage, the least recently used are dropped
+
+def run_geometry(params, catalogue): # {{{
+    (heads, max_H) = EPIC.get_heads(params)
+    geometry = get_head_geometry(heads, params)
+    geometry['heads'] = heads
+    geometry['max_H'] = max_H
+    return geometry
+    # }}} End of run_geometry
+
+def run_hydrology(params, catalogue, geometry): # {{{
+    return get_head_hydrology(geometry, params)
+    # }}} End of run_hydrology
+
+def run_hydraulics(params, catalogue, geometry, hydrology): # {{{
+    return get_head_losses_array(catalogue, hydrology['design_flow'], geometry['penstock_length'],
+                                 getattr(params, 'friction_method', 'fixed_point'),
+                                 getattr(params, 'friction_tolerance', FrictionTolerance))
+    # }}} End of run_hydraulics
+
+def run_pipe_choice(params, catalogue, geometry, hydrology, hydraulics): # {{{
+    return get_optimum_pipe_array(head            = geometry['head'],
+                                  pipe_table      = catalogue,
+                                  design_flow     = hydrology['design_flow'],
+                                  penstock_length = geometry['penstock_length'],
+                                  FIT             = hydrology['fit'],
+                                  efficiency      = params.efficiency,
+                                  market_price    = params.market_price,
+                                  interest        = params.interest,
+                                  head_losses     = hydraulics)
+    # }}} End of run_pipe_choice
+
+def run_economics(params, catalogue, geometry, hydrology, pipe): # {{{
+    '''
+    Returns the results of run_epic() from the outputs of the other stages.
+    '''
+    from reducer import SchemeReducer
+
+    results = {'head'               : geometry['head'],
+               'penstock_length'    : geometry['penstock_length'],
+               'avg_flow_rate'      : hydrology['avg_flow_rate'],
+               'design_flow'        : hydrology['design_flow'],
+               'fit'                : hydrology['fit']}
+    annual_energy = get_annual_energy(params, hydrology['area_frac'], hydrology['design_flow'],
+                                      geometry['head'], pipe['head_loss'], params.efficiency)
+    results.update(get_economics_array(head                = geometry['head'],
+                                       design_flow         = hydrology['design_flow'],
+                                       FIT                 = hydrology['fit'],
+                                       head_loss           = pipe['head_loss'],
+                                       total_penstock_cost = pipe['annual_capital_cost'] / params.interest,
+                                       efficiency          = params.efficiency,
+                                       market_price        = params.market_price,
+                                       reliability         = params.reliability,
+                                       interest            = params.interest,
+                                       annual_energy       = annual_energy))
+    results['diameter']  = pipe['diameter']
+    results['material']  = pipe['material']
+    results['head_loss'] = pipe['head_loss']
+    results['materials'] = catalogue.materials
+
+    heads = geometry['heads']
+    reducer = SchemeReducer(getattr(params, 'top', 1) or 1)
+    reducer.add_results(results, heads)
+    head_schemes = []
+    if params.heads: head_schemes = [get_scheme(results, i, h) for (i, h) in enumerate(heads)]
+    axes = dict((name, results[name].tolist()) for name in EPIC.AXES[1:])
+    axes['head'] = list(heads)
+
+    return {'max_H'         : geometry['max_H'],
+            'schemes'       : reducer.schemes(),
+            'top'           : dict((f[0], reducer.top(f[0])) for f in reducer.factors),
+            'head_schemes'  : head_schemes,
+            'axes'          : axes,
+            'diameters_skipped' : 0,
+            'evaluations'   : reducer.count}
+    # }}} End of run_economics
+
+# (name, options read, stages depended on, function) in the order they run. Each
+#   function is called with the params, the PipeCatalogue and the outputs of the
+#   stages it depends on.
+STAGES = [('geometry',    ['slope', 'cl', 'heads'],
+                          [], run_geometry),
+          ('hydrology',   ['catch_type', 'cl', 'ca', 'aar', 'aae', 'fdc_index'],
+                          ['geometry'], run_hydrology),
+          ('hydraulics',  ['friction_method', 'friction_tolerance'],
+                          ['geometry', 'hydrology'], run_hydraulics),
+          ('pipe_choice', ['efficiency', 'market_price', 'interest'],
+                          ['geometry', 'hydrology', 'hydraulics'], run_pipe_choice),
+          ('economics',   ['efficiency', 'market_price', 'reliability', 'interest', 'top',
+                           'flow_series', 'flow_step', 'min_flow'],
+                          ['geometry', 'hydrology', 'pipe_choice'], run_economics)]
+
+class Pipeline(object): # {{{
+    '''
+    Runs the STAGES for one pipe file, remembering the outputs of each stage so a run
+      only works out the stages whose options, or whose stages, have changed.
+    After each run, timings is a list of (stage, seconds, worked out) in the order of
+      STAGES, where worked out is False for a stage whose output was remembered.
+    '''
+    def __init__(self, pipe_table, stages=STAGES, memo_size=STAGE_MEMO_SIZE):
+        self.catalogue = get_pipe_catalogue(pipe_table)
+        self.stages = stages
+        self.memo_size = memo_size
+        self._memo = dict((name, OrderedDict()) for (name, options, inputs, run) in stages)
+        self.timings = []
+
+    def _get(self, name, key):
+        memo = self._memo[name]
+        if key not in memo: return None
+        outputs = memo.pop(key)
+        memo[key] = outputs # Now the most recently used
+        return outputs
+
+    def _put(self, name, key, outputs):
+        memo = self._memo[name]
+        memo[key] = outputs
+        while len(memo) > self.memo_size: memo.popitem(last=False)
+
+    def run(self, params):
+        '''
+        Returns the results of the last stage, the same as EPIC.run_epic() with the
+          per head axes kept. params is from EPIC.parse_args() or EPIC.make_params().
+        Raises ValueError if a head in params.heads is above the maximum head.
+        '''
+        keys = {}
+        outputs = {}
+        self.timings = []
+        for (name, options, inputs, run) in self.stages:
+            keys[name] = (tuple(getattr(params, option, None) for option in options),
+                          tuple(keys[i] for i in inputs))
+            start = time.time()
+            outputs[name] = self._get(name, keys[name])
+            if outputs[name] is None:
+                outputs[name] = run(params, self.catalogue, *[outputs[i] for i in inputs])
+                self._put(name, keys[name], outputs[name])
+                self.timings.append((name, time.time() - start, True))
+            else:
+                self.timings.append((name, time.time() - start, False))
+        return outputs[self.stages[-1][0]]
+
+    def clear(self):
+        '''
+        Forgets every remembered output.
+        '''
+        for memo in self._memo.values(): memo.clear()
+    # }}} End of Pipeline
@@ -0,0 +1,329 @@
+# sweep.py
+# This file contains the sensitivity sweep mode of EPIC.py (--sweep), which finds the
+# optimum schemes at every point of a grid of interest, market price, efficiency and
+# reliability values.
+#
+# --sweep takes a comma separated list of option=first:last:count or option=value, e.g.
+#   --sweep interest=0.03:0.08:50,market_price=0.02:0.05:50,efficiency=0.7:0.9:10
+# Options which are not listed keep their command line value.
+#
+# None of the swept options change the hydrology or the friction in the pipes, so the
+# design flow, FIT and the head loss of every head, diameter and material are worked out
+# once. What is left to choose at each grid point is the pipe: for a head, every pipe is
+# a straight line in
+#   total annual cost / interest = capital cost + r * head loss cost
+#   r = efficiency * (FIT + market_price) / interest
+# so the cheapest pipe only depends on r, and is read off the lower envelope of those
+# lines (worked out once per head) rather than by trying every pipe again. The choice
+# is the same as get_optimum_pipe_array() except where two pipes cost exactly the same
+# to the last bit, which the two ways of adding up the costs may round differently.
+import itertools
+import numpy as np
+from constants import *
+import EPIC
+from hydro_vector import OPTIMUM_FACTORS, EMPTY_SCHEME, get_head_flows, \
+                         get_head_loss_array, get_economics_array, get_optimum_index
+from pipes import get_pipe_catalogue
+from flow_series import get_annual_energy
+
+# The options which may be swept, in the order of the grid axes
+SWEEP_OPTIONS = [('interest',       'interest'),
+                 ('market_price',   'market_price'),
+                 ('efficiency',     'efficiency'),
+                 ('reliability',    'reliability')]
+
+# Grid points are evaluated in chunks of about this many (grid point, head) elements
+#   to bound memory.
+SWEEP_CHUNK_ELEMENTS = 500000
+
+def parse_sweep(spec, params): # {{{
+    '''
+    Parses the --sweep option.
+    Returns a list of (params dest, array of values) in the order of SWEEP_OPTIONS,
+      options which are not swept have their single value from params.
+    Raises ValueError if the option cannot be understood.
+    '''
+    names = dict(SWEEP_OPTIONS)
+    values = {}
+    for item in (spec or '').split(','):
+        if not item: continue
+        try:
+            (option, value) = item.split('=')
+            fields = [float(x) for x in value.split(':')]
+        except ValueError:
+            raise ValueError('Cannot read sweep: %s' % item)
+        if option not in names:
+            raise ValueError('%s cannot be swept, only %s' %
+                             (option, ', '.join(name for (name, dest) in SWEEP_OPTIONS)))
+        if len(fields) == 1:
+            values[names[option]] = np.array(fields)
+        elif len(fields) == 3 and fields[2] >= 1 and fields[2] == int(fields[2]):
+            values[names[option]] = np.linspace(fields[0], fields[1], int(fields[2]))
+        else:
+            raise ValueError('Sweep %s should be first:last:count or a single value' % option)
+
+    grid = []
+    for (option, dest) in SWEEP_OPTIONS:
+        if dest not in values: values[dest] = np.array([float(getattr(params, dest))])
+        grid.append((dest, values[dest]))
+
+    interest = values['interest']
+    if (interest <= 0).any():
+        raise ValueError('Interest must be above 0 in a sweep')
+    return grid
+    # }}} End of parse_sweep
+
+def get_lower_envelope(C, S): # {{{
+    '''
+    C and S are 1-D arrays of lines C + r * S, in the order get_optimum_pipe_array()
+      prefers them when they cost the same. Lines which are not finite are left out.
+    Returns (breaks, lines): lines[k] is the lowest line for breaks[k] <= r <
+      breaks[k + 1], and breaks[0] is -inf. Both are empty if no line is finite.
+    '''
+    valid = np.flatnonzero(np.isfinite(C) & np.isfinite(S))
+    if not len(valid): return ([], [])
+
+    # As r goes to -inf the steepest line is lowest
+    current = valid[np.lexsort((valid, C[valid], -S[valid]))[0]]
+    breaks = [-np.inf]
+    lines = [current]
+    while True:
+        # Each shallower line crosses the current one once, the first to cross is next
+        shallower = valid[S[valid] < S[current]]
+        if not len(shallower): break
+        r = (C[shallower] - C[current]) / (S[current] - S[shallower])
+        first = np.lexsort((shallower, S[shallower], r))[0]
+        current = shallower[first]
+        breaks.append(max(r[first], breaks[-1]))
+        lines.append(current)
+
+    return (breaks, lines)
+    # }}} End of get_lower_envelope
+
+def get_pipe_envelopes(flows, pipe_table, params): # {{{
+    '''
+    Works out the head loss of every pipe once and the lower envelope of the pipe cost
+      lines for every head (see the top of this file).
+    flows is from hydro_vector.get_head_flows().
+    Returns a dict of heads x envelope segment arrays: breaks (padded with inf), and
+      for the pipe of each segment penstock_cost (capital cost), head_loss_cost (head
+      loss cost per unit of efficiency * (FIT + market_price)), head_loss, diameter
+      and material, plus materials, the names of the materials.
+    '''
+    catalogue = get_pipe_catalogue(pipe_table)
+    diameter = catalogue.diameter
+    Q = flows['design_flow'][:, np.newaxis]
+    L = flows['penstock_length'][:, np.newaxis]
+    head = flows['head'][:, np.newaxis]
+
+    # Every (head, diameter, material), materials in the order of the catalogue
+    head_loss = np.empty(L.shape[:1] + diameter.shape + (len(catalogue.materials),))
+    for (k, E) in enumerate(catalogue.roughness):
+        head_loss[..., k] = get_head_loss_array(flows['design_flow'], flows['penstock_length'],
+                                                diameter, E,
+                                                getattr(params, 'friction_method', 'fixed_point'),
+                                                getattr(params, 'friction_tolerance', FrictionTolerance))
+    penstock_cost = L[..., np.newaxis] * catalogue.cost.T
+    head_loss_cost = head_loss * (Q * G * (365 * 24))[..., np.newaxis]
+
+    # The materials each pipe may be made of, as in get_material_choice_array(): a
+    #   preferred material where it is allowed, otherwise any of the others
+    allowed = np.zeros(head_loss.shape, dtype=bool)
+    preferred = np.zeros(head_loss.shape[:2], dtype=bool)
+    for k in np.flatnonzero(catalogue.preferred):
+        allowed[..., k] = ~preferred & ~np.isnan(catalogue.cost[k]) & \
+                          (head <= catalogue.max_head[k]) & (diameter <= catalogue.max_diameter[k])
+        preferred |= allowed[..., k]
+    for k in np.flatnonzero(~catalogue.preferred):
+        allowed[..., k] = ~preferred & ~np.isnan(catalogue.cost[k])
+
+    # Lines are in the order the pipes are preferred on a tie: the first diameter, and
+    #   then the later material
+    order = range(len(catalogue.materials))[::-1]
+    materials = np.tile(order, len(diameter))
+    diameters = np.repeat(diameter, len(order))
+
+    envelopes = []
+    for h in range(len(flows['head'])):
+        ok = allowed[h][:, order].ravel()
+        C = np.where(ok, penstock_cost[h][:, order].ravel(), np.nan)
+        S = np.where(ok, head_loss_cost[h][:, order].ravel(), np.nan)
+        envelopes.append(get_lower_envelope(C, S))
+
+    segments = max([1] + [len(lines) for (breaks, lines) in envelopes])
+    shape = (len(envelopes), segments)
+    pipes = {'breaks'         : np.empty(shape),
+             'penstock_cost'  : np.zeros(shape),
+             'head_loss_cost' : np.zeros(shape),
+             'head_loss'      : np.zeros(shape),
+             'diameter'       : np.zeros(shape),
+             'material'       : np.zeros(shape, dtype=int)}
+    pipes['breaks'].fill(np.inf)
+    for (h, (breaks, lines)) in enumerate(envelopes):
+        n = len(lines)
+        (j, m) = (np.array(lines, dtype=int) // len(order), materials[lines])
+        pipes['breaks'][h, :n]         = breaks
+        pipes['penstock_cost'][h, :n]  = penstock_cost[h, j, m]
+        pipes['head_loss_cost'][h, :n] = head_loss_cost[h, j, m]
+        pipes['head_loss'][h, :n]      = head_loss[h, j, m]
+        pipes['diameter'][h, :n]       = diameters[lines]
+        pipes['material'][h, :n]       = m
+
+    pipes['materials'] = catalogue.materials
+    return pipes
+    # }}} End of get_pipe_envelopes
+
+def run_sweep(params, pipe_table, grid): # {{{
+    '''
+    Finds the optimum schemes at every point of the grid from parse_sweep().
+    Returns a dict with:
+      parameters - the params dest of each grid axis
+      values     - an array of grid points x parameters, the last parameter varying
+                   fastest
+      schemes    - for each economic factor of hydro_vector.OPTIMUM_FACTORS, a dict of
+                   arrays over the grid points keyed as the scheme dicts of EPIC.py,
+                   with material an index into materials (-1 for none)
+      materials  - the names of the materials of the pipe file
+    '''
+    (heads, max_H) = EPIC.get_heads(params)
+    flows = get_head_flows(heads, params)
+    pipes = get_pipe_envelopes(flows, pipe_table, params)
+    materials = pipes.pop('materials')
+
+    parameters = [dest for (dest, values) in grid]
+    points = np.array(list(itertools.product(*[values for (dest, values) in grid])))
+    points = points.reshape((-1, len(parameters)))
+
+    n_heads = len(flows['head'])
+    schemes = {}
+    for (key, better, initial, condition) in OPTIMUM_FACTORS:
+        schemes[key] = {'head'      : np.empty(len(points)),
+                        'material'  : np.empty(len(points), dtype=int),
+                        'diameter'  : np.empty(len(points))}
+        for field in ['capacity', 'project_cost', 'cost_per_kw', 'payback_period',
+                      'annual_roi', 'annual_revenue']:
+            schemes[key][field] = np.empty(len(points))
+
+    # With no heads every grid point has the empty schemes, as in run_epic()
+    if n_heads == 0:
+        for (key, better, initial, condition) in OPTIMUM_FACTORS:
+            for (field, values) in schemes[key].items():
+                values.fill(EMPTY_SCHEME[field] if field != 'material' else -1)
+
+    rows = np.arange(n_heads)
+    segments = pipes['breaks'].shape[1]
+    chunk = max(1, SWEEP_CHUNK_ELEMENTS // max(1, n_heads))
+    for start in range(0, len(points) if n_heads else 0, chunk):
+        stop = min(start + chunk, len(points))
+        p = dict((dest, points[start:stop, k, np.newaxis]) for (k, dest) in enumerate(parameters))
+
+        # The pipe is the envelope segment which r falls in
+        r = p['efficiency'] * (flows['fit'] + p['market_price']) / p['interest']
+        segment = np.empty(r.shape, dtype=int)
+        for (h, breaks) in enumerate(pipes['breaks']):
+            segment[:, h] = np.searchsorted(breaks, r[:, h], side='right') - 1
+        flat = rows * segments + np.maximum(segment, 0) # take() on the flat arrays is quickest
+        pipe = dict((field, values.take(flat)) for (field, values) in pipes.items())
+
+        # No pipe beat the initial cost, as in get_optimum_pipe_array()
+        total_annual_cost = p['interest'] * pipe['penstock_cost'] + \
+                            p['efficiency'] * (flows['fit'] + p['market_price']) * pipe['head_loss_cost']
+        none = (segment < 0) | ~(total_annual_cost < 999999999.9)
+        for field in ['penstock_cost', 'head_loss', 'diameter']:
+            pipe[field] = np.where(none, 0, pipe[field])
+        pipe['material'] = np.where(none, -1, pipe['material'])
+
+        annual_energy = get_annual_energy(params, flows['area_frac'], flows['design_flow'],
+                                          flows['head'], pipe['head_loss'], p['efficiency'])
+        economics = get_economics_array(head                = flows['head'],
+                                        design_flow         = flows['design_flow'],
+                                        FIT                 = flows['fit'],
+                                        head_loss           = pipe['head_loss'],
+                                        total_penstock_cost = pipe['penstock_cost'],
+                                        efficiency          = p['efficiency'],
+                                        market_price        = p['market_price'],
+                                        reliability         = p['reliability'],
+                                        interest            = p['interest'],
+                                        annual_energy       = annual_energy)
+        economics['head'] = np.broadcast_to(flows['head'], pipe['diameter'].shape)
+        economics['project_cost'] = economics['total_project_cost']
+        economics['diameter'] = pipe['diameter']
+        economics['material'] = pipe['material']
+
+        points_in_chunk = np.arange(stop - start)
+        for (key, better, initial, condition) in OPTIMUM_FACTORS:
+            i = get_optimum_index(economics[key], key)
+            found = i >= 0
+            for (field, values) in schemes[key].items():
+                empty = EMPTY_SCHEME[field] if field != 'material' else -1
+                values[start:stop] = np.where(found, economics[field][points_in_chunk, i], empty)
+
+    return {'parameters'    : parameters,
+            'values'        : points,
+            'schemes'       : schemes,
+            'materials'     : materials}
+    # }}} End of run_sweep
+
+def get_sweep_rows(results): # {{{
+    '''
+    Yields (grid point values, scheme name, scheme dict) for every grid point and
+      optimum scheme, in the order of EPIC.RESULT_SCHEMES.
+    '''
+    schemes = [(name, dict((field, values.tolist())
+                           for (field, values) in results['schemes'][key].items()))
+               for (name, key) in EPIC.RESULT_SCHEMES]
+    for (n, point) in enumerate(results['values'].tolist()):
+        for (name, columns) in schemes:
+            scheme = dict((field, values[n]) for (field, values) in columns.items())
+            material = scheme['material']
+            if material >= 0:
+                scheme['material'] = results['materials'][material]
+                scheme['head'] = int(scheme['head']) # The heads are whole meters
+            else:
+                scheme['material'] = ''
+            yield (point, name, scheme)
+    # }}} End of get_sweep_rows
+
+def print_sweep(results, params, out=None): # {{{
+    '''
+    Writes the optimum schemes from run_sweep() in the format of params.format: one
+      row per grid point and scheme for table and csv, one JSON object per grid point
+      for json.
+    '''
+    import sys
+    if out is None: out = sys.stdout
+    parameters = results['parameters']
+    rows = get_sweep_rows(results)
+
+    if params.format == 'json':
+        import json
+        keys = dict(EPIC.RESULT_SCHEMES)
+        for (point, group) in itertools.groupby(rows, lambda row: row[0]):
+            document = dict(zip(parameters, point))
+            document['schemes'] = dict((keys[name], EPIC.get_json_scheme(scheme))
+                                       for (point, name, scheme) in group)
+            out.write(json.dumps(document, sort_keys=True) + '\n') # dumps() uses the C encoder
+
+    elif params.format == 'csv':
+        import csv
+        writer = csv.writer(out)
+        writer.writerow(parameters + ['scheme'] + EPIC.RESULT_FIELDS)
+        for (point, name, scheme) in rows:
+            writer.writerow([repr(x) for x in point] + [name] +
+                            [repr(scheme[k]) if isinstance(scheme[k], float) else scheme[k]
+                             for k in EPIC.RESULT_FIELDS])
+
+    else:
+        from prettytable import PrettyTable
+        table = PrettyTable([dest.replace('_', ' ').title() for dest in parameters] +
+                            ['Scheme', 'Head (m)', 'Mat', 'Diam (m)', 'Cap (kW)',
+                             'Rev/Yr (GBP)', 'Proj Cost (GBP)', 'Payback Period (Yr)',
+                             'Cost/kW (GBP/kW)'])
+        for (point, name, scheme) in rows:
+            table.add_row(['%g' % x for x in point] + [name, scheme['head'], scheme['material']] +
+                          ['%.02f' % scheme[k] for k in ['diameter', 'capacity', 'annual_revenue',
+                                                         'project_cost', 'payback_period',
+                                                         'cost_per_kw']])
+        print >>out, 'Input file: ', params.pipe_file
+        print >>out, table
+    # }}} End of print_sweep